@@ -1,10 +1,24 @@
 
-from langchain_core.runnables import Runnable, RunnableConfig
-from typing import Dict
+import asyncio
+import contextvars
+import copy
+import hashlib
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+from langchain_core.runnables.config import run_in_executor
+from typing import Dict, Optional
 from typing import Annotated
 from typing_extensions import TypedDict
 from langgraph.graph.message import AnyMessage, add_messages
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage, ToolMessage
+from context import ContextManager
+from response_cache import ResponseCache
+from singleflight import SingleFlight
+import telemetry
 
 
 
@@ -13,29 +27,315 @@ class State(TypedDict):
     messages: Annotated[list[AnyMessage], add_messages]
 
 
+# Prompt added after an empty LLM response (once: retries do not make the history grow)
+RETRY_PROMPT = "Respond with a real output."
+
+# Answer of the turn when every attempt (and the fallback model) failed
+CANNED_RESPONSE = (
+    "Sorry, I could not come up with an answer just now. Could you rephrase your question or try again?"
+)
+
+
+# How the Assistant retries empty LLM responses and what it does when they keep coming.
+class RetryPolicy:
+    """Bounded retries of empty LLM responses.
+
+    Args:
+        max_attempts (int): LLM calls per turn, the first one included.
+        call_timeout (float): Seconds a single LLM call may take (None: no limit).
+        deadline (float): Seconds the attempts and the fallback model of a turn may take together (None: no limit).
+        backoff (float): Seconds to wait before the second attempt, doubled for every further one.
+        canned_response (str): Answer of the turn when the attempts and the fallback model all failed.
+
+    stats() returns the LLM calls, retries, timeouts, fallbacks and canned answers of all turns so far, with the
+    tokens wasted on empty responses and the seconds the retries added.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 3,
+        call_timeout: Optional[float] = None,
+        deadline: Optional[float] = None,
+        backoff: float = 0.0,
+        canned_response: str = CANNED_RESPONSE,
+    ):
+        self.max_attempts = max(1, max_attempts)
+        self.call_timeout = call_timeout
+        self.deadline = deadline
+        self.backoff = backoff
+        self.canned_response = canned_response
+        self._lock = threading.Lock()
+        # retry_seconds: time from the first failed attempt of a turn to its answer (the latency retries add)
+        self.counts = {
+            "llm_calls": 0, "retries": 0, "timeouts": 0, "fallbacks": 0, "canned": 0,
+            "wasted_tokens": 0, "retry_seconds": 0.0,
+        }
+
+    def timeout(self, ends: Optional[float]) -> Optional[float]:
+        """Timeout of the next call: the call timeout, cut short by the deadline of the turn (ends, monotonic)."""
+        if ends is None:
+            return self.call_timeout
+        remaining = ends - time.monotonic()
+        return remaining if self.call_timeout is None else min(self.call_timeout, remaining)
+
+    def delay(self, attempt: int, ends: Optional[float]) -> float:
+        """Seconds to wait after the failed attempt (1-based), never past the deadline of the turn."""
+        delay = self.backoff * 2 ** (attempt - 1)
+        return delay if ends is None else max(0.0, min(delay, ends - time.monotonic()))
+
+    def count(self, name: str, value=1):
+        with self._lock:
+            self.counts[name] += value
+        current = telemetry.get_telemetry()
+        if current is not None and name not in ("llm_calls", "retries"):
+            # Retries are counted by telemetry.record_retry()
+            current.count(f"skincare_assistant_{name}_total", value)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.counts)
+
+
+def is_empty_response(result) -> bool:
+    return not getattr(result, 'tool_calls', None) and (
+        not getattr(result, 'content', None)
+        or isinstance(result.content, list)
+        and not result.content[0].get("text")
+    )
+
+
+def prompt_key(runnable: Runnable, messages: list[AnyMessage]) -> tuple:
+    """Single-flight key of an LLM call: the runnable and what the prompt says, without the message and tool
+       call ids (they differ between conversations that send the same prompt).
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for message in messages:
+        digest.update(json.dumps(
+            [
+                message.type,
+                message.content,
+                [[call["name"], call["args"]] for call in getattr(message, "tool_calls", None) or []],
+                message.name if isinstance(message, ToolMessage) else None,
+            ],
+            sort_keys=True, default=str, ensure_ascii=False,
+        ).encode("utf-8"))
+    return id(runnable), digest.hexdigest()
+
+
+def _shared_response(result):
+    """Copy of a response shared with another conversation, with its own message id."""
+    message = copy.deepcopy(result)
+    if isinstance(message, AIMessage):
+        message.id = f"shared-{uuid.uuid4()}"
+    return message
+
+
 # Defining the Assistant class which takes the Graph state, formats it into a prompt and then invokes the LLM.
+# An optional ContextManager trims the history (recent turns verbatim, older ones summarized) before each call,
+# max_concurrency bounds the number of LLM calls in flight across all conversations and an optional
+# ResponseCache answers near-identical turns without calling the LLM. Empty responses are retried within the
+# bounds of the RetryPolicy, then answered by the fallback runnable (a cheaper model) or a canned response.
+# With a SingleFlight, concurrent calls sending the same prompt messages (e.g. the first-turn greetings of many
+# sessions) share one LLM generation; the prompt template must then depend on the messages only.
 class Assistant:
-    def __init__(self, runnable: Runnable):
+    def __init__(
+        self,
+        runnable: Runnable,
+        context_manager: Optional[ContextManager] = None,
+        max_concurrency: Optional[int] = None,
+        cache: Optional[ResponseCache] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        fallback: Optional[Runnable] = None,
+        single_flight: Optional[SingleFlight] = None,
+    ):
         self.runnable = runnable
+        self.context_manager = context_manager
+        self.max_concurrency = max_concurrency
+        self.cache = cache
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.fallback = fallback
+        self.single_flight = single_flight
+        # Graph runs use the threading semaphore (sync) or the asyncio one (async)
+        self._sync_limit = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self._async_limit = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        # Sync calls with a timeout run on this pool (a call that timed out keeps its thread until it returns)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _with_user_info(self, state: State, config: RunnableConfig) -> State:
+        # Configuration for user_id (which is same as thread_id)
+        configuration = config.get("configurable", {})
+        user_id = configuration.get("user_id", None)
+        return {**state, "user_info": user_id}
+
+    def _retry_state(self, state: State, result, config: RunnableConfig) -> Optional[State]:
+        """Return the state to re-prompt the LLM with if it returned an empty response, otherwise None."""
+        if not is_empty_response(result):
+            return None
+        telemetry.record_retry(config)
+        self.retry_policy.count("retries")
+        self._wasted(result)
+        return {**state, "messages": state["messages"] + [HumanMessage(content=RETRY_PROMPT)]}
+
+    def _wasted(self, result):
+        # The tokens of an empty response bought nothing
+        usage = getattr(result, "usage_metadata", None) or {}
+        self.retry_policy.count("wasted_tokens", usage.get("total_tokens", 0))
+
+    def _finish(self, result, history, failed_at: Optional[float]):
+        """Return the node update with the answer of the turn (cached unless history is None, i.e. canned)."""
+        if failed_at is not None:
+            self.retry_policy.count("retry_seconds", time.monotonic() - failed_at)
+        if self.cache is not None and history is not None:
+            self.cache.store(history, result)
+        return {"messages": result}
+
+    def _canned(self) -> AIMessage:
+        self.retry_policy.count("canned")
+        return AIMessage(content=self.retry_policy.canned_response)
+
+    # Sync path
+
+    def _invoke(self, runnable: Runnable, state: State, config: RunnableConfig, timeout: Optional[float]):
+        def call():
+            # Pass the config on so that streaming callbacks (stream_mode="messages") see the LLM tokens
+            if self._sync_limit is not None:
+                with self._sync_limit:
+                    return runnable.invoke(state, config)
+            return runnable.invoke(state, config)
+
+        def execute():
+            self.retry_policy.count("llm_calls")
+            if timeout is None:
+                return call()
+            if timeout <= 0:
+                raise TimeoutError()
+            if self._executor is None:
+                with self._executor_lock:
+                    if self._executor is None:
+                        self._executor = ThreadPoolExecutor(
+                            max_workers=self.max_concurrency or 32, thread_name_prefix="llm"
+                        )
+            return self._executor.submit(contextvars.copy_context().run, call).result(timeout=timeout)
+
+        if self.single_flight is None:
+            return execute()
+        # Waiters give up after the same timeout as the call itself
+        result, shared = self.single_flight.do(prompt_key(runnable, state["messages"]), execute, timeout)
+        return _shared_response(result) if shared else result
 
     def __call__(self, state: State, config: RunnableConfig):
-        while True:
-            # Configuration for user_id (which is same as thread_id)
-            configuration = config.get("configurable", {})
-            user_id = configuration.get("user_id", None)
-            state = {**state, "user_info": user_id}
-            result = self.runnable.invoke(state)
-
-            # If the LLM returns an empty response, we will re-prompt it again.
-            if not getattr(result, 'tool_calls', None) and (
-                not getattr(result, 'content', None)
-                or isinstance(result.content, list)
-                and not result.content[0].get("text")
-            ):
-                messages = state["messages"] + [HumanMessage(content="Respond with a real output.")]
-                state = {**state, "messages": messages}
-            else:
+        # The cache is keyed on the untrimmed history (and never sees the retry prompts below)
+        history = state["messages"]
+        if self.cache is not None:
+            cached = self.cache.lookup(history)
+            if cached is not None:
+                return {"messages": cached}
+
+        if self.context_manager is not None:
+            thread_id = config.get("configurable", {}).get("thread_id", None)
+            state = {**state, "messages": self.context_manager.prepare(state["messages"], thread_id)}
+        state = self._with_user_info(state, config)
+
+        policy = self.retry_policy
+        ends = time.monotonic() + policy.deadline if policy.deadline is not None else None
+        failed_at = None
+        attempt_state = state
+        for attempt in range(1, policy.max_attempts + 1):
+            try:
+                result = self._invoke(self.runnable, attempt_state, config, policy.timeout(ends))
+            except TimeoutError:
+                # A model this slow is not retried: go straight to the fallback
+                self.retry_policy.count("timeouts")
+                failed_at = failed_at or time.monotonic()
                 break
-        return {"messages": result}
+            # If the LLM returns an empty response, we will re-prompt it again (within the policy).
+            retry_state = self._retry_state(state, result, config)
+            if retry_state is None:
+                return self._finish(result, history, failed_at)
+            failed_at = failed_at or time.monotonic()
+            attempt_state = retry_state
+            if attempt < policy.max_attempts and policy.backoff:
+                time.sleep(policy.delay(attempt, ends))
+
+        # Attempts exhausted: degrade to the fallback model, then to the canned response
+        if self.fallback is not None:
+            self.retry_policy.count("fallbacks")
+            try:
+                # The fallback is bounded by the deadline of the turn too
+                result = self._invoke(self.fallback, state, config, policy.timeout(ends))
+                if not is_empty_response(result):
+                    return self._finish(result, history, failed_at)
+                self._wasted(result)
+            except TimeoutError:
+                self.retry_policy.count("timeouts")
+        return self._finish(self._canned(), None, failed_at)
+
+    # Async path
+
+    async def _ainvoke(self, runnable: Runnable, state: State, config: RunnableConfig, timeout: Optional[float]):
+        async def call():
+            if self._async_limit is not None:
+                async with self._async_limit:
+                    return await runnable.ainvoke(state, config)
+            return await runnable.ainvoke(state, config)
+
+        async def execute():
+            self.retry_policy.count("llm_calls")
+            if timeout is not None and timeout <= 0:
+                raise asyncio.TimeoutError()
+            return await asyncio.wait_for(call(), timeout)
+
+        if self.single_flight is None:
+            return await execute()
+        result, shared = await self.single_flight.ado(prompt_key(runnable, state["messages"]), execute, timeout)
+        return _shared_response(result) if shared else result
+
+    async def acall(self, state: State, config: RunnableConfig):
+        """Async version of __call__, used when the graph runs with ainvoke/astream (e.g. server.py)."""
+        history = state["messages"]
+        if self.cache is not None:
+            cached = self.cache.lookup(history)
+            if cached is not None:
+                return {"messages": cached}
+
+        if self.context_manager is not None:
+            thread_id = config.get("configurable", {}).get("thread_id", None)
+            # The summary may need an LLM call: keep it off the event loop
+            messages = await run_in_executor(config, self.context_manager.prepare, state["messages"], thread_id)
+            state = {**state, "messages": messages}
+        state = self._with_user_info(state, config)
+
+        policy = self.retry_policy
+        ends = time.monotonic() + policy.deadline if policy.deadline is not None else None
+        failed_at = None
+        attempt_state = state
+        for attempt in range(1, policy.max_attempts + 1):
+            try:
+                result = await self._ainvoke(self.runnable, attempt_state, config, policy.timeout(ends))
+            except asyncio.TimeoutError:
+                self.retry_policy.count("timeouts")
+                failed_at = failed_at or time.monotonic()
+                break
+            retry_state = self._retry_state(state, result, config)
+            if retry_state is None:
+                return self._finish(result, history, failed_at)
+            failed_at = failed_at or time.monotonic()
+            attempt_state = retry_state
+            if attempt < policy.max_attempts and policy.backoff:
+                await asyncio.sleep(policy.delay(attempt, ends))
 
+        if self.fallback is not None:
+            self.retry_policy.count("fallbacks")
+            try:
+                result = await self._ainvoke(self.fallback, state, config, policy.timeout(ends))
+                if not is_empty_response(result):
+                    return self._finish(result, history, failed_at)
+                self._wasted(result)
+            except asyncio.TimeoutError:
+                self.retry_policy.count("timeouts")
+        return self._finish(self._canned(), None, failed_at)
 
+    def as_runnable(self) -> Runnable:
+        """Graph node running __call__ for invoke/stream and acall for ainvoke/astream."""
+        return RunnableLambda(self, afunc=self.acall)
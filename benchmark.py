@@ -0,0 +1,344 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+
+from latency import summarize
+
+'''
+    This is a script that benchmarks the tools and the database setup offline (no LLM, no network).
+    For every catalog size it generates a synthetic products CSV and shopping carts, times the setup.py load path
+    and the logic of every tool, and records p50/p95/p99 latency, throughput and peak RSS. Each size runs in its
+    own process so the peak RSS and the in-memory catalog of one size do not leak into the next.
+
+    Examples:
+        python benchmark.py                                        # 10k and 100k products
+        python benchmark.py --products 10000 100000 1000000 --users 100000 --output baseline.json
+        python benchmark.py --compare baseline.json                # fails if a p50/p95 regressed
+'''
+
+CATEGORIES = {
+    "Moisturizers": ["Cream", "Lotion", "Gel Cream", "Moisturizer", "Balm"],
+    "Cleansers": ["Cleanser", "Foaming Wash", "Cleansing Oil", "Micellar Water", "Cleansing Balm"],
+    "Serums": ["Serum", "Ampoule", "Essence", "Booster", "Concentrate"],
+    "Sunscreens": ["Sunscreen SPF 30", "Sunscreen SPF 50", "Sun Fluid", "Mineral Sunscreen", "Sun Stick"],
+    "Toners": ["Toner", "Tonic", "Mist", "Pads"],
+    "Masks": ["Sheet Mask", "Clay Mask", "Sleeping Mask", "Peel-Off Mask"],
+    "Exfoliators": ["Scrub", "Peeling Gel", "Exfoliating Toner", "Enzyme Powder"],
+    "Eye Care": ["Eye Cream", "Eye Gel", "Eye Serum", "Eye Patches"],
+    "Lip Care": ["Lip Balm", "Lip Mask", "Lip Oil", "Lip Scrub"],
+    "Body Care": ["Body Lotion", "Body Wash", "Body Oil", "Hand Cream"],
+}
+ADJECTIVES = [
+    "Hydrating", "Oil-Free", "Brightening", "Soothing", "Gentle", "Firming", "Daily", "Overnight", "Mattifying",
+    "Nourishing", "Clarifying", "Calming", "Renewing", "Radiance", "Ultra Light", "Intensive", "Balancing",
+    "Revitalizing", "Barrier Repair", "Sensitive",
+]
+INGREDIENTS = [
+    "Hyaluronic Acid", "Vitamin C", "Retinol", "Niacinamide", "Ceramide", "Green Tea", "Aloe Vera", "Peptide",
+    "Salicylic Acid", "Squalane", "Glycolic Acid", "Centella", "Rosehip", "Shea Butter", "Zinc", "Collagen",
+    "Snail Mucin", "Bakuchiol", "Charcoal", "Oat",
+]
+SKIN_TYPES = ["dry", "oily", "combination", "sensitive", "normal", "acne-prone", "mature", "dull"]
+BENEFITS = [
+    "locks in moisture", "reduces redness", "evens out skin tone", "minimizes pores", "smooths fine lines",
+    "calms irritation", "protects against UV damage", "removes makeup", "restores the skin barrier",
+    "controls shine",
+]
+
+# Default number of timed calls per tool
+CALLS = 2000
+
+
+def generate_catalog(path: str, products: int, seed: int = 0):
+    """Write a synthetic products CSV with the columns of skincare_products.csv."""
+    rng = random.Random(seed)
+    categories = list(CATEGORIES)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["ID", "product_name", "description", "category", "stock", "price"])
+        for product_id in range(1, products + 1):
+            category = rng.choice(categories)
+            ingredient = rng.choice(INGREDIENTS)
+            name = f"{rng.choice(ADJECTIVES)} {ingredient} {rng.choice(CATEGORIES[category])}"
+            description = (
+                f"{rng.choice(ADJECTIVES)} formula with {ingredient.lower()} that {rng.choice(BENEFITS)} "
+                f"for {rng.choice(SKIN_TYPES)} skin."
+            )
+            writer.writerow([product_id, name, description, category, rng.randint(0, 200),
+                             round(rng.uniform(5, 90), 2)])
+
+
+def user_id(index: int) -> str:
+    return f"bench-user-{index:06d}"
+
+
+def generate_carts(path: str, users: int, products: int, max_items: int = 5, seed: int = 0) -> int:
+    """Fill the shopping carts of a database with 1 to max_items products per user. Returns the row count."""
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    rows = 0
+    try:
+        conn.execute("BEGIN")
+        for index in range(users):
+            product_ids = rng.sample(range(1, products + 1), min(rng.randint(1, max_items), products))
+            conn.executemany(
+                "INSERT INTO shopping_carts (user_id, product_id, product_name, price, quantity) "
+                "SELECT ?, product_id, product_name, price, ? FROM products WHERE product_id = ?",
+                [(user_id(index), rng.randint(1, 3), product_id) for product_id in product_ids],
+            )
+            rows += len(product_ids)
+        conn.commit()
+    finally:
+        conn.close()
+    return rows
+
+
+def peak_rss_mb() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return usage / (1024 * 1024) if sys.platform == "darwin" else usage / 1024
+
+
+def measure(fn, inputs: list) -> dict:
+    """Call fn once per input (a tuple of positional arguments) and summarize the latencies."""
+    latencies = []
+    for args in inputs:
+        start = time.perf_counter()
+        fn(*args)
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies)
+
+
+def _search_terms(rng: random.Random) -> str:
+    words = f"{rng.choice(ADJECTIVES)} {rng.choice(INGREDIENTS)}".split()
+    # Mix whole words and prefixes, like users typing part of a product name
+    choice = rng.random()
+    if choice < 0.4:
+        return rng.choice(words)
+    if choice < 0.7:
+        return rng.choice(words)[:4]
+    return " ".join(words)
+
+
+def run_scale(products: int, users: int, calls: int, workdir: str, seed: int, chunk_size: int) -> dict:
+    """Benchmark one catalog size. Runs in a child process (see main)."""
+    # Imported here so that the database configuration belongs to this process only
+    import database
+    import setup
+    import tools
+    from catalog import _Snapshot, get_catalog
+    from recommender import get_recommender
+
+    rng = random.Random(seed)
+    csv_path = os.path.join(workdir, f"products_{products}.csv")
+    db_path = os.path.join(workdir, f"bench_{products}.sqlite")
+    result = {"products": products, "users": users, "setup": {}, "tools": {}}
+
+    # setup.py load path
+    start = time.perf_counter()
+    generate_catalog(csv_path, products, seed)
+    result["setup"]["generate_csv_s"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    setup.build_database(db_path, csv_path, chunk_size, recommendations=False)
+    elapsed = time.perf_counter() - start
+    result["setup"]["build_database_s"] = elapsed
+    result["setup"]["rows_per_second"] = products / elapsed if elapsed else 0.0
+
+    conn = sqlite3.connect(db_path)
+    start = time.perf_counter()
+    setup.build_recommendations(conn, db_path)
+    result["setup"]["build_recommendations_s"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    setup.sync_products(conn, csv_path, chunk_size)
+    result["setup"]["sync_unchanged_s"] = time.perf_counter() - start
+    conn.close()
+    result["setup"]["database_mb"] = os.path.getsize(db_path) / (1024 * 1024)
+
+    start = time.perf_counter()
+    result["setup"]["cart_rows"] = generate_carts(db_path, users, products, seed=seed)
+    result["setup"]["generate_carts_s"] = time.perf_counter() - start
+
+    database.configure(db_path)
+    start = time.perf_counter()
+    get_catalog().refresh()
+    result["setup"]["catalog_load_s"] = time.perf_counter() - start
+
+    # Tool inputs, drawn up front so that the random generator is not timed
+    categories = list(CATEGORIES)
+    names = [(_search_terms(rng),) for _ in range(calls)]
+    recommendations = [
+        (rng.choice(categories).lower(), f"{rng.choice(SKIN_TYPES)} skin {rng.choice(BENEFITS).split()[0]}")
+        for _ in range(calls)
+    ]
+    browses = [(rng.choice(categories).lower(), float(rng.randint(10, 90))) for _ in range(calls)]
+    carts = [({"configurable": {"thread_id": user_id(rng.randrange(users))}},) for _ in range(calls)]
+    writes = [
+        ({"configurable": {"thread_id": user_id(rng.randrange(users))}}, rng.randint(1, products))
+        for _ in range(calls)
+    ]
+    no_args = [()] * calls
+    browse_pages = [
+        ({"category": category, "min_price": None, "max_price": None, "in_stock": True, "sort": "price_asc",
+          "page_size": 5, "after": [round(rng.uniform(5, 90), 2), rng.randint(1, products)]},)
+        for category, _ in browses
+    ]
+
+    timed = {
+        "get_product_categories": (tools.get_product_categories.func, no_args),
+        "search_product_by_name": (tools.search_product_by_name.func, names),
+        "get_recommendations": (tools.get_recommendations.func, recommendations),
+        "browse_products": (
+            lambda category, max_price: tools.browse_products.func(category=category, max_price=max_price), browses
+        ),
+        "view_cart": (tools.view_cart.func, carts),
+        "add_to_cart": (lambda config, product_id: tools.add_to_cart.func(config, product_id, 1), writes),
+        "remove_from_cart": (tools.remove_from_cart.func, writes),
+        "get_delivery_time": (tools.get_delivery_time.func, no_args),
+        "get_returns_policy": (tools.get_returns_policy.func, no_args),
+        "get_shipping_policy": (tools.get_shipping_policy.func, no_args),
+        "get_payment_methods": (tools.get_payment_methods.func, no_args),
+        # The SQL paths used when the catalog is too large to be kept in memory (no result cache either)
+        "search_product_by_name[sql]": (
+            lambda name: tools._query_products_by_name(_Snapshot([], loaded=False), name), names
+        ),
+        # Ranking with the recommendation index, without the result cache
+        "get_recommendations[index]": (
+            lambda category, description: tools._rank_recommendations(
+                _Snapshot([], loaded=False), get_recommender(db_path), category, description
+            ),
+            recommendations,
+        ),
+        # Keyset pages deep into the catalog (the cursors are drawn up front), without the result cache
+        "browse_products[page]": (lambda state: tools._query_browse(state), browse_pages),
+        "get_recommendations[sql]": (
+            lambda category, description: tools._query_recommendations(
+                _Snapshot([], loaded=False), category, description
+            ),
+            recommendations,
+        ),
+    }
+    for name, (fn, inputs) in timed.items():
+        result["tools"][name] = measure(fn, inputs)
+
+    result["catalog"] = get_catalog().stats()
+    result["peak_rss_mb"] = peak_rss_mb()
+    database.close_all()
+    return result
+
+
+def compare(results: dict, baseline: dict, threshold: float, min_delta_ms: float = 0.05) -> list[str]:
+    """Print the latency change of every tool against a baseline. Returns the regressions above threshold
+       (changes smaller than min_delta_ms are timer noise on sub-microsecond tools and never count).
+    """
+    regressions = []
+    baseline_scales = {scale["products"]: scale for scale in baseline.get("scales", [])}
+    for scale in results["scales"]:
+        previous = baseline_scales.get(scale["products"])
+        if previous is None:
+            continue
+        print(f"\n{scale['products']:,} products vs baseline")
+        for name, stats in scale["tools"].items():
+            old = previous["tools"].get(name)
+            if old is None:
+                continue
+            changes = []
+            for key in ("p50_ms", "p95_ms"):
+                change = (stats[key] - old[key]) / old[key] if old[key] else 0.0
+                changes.append(f"{key} {old[key]:.3f} -> {stats[key]:.3f} ({change:+.0%})")
+                if change > threshold and stats[key] - old[key] >= min_delta_ms:
+                    regressions.append(f"{scale['products']} products, {name}: {key} {change:+.0%}")
+            print(f"  {name:<30} " + ", ".join(changes))
+    return regressions
+
+
+def print_results(results: dict):
+    for scale in results["scales"]:
+        setup_stats = scale["setup"]
+        print(
+            f"\n{scale['products']:,} products, {scale['users']:,} users "
+            f"(build {setup_stats['build_database_s']:.2f}s at {setup_stats['rows_per_second']:,.0f} rows/s, "
+            f"recommendation index {setup_stats.get('build_recommendations_s', 0.0):.2f}s, "
+            f"catalog load {setup_stats['catalog_load_s']:.2f}s, peak RSS {scale['peak_rss_mb']:.0f} MB)"
+        )
+        print(f"  {'tool':<30} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'calls/s':>10}")
+        for name, stats in scale["tools"].items():
+            print(
+                f"  {name:<30} {stats['p50_ms']:>9.3f} {stats['p95_ms']:>9.3f} {stats['p99_ms']:>9.3f} "
+                f"{stats['throughput_per_s']:>10,.0f}"
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the chatbot tools and database setup.")
+    parser.add_argument("--products", type=int, nargs="+", default=[10_000, 100_000],
+                        help="Catalog sizes to benchmark (default: 10000 100000).")
+    parser.add_argument("--users", type=int, default=10_000,
+                        help="Number of users with a shopping cart (default: 10000).")
+    parser.add_argument("--calls", type=int, default=CALLS,
+                        help=f"Timed calls per tool and catalog size (default: {CALLS}).")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the synthetic data (default: 0).")
+    parser.add_argument("--chunk-size", type=int, default=10_000, help="CSV rows per insert batch (default: 10000).")
+    parser.add_argument("--workdir", default=None,
+                        help="Directory for the generated CSV and database files (default: a temporary directory).")
+    parser.add_argument("--output", default=None, help="Write the results to this JSON file (e.g. a baseline).")
+    parser.add_argument("--compare", default=None, help="Baseline JSON file to compare the results against.")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Relative p50/p95 increase counted as a regression by --compare (default: 0.25).")
+    parser.add_argument("--min-delta-ms", type=float, default=0.05,
+                        help="Smallest absolute p50/p95 increase counted as a regression (default: 0.05 ms).")
+    args = parser.parse_args(argv)
+
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "calls": args.calls,
+        "seed": args.seed,
+        "scales": [],
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.workdir or tmp
+        os.makedirs(workdir, exist_ok=True)
+        context = multiprocessing.get_context("spawn")
+        for products in args.products:
+            print(f"Benchmarking {products:,} products...", flush=True)
+            with context.Pool(1) as pool:
+                scale = pool.apply(
+                    run_scale, (products, args.users, args.calls, workdir, args.seed, args.chunk_size)
+                )
+            results["scales"].append(scale)
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.min_delta_ms)
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
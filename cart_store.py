@@ -0,0 +1,432 @@
+import argparse
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+from typing import Optional
+
+from database import (
+    ConnectionPool, DEFAULT_DB_PATH, get_connection, get_pool, is_bound, read_transaction, write_transaction
+)
+
+'''
+    This is a module that stores the shopping carts for the cart tools. By default the carts live in the
+    "shopping_carts" table of the products database, so every cart change of every session takes the write lock
+    of that one file. With shards, the carts are spread over N SQLite files ("skincare.carts/shard-0.sqlite",
+    ...) by a hash of the user_id. Each shard has its own connection pool and its own write lock, so cart writes
+    of different users mostly run in parallel. The products stay in the shared database, which the cart tools
+    only read.
+
+    Users are assigned to shards with jump consistent hashing: growing from N to N+1 shards only moves the carts
+    of about 1/(N+1) of the users. Run "python cart_store.py --shards N" to create or rebalance the shards
+    (moving any carts of the single table into them), and "--shards 0" to move the carts back into the single
+    table. Stop the chatbots while rebalancing: a chatbot only creates the shards when there are none, and
+    refuses to start with a shard count (or 0) that does not match the existing shards, or with carts left in
+    the single table while the shards are in use.
+'''
+
+# Manifest of a shard directory (the shard count every process must route with)
+MANIFEST = "shards.json"
+
+# The "shopping_carts" table of a shard (the products are in another file, so there is no foreign key)
+SHARD_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS shopping_carts (
+        user_id INTEGER,
+        product_id INTEGER,
+        product_name TEXT NOT NULL,
+        price REAL,
+        quantity INTEGER,
+        PRIMARY KEY (user_id, product_id)
+    ) WITHOUT ROWID
+"""
+
+# Add to the cart if the stock covers the whole cart quantity (parameters: the row, then the stock check)
+UPSERT_SQL = """
+    INSERT INTO shopping_carts (user_id, product_id, product_name, price, quantity)
+    SELECT ?, ?, ?, ?, ?
+    WHERE ? >= ? + COALESCE((SELECT quantity FROM shopping_carts WHERE user_id = ? AND product_id = ?), 0)
+    ON CONFLICT (user_id, product_id) DO UPDATE SET quantity = quantity + excluded.quantity
+"""
+
+# Rows moved per transaction while rebalancing
+MOVE_BATCH_SIZE = 1000
+
+
+def shards_path(db_path: str) -> str:
+    """Directory of the cart shards of a products database file."""
+    return os.path.splitext(db_path)[0] + ".carts"
+
+
+def shard_file(directory: str, shard: int) -> str:
+    return os.path.join(directory, f"shard-{shard}.sqlite")
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Jump consistent hash (Lamping and Veach) of a 64-bit key into [0, buckets)."""
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def shard_of(user_id, count: int) -> int:
+    """Shard of a user's cart among count shards."""
+    key = int.from_bytes(hashlib.blake2b(str(user_id).encode("utf-8"), digest_size=8).digest(), "little")
+    return jump_hash(key, count)
+
+
+def read_manifest(directory: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(directory, MANIFEST), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(directory: str, count: int):
+    path = os.path.join(directory, MANIFEST)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"shards": count}, f)
+    os.replace(path + ".tmp", path)
+
+
+def remove_shards(directory: str):
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def _product(product_id: int) -> Optional[tuple]:
+    """(name, price, stock) of a product, read from the shared products database."""
+    return get_connection().execute(
+        "SELECT product_name, price, stock FROM products WHERE product_id = ?", (product_id,)
+    ).fetchone()
+
+
+class CartStore:
+    """Carts in the "shopping_carts" table of the products database (the default)."""
+
+    shards = 1
+
+    def add(self, user_id, product_id: int, quantity: int) -> str:
+        """Add to a cart. Returns "added", "not_found" or "insufficient_stock"."""
+        conn = get_connection()
+        cursor = conn.cursor()
+        try:
+            with write_transaction(conn):
+                # Insert the product (name, price) into the cart, or increase the quantity if it is already there.
+                # The row is only written if the product exists and has enough stock for the whole cart quantity.
+                cursor.execute("""
+                    INSERT INTO shopping_carts (user_id, product_id, product_name, price, quantity)
+                    SELECT ?, p.product_id, p.product_name, p.price, ?
+                    FROM products p
+                    WHERE p.product_id = ?
+                      AND p.stock >= ? + COALESCE(
+                          (SELECT quantity FROM shopping_carts WHERE user_id = ? AND product_id = p.product_id), 0)
+                    ON CONFLICT (user_id, product_id) DO UPDATE SET quantity = quantity + excluded.quantity
+                """, (user_id, quantity, product_id, quantity, user_id))
+
+                if cursor.rowcount == 0:
+                    # Nothing was written: find out whether the product is missing or out of stock
+                    cursor.execute("SELECT 1 FROM products WHERE product_id = ?", (product_id,))
+                    return "insufficient_stock" if cursor.fetchone() else "not_found"
+            return "added"
+        finally:
+            cursor.close()
+
+    def _remove(self, conn, user_id, product_id: int) -> bool:
+        # RETURNING tells us whether the product was in the cart in the same statement
+        with write_transaction(conn):
+            row = conn.execute(
+                "DELETE FROM shopping_carts WHERE user_id = ? AND product_id = ? RETURNING product_id",
+                (user_id, product_id),
+            ).fetchone()
+        return row is not None
+
+    def remove(self, user_id, product_id: int) -> bool:
+        """Remove a product from a cart. Returns whether it was there."""
+        return self._remove(get_connection(), user_id, product_id)
+
+    def _summary(self, conn, user_id) -> Optional[tuple]:
+        try:
+            return conn.execute(
+                "SELECT products, items, total FROM cart_summaries WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        except sqlite3.OperationalError as e:
+            if "no such table" not in str(e):
+                raise
+            # Database not migrated yet (python setup.py --migrate): add the rows up
+            row = conn.execute(
+                "SELECT COUNT(*), SUM(quantity), SUM(price * quantity) FROM shopping_carts WHERE user_id = ?",
+                (user_id,),
+            ).fetchone()
+            return row if row[0] else None
+
+    def summary(self, user_id) -> Optional[tuple]:
+        """(products, items, total price) of a cart, kept up to date by triggers (None for an empty cart)."""
+        return self._summary(get_connection(), user_id)
+
+    def _view(self, conn, user_id, after: Optional[int], limit: int) -> list[tuple]:
+        return conn.execute(
+            "SELECT product_id, product_name, price, quantity FROM shopping_carts "
+            "WHERE user_id = ? AND product_id > ? ORDER BY product_id LIMIT ?",
+            (user_id, after if after is not None else -1, limit),
+        ).fetchall()
+
+    def view(self, user_id, after: Optional[int] = None, limit: int = -1) -> list[tuple]:
+        """(product_id, product_name, price, quantity) rows of a cart in product id order, after the product id
+           after (keyset pagination along the primary key), at most limit of them (-1: all).
+        """
+        return self._view(get_connection(), user_id, after, limit)
+
+    def _page(self, conn, user_id, after: Optional[int], limit: int) -> tuple[Optional[tuple], list[tuple]]:
+        with read_transaction(conn):
+            summary = self._summary(conn, user_id)
+            return summary, (self._view(conn, user_id, after, limit) if summary else [])
+
+    def page(self, user_id, after: Optional[int] = None, limit: int = -1) -> tuple[Optional[tuple], list[tuple]]:
+        """summary() and view() of a cart read in one transaction, so the totals are those of the rows
+           (a cart change in between is seen by neither or both). The rows are [] for an empty cart.
+        """
+        return self._page(get_connection(), user_id, after, limit)
+
+    def close(self):
+        pass
+
+
+class ShardedCartStore(CartStore):
+    """Carts spread over the shard files of a directory created by rebalance()."""
+
+    def __init__(self, directory: str):
+        manifest = read_manifest(directory)
+        if manifest is None:
+            raise FileNotFoundError(f"No cart shards in {directory} (run: python cart_store.py --shards N)")
+        self.directory = directory
+        self.shards = manifest["shards"]
+        self.pools = [ConnectionPool(shard_file(directory, shard)) for shard in range(self.shards)]
+        # Shards created by older versions have no summary table yet
+        for shard in range(self.shards):
+            _create_shard(shard_file(directory, shard))
+
+    def connection(self, user_id):
+        return self.pools[shard_of(user_id, self.shards)].get_connection()
+
+    def add(self, user_id, product_id: int, quantity: int) -> str:
+        # The product is read from the shared database first (carts never change it), then only the
+        # user's shard is written
+        product = _product(product_id)
+        if product is None:
+            return "not_found"
+        name, price, stock = product
+        conn = self.connection(user_id)
+        with write_transaction(conn):
+            cursor = conn.execute(
+                UPSERT_SQL, (user_id, product_id, name, price, quantity, stock, quantity, user_id, product_id)
+            )
+            written = cursor.rowcount
+        return "added" if written else "insufficient_stock"
+
+    def remove(self, user_id, product_id: int) -> bool:
+        return self._remove(self.connection(user_id), user_id, product_id)
+
+    def summary(self, user_id) -> Optional[tuple]:
+        return self._summary(self.connection(user_id), user_id)
+
+    def view(self, user_id, after: Optional[int] = None, limit: int = -1) -> list[tuple]:
+        return self._view(self.connection(user_id), user_id, after, limit)
+
+    def page(self, user_id, after: Optional[int] = None, limit: int = -1) -> tuple[Optional[tuple], list[tuple]]:
+        return self._page(self.connection(user_id), user_id, after, limit)
+
+    def close(self):
+        for pool in self.pools:
+            pool.close()
+
+
+def _create_shard(path: str):
+    # Imported here: setup.py imports this module
+    from setup import create_cart_summaries
+
+    pool = ConnectionPool(path)
+    try:
+        conn = pool.get_connection()
+        conn.execute(SHARD_TABLE_SQL)
+        conn.commit()
+        create_cart_summaries(conn)
+    finally:
+        pool.close()
+
+
+def _move(source, rows: list[tuple], target_of, add: bool) -> int:
+    """Copy rows into the connections target_of(user_id) returns, then delete them from the source connection.
+       add=False overwrites the quantities (moving between shards, where the copy is the same row: a rebalance
+       interrupted between the two steps can simply be run again). add=True adds them up (moving out of the
+       single table, whose rows may have been written while the shards were not in use).
+    """
+    by_target = {}
+    for row in rows:
+        by_target.setdefault(target_of(row[0]), []).append(row)
+    quantity = "quantity + excluded.quantity" if add else "excluded.quantity"
+    for target, target_rows in by_target.items():
+        with write_transaction(target):
+            target.executemany(
+                "INSERT INTO shopping_carts (user_id, product_id, product_name, price, quantity) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT (user_id, product_id) DO UPDATE SET "
+                f"product_name = excluded.product_name, price = excluded.price, quantity = {quantity}",
+                target_rows,
+            )
+    with write_transaction(source):
+        source.executemany(
+            "DELETE FROM shopping_carts WHERE user_id = ? AND product_id = ?", [row[:2] for row in rows]
+        )
+    return len(rows)
+
+
+def _has_table(conn) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'shopping_carts'"
+    ).fetchone() is not None
+
+
+def rebalance(db_path: str, count: int, directory: Optional[str] = None) -> dict:
+    """Create or resize the cart shards of a products database to count shards, moving every cart to the shard
+       of its user (and the carts of the single "shopping_carts" table into the shards). count=0 moves every
+       cart back into the single table and removes the shards. Returns the rows moved out of every source
+       ("single" and the shard numbers).
+    """
+    if count < 0:
+        raise ValueError("The shard count cannot be negative.")
+    directory = directory or shards_path(db_path)
+    previous = (read_manifest(directory) or {}).get("shards", 0)
+    if count == 0 and previous == 0:
+        return {}
+    os.makedirs(directory, exist_ok=True)
+    for shard in range(max(count, previous)):
+        _create_shard(shard_file(directory, shard))
+
+    pools = [ConnectionPool(shard_file(directory, shard)) for shard in range(max(count, previous))]
+    single = ConnectionPool(db_path)
+    moved = {}
+    try:
+        if count:
+            targets = [pool.get_connection() for pool in pools[:count]]
+            target_of = lambda user: targets[shard_of(user, count)]
+        else:
+            target = single.get_connection()
+            target_of = lambda user: target
+        sources = [(shard, pool.get_connection()) for shard, pool in enumerate(pools)]
+        if count:
+            sources.insert(0, ("single", single.get_connection()))
+        for name, source in sources:
+            if name == "single" and not _has_table(source):
+                continue
+            users = [row[0] for row in source.execute("SELECT DISTINCT user_id FROM shopping_carts")]
+            leaving = [user for user in users if name == "single" or not count or shard_of(user, count) != name]
+            moved[name] = 0
+            for start in range(0, len(leaving), MOVE_BATCH_SIZE):
+                batch = leaving[start:start + MOVE_BATCH_SIZE]
+                rows = source.execute(
+                    "SELECT user_id, product_id, product_name, price, quantity FROM shopping_carts "
+                    f"WHERE user_id IN ({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                moved[name] += _move(source, rows, target_of, add=name == "single")
+        if count:
+            _write_manifest(directory, count)
+    finally:
+        single.close()
+        for pool in pools:
+            pool.close()
+
+    if not count:
+        remove_shards(directory)
+        return moved
+    # Shards beyond the new count are empty now
+    for shard in range(count, previous):
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(shard_file(directory, shard) + suffix):
+                os.remove(shard_file(directory, shard) + suffix)
+    return moved
+
+
+def _single_table_carts(db_path: str) -> int:
+    """Rows of the single "shopping_carts" table of a products database."""
+    pool = ConnectionPool(db_path)
+    try:
+        conn = pool.get_connection()
+        return conn.execute("SELECT COUNT(*) FROM shopping_carts").fetchone()[0] if _has_table(conn) else 0
+    finally:
+        pool.close()
+
+
+# Store used by the cart tools (the single table unless configure() selected shards)
+_store = CartStore()
+_store_lock = threading.Lock()
+
+
+def configure(shards: int = 0, db_path: Optional[str] = None) -> CartStore:
+    """Select the cart store of the tools: the single table (shards=0) or shards next to the products database
+       (created if there are none yet). Raises ValueError if the shards on disk do not match: rebalancing is
+       left to "python cart_store.py --shards N", run while no chatbot uses the carts.
+    """
+    global _store
+    with _store_lock:
+        old_store = _store
+        db_path = db_path or get_pool().path
+        directory = shards_path(db_path)
+        existing = (read_manifest(directory) or {}).get("shards", 0)
+        if existing != shards and (existing or not shards):
+            raise ValueError(
+                f"The carts of {db_path} are in {existing or 'no'} shards, not {shards or 'the single table'} "
+                f"(move them with: python cart_store.py --shards {shards})"
+            )
+        if shards:
+            if not existing:
+                rebalance(db_path, shards, directory)
+            elif _single_table_carts(db_path):
+                raise ValueError(
+                    f"The single carts table of {db_path} has rows written while the shards were not in use "
+                    f"(move them into the shards with: python cart_store.py --shards {shards})"
+                )
+            _store = ShardedCartStore(directory)
+        else:
+            _store = CartStore()
+    old_store.close()
+    return _store
+
+
+# Runs bound to their own database (database.use_database()) keep their carts in its table
+_bound_store = CartStore()
+
+
+def get_store() -> CartStore:
+    return _bound_store if is_bound() else _store
+
+
+def close_all():
+    _store.close()
+
+
+atexit.register(close_all)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Create or rebalance the cart shards of the products database.")
+    parser.add_argument("--shards", type=int, required=True,
+                        help="Number of cart shard databases (0: move the carts back into the single table).")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help=f"Products database (default: {DEFAULT_DB_PATH}).")
+    args = parser.parse_args(argv)
+
+    previous = (read_manifest(shards_path(args.db)) or {}).get("shards", 0)
+    moved = rebalance(args.db, args.shards)
+    print(f"Cart shards: {previous} -> {args.shards} ({shards_path(args.db) if args.shards else 'single table'})")
+    for source, rows in moved.items():
+        if rows:
+            print(f"  moved {rows} cart rows out of {'the single table' if source == 'single' else f'shard {source}'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import atexit
+import bisect
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import database
+
+'''
+    This is a module that keeps an in-memory copy of the (read-mostly) products table for the read tools.
+    Products are indexed by id, category and name tokens, and tool results are kept in a bounded LRU cache.
+
+    Everything is invalidated when the products change: every call checks "PRAGMA data_version" (which changes
+    whenever another connection or process commits to the database) and, only if it moved, the catalog version
+    row that the triggers created by setup.py bump on every insert, update or delete of a product. Cart writes
+    therefore do not throw the catalog away, but a stock or price change is never served stale.
+'''
+
+# Maximum number of cached tool results
+RESULT_CACHE_SIZE = int(os.environ.get("SKINCARE_RESULT_CACHE_SIZE", 1024))
+
+# Catalogs larger than this are not copied into memory (only the tool results are cached)
+MAX_PRODUCTS = int(os.environ.get("SKINCARE_CATALOG_MAX_PRODUCTS", 200_000))
+
+# Columns of a product row, in the order used by the tools
+PRODUCT_COLUMNS = ("product_id", "product_name", "description", "category", "stock", "price")
+
+
+def normalize(text: str) -> list[str]:
+    """Split text into lower case word tokens."""
+    return re.findall(r"\w+", text.lower())
+
+
+class _Snapshot:
+    """Immutable view of the products table at one catalog version."""
+
+    def __init__(self, rows: list[tuple], loaded: bool = True):
+        self.loaded = loaded
+        self.by_id = {row[0]: row for row in rows}
+
+        self.by_category = {}
+        category_names = {}
+        tokens = {}
+        for row in rows:
+            key = (row[3] or "").casefold()
+            self.by_category.setdefault(key, []).append(row)
+            category_names.setdefault(key, row[3])
+            for token in set(normalize(row[1] or "")):
+                tokens.setdefault(token, []).append(row[0])
+
+        self.categories = sorted(name for name in category_names.values() if name is not None)
+        self.tokens = tokens
+        # Sorted vocabulary so that prefix lookups are a binary search
+        self.vocabulary = sorted(tokens)
+
+    def search_names(self, text: str, limit: int = 3) -> list[tuple]:
+        """Return products whose name has a word starting with every word of text.
+           Exact word matches rank first, then shorter names, then lower ids. Without any such product, return
+           the products whose name contains text (as the LIKE query of the tools, e.g. "oist" in "Moisturizer").
+        """
+        terms = normalize(text)
+        if not terms:
+            return self.search_substring(text, limit)
+
+        candidates = None
+        exact = {}
+        for term in terms:
+            ids = set()
+            index = bisect.bisect_left(self.vocabulary, term)
+            while index < len(self.vocabulary) and self.vocabulary[index].startswith(term):
+                ids.update(self.tokens[self.vocabulary[index]])
+                index += 1
+            for product_id in self.tokens.get(term, ()):
+                exact[product_id] = exact.get(product_id, 0) + 1
+            candidates = ids if candidates is None else candidates & ids
+            if not candidates:
+                return self.search_substring(text, limit)
+
+        rows = [self.by_id[product_id] for product_id in candidates]
+        rows.sort(key=lambda row: (-exact.get(row[0], 0), len(row[1]), row[0]))
+        return rows[:limit]
+
+    def search_substring(self, text: str, limit: int = 3) -> list[tuple]:
+        """Return the first products (by id) whose name contains text, ignoring case."""
+        text = text.casefold()
+        return [row for row in self.by_id.values() if text in (row[1] or "").casefold()][:limit]
+
+
+class Catalog:
+    """In-memory product catalog and tool result cache for one database file."""
+
+    def __init__(self, path: str, cache_size: int = RESULT_CACHE_SIZE, max_products: int = MAX_PRODUCTS):
+        self.path = path
+        self.cache_size = cache_size
+        self.max_products = max_products
+
+        # Dedicated connection: PRAGMA data_version only reports commits made by *other* connections,
+        # so this one must never be used for writes.
+        self._conn = database.connect(path)
+        self._lock = threading.Lock()
+        self._data_version = None
+        self._catalog_version = None
+        self._snapshot = None
+        self._results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _read_catalog_version(self):
+        try:
+            return self._conn.execute("SELECT version FROM catalog_version").fetchone()[0]
+        except (sqlite3.OperationalError, TypeError):
+            # Older database without the version row: every change to the file counts
+            return None
+
+    def _load(self) -> _Snapshot:
+        count = self._conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+        if count > self.max_products:
+            return _Snapshot([], loaded=False)
+        rows = self._conn.execute(f"SELECT {', '.join(PRODUCT_COLUMNS)} FROM products ORDER BY product_id").fetchall()
+        return _Snapshot(rows)
+
+    def refresh(self) -> _Snapshot:
+        """Return the current snapshot, reloading it (and clearing cached results) if the products changed."""
+        with self._lock:
+            data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if self._snapshot is not None and data_version == self._data_version:
+                return self._snapshot
+            self._data_version = data_version
+
+            catalog_version = self._read_catalog_version()
+            if self._snapshot is not None and catalog_version is not None and catalog_version == self._catalog_version:
+                # Only other tables (e.g. shopping carts) changed
+                return self._snapshot
+
+            # Read the version and the rows in one read transaction so they are consistent
+            self._conn.execute("BEGIN")
+            try:
+                self._catalog_version = self._read_catalog_version()
+                self._snapshot = self._load()
+            finally:
+                self._conn.rollback()
+            self._results.clear()
+            return self._snapshot
+
+    def cached(self, key, compute):
+        """Return the cached result for key, computing (and caching) it on a miss. Exceptions are not cached."""
+        snapshot = self.refresh()
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return self._results[key]
+            self.misses += 1
+
+        result = compute(snapshot)
+
+        with self._lock:
+            # Do not store a result computed from a snapshot that has since been replaced
+            if snapshot is self._snapshot:
+                self._results[key] = result
+                if len(self._results) > self.cache_size:
+                    self._results.popitem(last=False)
+        return result
+
+    def version(self):
+        """Return the catalog version of the current snapshot (it changes whenever the products change)."""
+        self.refresh()
+        return self._catalog_version
+
+    def get(self, product_id: int):
+        """Return the product row with this id (None if it does not exist or the catalog is not in memory)."""
+        return self.refresh().by_id.get(product_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._results)}
+
+    def close(self):
+        with self._lock:
+            self._results.clear()
+            self._snapshot = None
+            self._conn.close()
+
+
+# One catalog per database file
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog() -> Catalog:
+    """Return the catalog for the database of the current run (see database.get_pool())."""
+    path = database.get_pool().path
+    catalog = _catalogs.get(path)
+    if catalog is None:
+        with _catalogs_lock:
+            catalog = _catalogs.get(path)
+            if catalog is None:
+                catalog = _catalogs[path] = Catalog(path)
+    return catalog
+
+
+def close_catalog(path: str):
+    """Drop the catalog of a database file (e.g. a clone that is being removed)."""
+    with _catalogs_lock:
+        catalog = _catalogs.pop(path, None)
+    if catalog is not None:
+        catalog.close()
+
+
+def close_catalogs():
+    with _catalogs_lock:
+        for catalog in _catalogs.values():
+            catalog.close()
+        _catalogs.clear()
+
+
+atexit.register(close_catalogs)
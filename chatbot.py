@@ -1,13 +1,44 @@
+import time
+_started = time.perf_counter()
+import sys
+import warmup
+
+# Loading the model into Ollama takes seconds: when run as a script, start it before the heavy imports below.
+# Those imports stay at module level (the prompt, the tool lists and the nodes below are built from them, and
+# server.py, loadtest.py and result_format.py import them from here); the model load runs while they are imported.
+# Only langchain_ollama is deferred, to create_llm(), since stub runs and replays never need it.
+_preloaded = warmup.preload(sys.argv[1:]) if __name__ == "__main__" else None
+
 from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import END, START, StateGraph, MessagesState
-from langchain_core.messages import HumanMessage, SystemMessage, AIMessage, ToolMessage
+from langchain_core.messages import HumanMessage, SystemMessage, AIMessage, AIMessageChunk, ToolMessage
 from langgraph.prebuilt import tools_condition
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
 import uuid
-from assistant import State, Assistant
+from typing import Optional
+from assistant import State, Assistant, RetryPolicy
+from context import ContextManager
+from router import FastPathRouter
+from response_cache import ResponseCache
+from singleflight import SingleFlight
+from catalog import get_catalog
+from tool_executor import ParallelToolNode, in_call_order, pending_tool_calls
+from result_format import DEFAULT_FORMAT, FORMATS
+import cart_store
+import database
+from database import close_all
+import telemetry
+from checkpointer import DEFAULT_CHECKPOINT_DB, SQLiteCheckpointSaver
+from latency import summarize
 from tools import (
     get_product_categories,
     search_product_by_name,
     get_recommendations,
+    browse_products,
     add_to_cart,
     remove_from_cart,
     view_cart,
@@ -16,11 +47,12 @@ from tools import (
     get_shipping_policy,
     get_payment_methods,
 )
-from langchain_ollama import ChatOllama
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.messages import ToolMessage
 from langchain_core.runnables import RunnableLambda
-from langgraph.prebuilt import ToolNode
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+_imported = time.perf_counter()
 
 # Helper function to print the assistant's response
 def _print_event(event: dict, _printed: set, max_length=1500):
@@ -38,12 +70,80 @@ def _print_event(event: dict, _printed: set, max_length=1500):
             print(content)
             print("\n")  # Add divider after the response
             _printed.add(message.id)
-            
+
+
+# Helper function to print the assistant's response token by token (graph.stream with stream_mode="messages").
+# Returns the time to first token and the generation speed of the turn.
+def _print_stream(events, _printed: set, max_length=1500) -> dict:
+    start = time.perf_counter()
+    first_token = last_token = None
+    chunks = 0
+    output_tokens = 0
+    lengths = {}  # message id -> number of characters received
+    current = None
+
+    for message, metadata in events:
+        if message.id in _printed or not isinstance(message, AIMessage):
+            continue
+
+        if isinstance(message, AIMessageChunk):
+            if message.usage_metadata:
+                output_tokens += message.usage_metadata.get("output_tokens", 0)
+            content = message.content
+            if not isinstance(content, str):
+                content = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+        elif message.id not in lengths:
+            # Complete message that was not generated token by token (e.g. a fast path answer)
+            content = message.content if isinstance(message.content, str) else ""
+        else:
+            continue
+        if not content:
+            continue
+
+        now = time.perf_counter()
+        first_token = first_token or now
+        last_token = now
+        if isinstance(message, AIMessageChunk):
+            chunks += 1
+
+        printed = lengths.get(message.id, 0)
+        if printed < max_length:
+            if current is not None and current != message.id:
+                print("\n")
+            current = message.id
+            piece = content[:max_length - printed]
+            print(piece, end="", flush=True)
+            if len(piece) < len(content):
+                print(" ... (truncated)", end="", flush=True)
+        lengths[message.id] = printed + len(content)
+
+    if current is not None:
+        print("\n")  # Add divider after the response
+    _printed.update(lengths)
+
+    stats = {
+        "ttft": first_token - start if first_token is not None else None,
+        "tokens": output_tokens or chunks,
+        "tokens_per_second": None,
+    }
+    if chunks > 1 and last_token > first_token:
+        stats["tokens_per_second"] = stats["tokens"] / (last_token - first_token)
+    return stats
+
+
+def _print_stream_stats(stats: dict):
+    if stats["ttft"] is None:
+        return
+    line = f"[Stream] time to first token {stats['ttft']:.2f}s"
+    if stats["tokens_per_second"] is not None:
+        line += f", {stats['tokens']} tokens at {stats['tokens_per_second']:.1f} tokens/s"
+    print(line)
+
 
 # Handler for tool error messages.
 def handle_tool_error(state) -> dict:
     error = state.get("error")
-    tool_calls = state["messages"][-1].tool_calls
+    tool_calls = pending_tool_calls(state["messages"])
     return {
         "messages": [
             ToolMessage(
@@ -54,92 +154,653 @@ def handle_tool_error(state) -> dict:
         ]
     }
 
-# Create a tool node with a fallback to handle errors
-def create_tool_node_with_fallback(tools: list) -> dict:
-    return ToolNode(tools).with_fallbacks(
+# Answer every pending sensitive tool call with the user's reason for denying it (in the order of the calls,
+# also when the safe calls of the same batch were answered before)
+def denial_messages(messages: list, reason: str) -> list:
+    return in_call_order(messages, {
+        tool_call["id"]: ToolMessage(
+            tool_call_id=tool_call["id"],
+            name=tool_call["name"],
+            content=f"API call denied by user. Reasoning: '{reason}'. Continue assisting, accounting for the user's input.",
+        )
+        for tool_call in pending_tool_calls(messages, SENSITIVE_TOOL_NAMES)
+    })
+
+# Create a tool node (running its calls concurrently) with a fallback to handle errors
+def create_tool_node_with_fallback(
+    tools: list,
+    timeout: Optional[float] = 10.0,
+    max_workers: int = 8,
+    result_format: str = DEFAULT_FORMAT,
+    all_tool_names: Optional[set] = None,
+) -> dict:
+    node = ParallelToolNode(
+        tools, timeout=timeout, max_workers=max_workers, result_format=result_format, all_tool_names=all_tool_names
+    )
+    return RunnableLambda(node).with_fallbacks(
         [RunnableLambda(handle_tool_error)], exception_key="error"
     )
 
 
-# Main function to run the chatbot
-def main():
-    # Generate a unique thread ID for the conversation session (same as user_id)
-    thread_id = str(uuid.uuid4())
-    config = {
-        "configurable": {
-            "thread_id": thread_id,
-            "user_id": thread_id,
-        }
-    }
+# LLM retry and fallback options, shared with server.py (see create_retry_policy)
+def add_retry_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--llm-attempts",
+        type=int,
+        default=3,
+        help="LLM calls per turn when the model keeps returning empty responses, the first one included "
+             "(default: 3).",
+    )
+    parser.add_argument(
+        "--llm-timeout",
+        type=float,
+        default=120.0,
+        help="Seconds one LLM call may take before the turn falls back (default: 120, 0 = no limit).",
+    )
+    parser.add_argument(
+        "--llm-deadline",
+        type=float,
+        default=180.0,
+        help="Seconds the LLM attempts and the fallback model of a turn may take together (default: 180, "
+             "0 = no limit).",
+    )
+    parser.add_argument(
+        "--llm-backoff",
+        type=float,
+        default=0.5,
+        help="Seconds to wait before retrying an empty response, doubled for every further retry (default: 0.5).",
+    )
+    parser.add_argument(
+        "--fallback-model",
+        default=None,
+        help="Smaller Ollama model answering once the retries are exhausted, e.g. llama3.2:1b (default: a canned "
+             "apology).",
+    )
 
-    # Initialize the LLM model
-    llm = ChatOllama(
-        model="llama3.2:3b",
+
+# Command line options of the chatbot
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Skincare Assistant Chatbot")
+    parser.add_argument(
+        "--checkpointer",
+        choices=["memory", "sqlite"],
+        default=os.environ.get("SKINCARE_CHECKPOINTER", "memory"),
+        help="Where conversation checkpoints are kept: in process memory, or in a bounded SQLite store "
+             "that survives restarts (default: memory).",
+    )
+    parser.add_argument(
+        "--checkpoint-db",
+        default=DEFAULT_CHECKPOINT_DB,
+        help=f"Path of the SQLite checkpoint store (default: {DEFAULT_CHECKPOINT_DB}).",
+    )
+    parser.add_argument(
+        "--max-checkpoints",
+        type=int,
+        default=20,
+        help="Number of checkpoints kept per conversation by the SQLite store (default: 20).",
+    )
+    parser.add_argument(
+        "--checkpoint-ttl",
+        type=float,
+        default=7 * 24 * 3600,
+        help="Seconds after which idle conversations are evicted from the SQLite store (default: 7 days).",
+    )
+    parser.add_argument(
+        "--checkpoint-max-mb",
+        type=float,
+        default=256,
+        help="Size cap of the SQLite store in MB (default: 256).",
+    )
+    parser.add_argument(
+        "--context-tokens",
+        type=int,
+        default=int(os.environ.get("SKINCARE_CONTEXT_TOKENS", 3000)),
+        help="Token budget for the conversation history sent to the LLM; older turns are summarized "
+             "(default: 3000, 0 sends the full history).",
+    )
+    parser.add_argument(
+        "--llm-summary",
+        action="store_true",
+        help="Write the rolling summary of older turns with the LLM instead of an extractive summary.",
+    )
+    parser.add_argument(
+        "--no-fast-path",
+        action="store_true",
+        help="Send every question to the LLM instead of answering static questions (policies, payment methods, "
+             "delivery time, categories) directly.",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Print the answer token by token as it is generated, with the time to first token and tokens/s "
+             "of each turn.",
+    )
+    parser.add_argument(
+        "--tool-timeout",
+        type=float,
+        default=10.0,
+        help="Seconds a read tool call may take before it is answered with a timeout error; cart changes are "
+             "always waited for (default: 10).",
+    )
+    parser.add_argument(
+        "--tool-workers",
+        type=int,
+        default=8,
+        help="Number of tool calls of one AI message that run concurrently (default: 8).",
+    )
+    parser.add_argument(
+        "--tool-result-format",
+        choices=FORMATS,
+        default=os.environ.get("SKINCARE_TOOL_RESULT_FORMAT", DEFAULT_FORMAT),
+        help="How tool results are written into the conversation: 'table' writes lists of products once as "
+             "columns and rows, 'json' repeats every key (default: table).",
+    )
+    add_retry_arguments(parser)
+    parser.add_argument(
+        "--cart-shards",
+        type=int,
+        default=int(os.environ.get("SKINCARE_CART_SHARDS", 0)),
+        help="Spread the shopping carts over this many SQLite files by user, each with its own write lock "
+             "(default: 0 = the carts table of the products database). See cart_store.py.",
+    )
+    parser.add_argument(
+        "--response-cache",
+        action="store_true",
+        help="Answer near-identical questions from a cache of earlier LLM responses (never for cart or stock "
+             "dependent answers).",
+    )
+    parser.add_argument(
+        "--response-cache-db",
+        default="response_cache.sqlite",
+        help="SQLite file the response cache is kept in across restarts (default: response_cache.sqlite).",
+    )
+    parser.add_argument(
+        "--response-cache-ttl",
+        type=float,
+        default=3600.0,
+        help="Seconds a cached response stays valid (default: 3600).",
+    )
+    parser.add_argument(
+        "--response-cache-threshold",
+        type=float,
+        default=0.85,
+        help="Minimum similarity of a differently worded question to reuse its answer (default: 0.85, "
+             "1.0 = exact matches only).",
+    )
+    parser.add_argument(
+        "--trace",
+        default=None,
+        metavar="FILE",
+        help="Append a span for every graph node, LLM call, tool call and SQL statement to this JSONL file.",
+    )
+    parser.add_argument(
+        "--metrics",
+        default=None,
+        metavar="FILE",
+        help="Write Prometheus/OpenMetrics latency, token and retry metrics to this file on exit.",
+    )
+    parser.add_argument(
+        "--thread-id",
+        default=None,
+        help="Resume the conversation with this thread ID (default: start a new one).",
+    )
+    parser.add_argument(
+        "--replay",
+        default=None,
+        metavar="FILE",
+        help="Replay the recorded conversations of this JSONL file without prompting (see replay()) instead "
+             "of starting an interactive session.",
+    )
+    parser.add_argument(
+        "--replay-output",
+        default="replay_results.jsonl",
+        metavar="FILE",
+        help="JSONL file the replay results are written to as they arrive (default: replay_results.jsonl).",
+    )
+    parser.add_argument(
+        "--replay-workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Worker processes of the replay, each with its own graph and database copy (default: all cores).",
+    )
+    parser.add_argument(
+        "--replay-db",
+        default=database.DEFAULT_DB_PATH,
+        help=f"Products database copied into every replay worker (default: {database.DEFAULT_DB_PATH}).",
+    )
+    parser.add_argument(
+        "--replay-isolated",
+        action="store_true",
+        help="Replay every conversation on its own fresh in-memory copy of --replay-db (its carts and stock "
+             "changes are not seen by the other conversations).",
+    )
+    parser.add_argument(
+        "--stub",
+        action="store_true",
+        help="Use the deterministic stub model of stub_llm.py instead of Ollama (e.g. for replays).",
+    )
+    warmup.add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+# Create the retry policy and the fallback model selected on the command line
+def create_retry_policy(args):
+    policy = RetryPolicy(
+        max_attempts=args.llm_attempts,
+        call_timeout=args.llm_timeout or None,
+        deadline=args.llm_deadline or None,
+        backoff=args.llm_backoff,
+    )
+    fallback_llm = None
+    if args.fallback_model:
+        from langchain_ollama import ChatOllama
+        fallback_llm = ChatOllama(
+            model=args.fallback_model, base_url=warmup.ollama_url(args.ollama_url), keep_alive=args.keep_alive,
+            temperature=0,
+        )
+    return policy, fallback_llm
+
+
+# Create the chat model selected on the command line (langchain_ollama is only imported when it is used)
+def create_llm(args):
+    if args.stub:
+        from stub_llm import StubChatModel
+        return StubChatModel()
+    from langchain_ollama import ChatOllama
+    return ChatOllama(
+        model=args.model,
+        base_url=warmup.ollama_url(args.ollama_url),
+        keep_alive=args.keep_alive,
         temperature=1,
     )
 
-    assistant_prompt = ChatPromptTemplate.from_messages([
-        (
-            "system",
-            "You are a helpful customer support assistant for the Skincare Products company."
-            "Reply in a friendly way whenever the user says Hello or Hi and Greet them in your first response."
-            "Provide a good detailed response to the questions you are asked."
-            "Do not provide answers about products that are outside the tools available to you such as the database."
-            "If a tool returns an empty response, kindly ask the user to rephrase their question or provide more details."
-        ),
-        ("placeholder", "{messages}")
-    ])
-
-    # Define the tools that the assistant can use safely without user confirmation
-    safe_tools = [
-        get_product_categories,
-        search_product_by_name,
-        get_recommendations,
-        view_cart,
-        get_delivery_time,
-        get_returns_policy,
-        get_shipping_policy,
-        get_payment_methods,
+
+# Create the checkpointer selected on the command line
+def create_checkpointer(args):
+    if args.checkpointer == "sqlite":
+        return SQLiteCheckpointSaver(
+            args.checkpoint_db,
+            max_checkpoints=args.max_checkpoints,
+            ttl_seconds=args.checkpoint_ttl,
+            max_bytes=int(args.checkpoint_max_mb * 1024 * 1024),
+        )
+    return MemorySaver()
+
+
+# The system prompt of the assistant
+ASSISTANT_PROMPT = ChatPromptTemplate.from_messages([
+    (
+        "system",
+        "You are a helpful customer support assistant for the Skincare Products company."
+        "Reply in a friendly way whenever the user says Hello or Hi and Greet them in your first response."
+        "Provide a good detailed response to the questions you are asked."
+        "Do not provide answers about products that are outside the tools available to you such as the database."
+        "If a tool returns an empty response, kindly ask the user to rephrase their question or provide more details."
+    ),
+    ("placeholder", "{messages}")
+])
+
+# Define the tools that the assistant can use safely without user confirmation
+SAFE_TOOLS = [
+    get_product_categories,
+    search_product_by_name,
+    get_recommendations,
+    browse_products,
+    view_cart,
+    get_delivery_time,
+    get_returns_policy,
+    get_shipping_policy,
+    get_payment_methods,
+]
+
+# Define the sensitive tools that require user confirmation before execution
+SENSITIVE_TOOLS = [add_to_cart, remove_from_cart]
+
+SENSITIVE_TOOL_NAMES = {t.name for t in SENSITIVE_TOOLS}
+
+
+# The static prefix of every LLM request (system prompt and tool schemas, as ChatOllama sends them)
+def warmup_request() -> tuple[list[dict], list[dict]]:
+    messages = [
+        {"role": "system", "content": message.content} for message in ASSISTANT_PROMPT.format_messages(messages=[])
     ]
+    return messages, [convert_to_openai_tool(tool) for tool in SAFE_TOOLS + SENSITIVE_TOOLS]
 
-    # Define the sensitive tools that require user confirmation before execution
-    sensitive_tools = [add_to_cart, remove_from_cart]
 
-    sensitive_tool_names = {t.name for t in sensitive_tools}
-    assistant_runnable = assistant_prompt | llm.bind_tools(safe_tools + sensitive_tools)
+# Build and compile the chatbot graph around any LangChain chat model (ChatOllama, or a stub for load tests)
+def build_graph(
+    llm,
+    checkpointer=None,
+    router: Optional[FastPathRouter] = None,
+    context_tokens: int = 3000,
+    llm_summary: bool = False,
+    tool_timeout: float = 10.0,
+    tool_workers: int = 8,
+    llm_concurrency: Optional[int] = None,
+    response_cache: Optional[ResponseCache] = None,
+    result_format: str = DEFAULT_FORMAT,
+    retry_policy: Optional[RetryPolicy] = None,
+    fallback_llm=None,
+    single_flight: Optional[SingleFlight] = None,
+    debug: bool = False,
+):
+    """Return the compiled graph. It interrupts before "sensitive_tools" so the caller can ask for approval.
+
+    Args:
+        llm: Chat model supporting bind_tools().
+        checkpointer: LangGraph checkpointer (default: a new MemorySaver).
+        router (FastPathRouter): Answers static questions without the LLM. None sends everything to the LLM.
+        context_tokens (int): Token budget of the history sent to the LLM (0 sends the full history).
+        llm_summary (bool): Write the rolling summary of old turns with the LLM instead of extractively.
+        tool_timeout (float), tool_workers (int): Per-call timeout of the safe tools and concurrency of the tool
+            nodes (the cart changes of the sensitive tools are always waited for).
+        llm_concurrency (int): Maximum number of LLM calls in flight across all conversations (None: no limit).
+        response_cache (ResponseCache): Answers near-identical turns without calling the LLM.
+        result_format (str): Format of the tool results in the conversation ("table" or "json").
+        retry_policy (RetryPolicy): Bounds the retries of empty LLM responses (default: 3 attempts, no timeouts).
+        fallback_llm: Cheaper chat model that answers once the retries are exhausted (None: canned response).
+        single_flight (SingleFlight): Shares one LLM call between concurrent turns sending the same prompt.
+        debug (bool): Print the tool calls of every AI message.
+    """
+    assistant_runnable = ASSISTANT_PROMPT | llm.bind_tools(SAFE_TOOLS + SENSITIVE_TOOLS)
 
     # Route tools based on input State
     def route_tools(state: State):
-        """Route tools based on AI response."""
+        """Route tools based on AI response.
+           The safe calls of a batch run first; the sensitive ones then wait for the user's approval.
+        """
         next_node = tools_condition(state)
         if next_node == END:
             return END
 
         ai_message = state["messages"][-1]
         if isinstance(ai_message, AIMessage) and ai_message.tool_calls:
-            first_tool_call = ai_message.tool_calls[0]
-            print("\n[DEBUG] Tool call detected:", first_tool_call)
-            if first_tool_call["name"] in sensitive_tool_names:
+            if debug:
+                print("\n[DEBUG] Tool calls detected:", ai_message.tool_calls)
+            if all(call["name"] in SENSITIVE_TOOL_NAMES for call in ai_message.tool_calls):
                 return "sensitive_tools"
         return "safe_tools"
 
+    # After the safe tools, go through the approval step only if the batch also has sensitive calls
+    def route_after_safe_tools(state: State):
+        if pending_tool_calls(state["messages"], SENSITIVE_TOOL_NAMES):
+            return "sensitive_tools"
+        return "skincare_assistant"
+
     # Build the state graph
     builder = StateGraph(State)
-    builder.add_node("skincare_assistant", Assistant(assistant_runnable))
-    builder.add_node("safe_tools", create_tool_node_with_fallback(safe_tools))
-    builder.add_edge(START, "skincare_assistant")
-    builder.add_node("sensitive_tools", create_tool_node_with_fallback(sensitive_tools))
+    context_manager = None
+    if context_tokens > 0:
+        context_manager = ContextManager(
+            max_tokens=context_tokens,
+            summarizer=llm if llm_summary else None,
+        )
+
+    fallback_runnable = None
+    if fallback_llm is not None:
+        fallback_runnable = ASSISTANT_PROMPT | fallback_llm.bind_tools(SAFE_TOOLS + SENSITIVE_TOOLS)
+    assistant = Assistant(
+        assistant_runnable,
+        context_manager,
+        max_concurrency=llm_concurrency,
+        cache=response_cache,
+        retry_policy=retry_policy,
+        fallback=fallback_runnable,
+        single_flight=single_flight,
+    )
+    builder.add_node("skincare_assistant", assistant.as_runnable())
+    # The safe node also answers the calls to tools that do not exist (route_tools sends them there)
+    builder.add_node("safe_tools", create_tool_node_with_fallback(
+        SAFE_TOOLS, tool_timeout, tool_workers, result_format,
+        all_tool_names={t.name for t in SAFE_TOOLS + SENSITIVE_TOOLS},
+    ))
+    # Answer obvious static questions without the LLM, fall back to the assistant otherwise
+    if router is None:
+        builder.add_edge(START, "skincare_assistant")
+    else:
+        builder.add_node("fast_path", router)
+        builder.add_edge(START, "fast_path")
+        builder.add_conditional_edges(
+            "fast_path", router.route, {"answered": END, "assistant": "skincare_assistant"}
+        )
+    # Cart changes are never abandoned on a timeout: one reported as failed could still commit (and be retried)
+    builder.add_node(
+        "sensitive_tools", create_tool_node_with_fallback(SENSITIVE_TOOLS, None, tool_workers, result_format)
+    )
     builder.add_conditional_edges(
         "skincare_assistant", route_tools, ["safe_tools", "sensitive_tools", END]
     )
-    builder.add_edge("safe_tools", "skincare_assistant")
+    builder.add_conditional_edges(
+        "safe_tools", route_after_safe_tools, ["sensitive_tools", "skincare_assistant"]
+    )
     builder.add_edge("sensitive_tools", "skincare_assistant")
 
-    memory = MemorySaver()
-    graph = builder.compile(
+    return builder.compile(
+        checkpointer=checkpointer if checkpointer is not None else MemorySaver(),
+        interrupt_before=["sensitive_tools"],
+    )
+
+
+# Graph of a replay worker process (set by _replay_worker_init)
+_replay_worker = {}
+
+
+# Build the graph of a replay worker on its own copy of the products database
+def _replay_worker_init(args, workdir: str):
+    from db_template import DatabaseTemplate
+
+    # Clones of the template share the (read-only) recommendation index of --replay-db
+    template = DatabaseTemplate(args.replay_db)
+    _replay_worker["template"] = template
+    _replay_worker["isolated"] = args.replay_isolated
+    db_path = template.clone(os.path.join(workdir, f"worker-{os.getpid()}.sqlite"))
+    database.configure(db_path)
+    cart_store.configure(args.cart_shards, db_path)
+
+    llm = create_llm(args)
+    retry_policy, fallback_llm = create_retry_policy(args)
+    # Compiled once; every conversation runs a copy of it with its own checkpointer (see _replay_worker_run)
+    _replay_worker["graph"] = build_graph(
+        llm,
+        router=None if args.no_fast_path else FastPathRouter(),
+        context_tokens=args.context_tokens,
+        llm_summary=args.llm_summary,
+        tool_timeout=args.tool_timeout,
+        tool_workers=args.tool_workers,
+        result_format=args.tool_result_format,
+        retry_policy=retry_policy,
+        fallback_llm=fallback_llm,
+    )
+
+
+# Tool calls made during a turn, with their (truncated) results
+def _tool_call_trace(messages: list, max_length=300) -> list[dict]:
+    results = {message.tool_call_id: message for message in messages if isinstance(message, ToolMessage)}
+    trace = []
+    for message in messages:
+        if isinstance(message, AIMessage):
+            for tool_call in message.tool_calls:
+                result = results.get(tool_call["id"])
+                content = result.content if result is not None else None
+                if isinstance(content, str) and len(content) > max_length:
+                    content = content[:max_length] + " ... (truncated)"
+                trace.append({
+                    "name": tool_call["name"],
+                    "args": tool_call["args"],
+                    "status": result.status if result is not None else "pending",
+                    "result": content,
+                })
+    return trace
+
+
+# Run one recorded conversation through the graph of this worker
+def replay_conversation(graph, conversation: dict) -> dict:
+    thread_id = f"replay-{conversation['id']}-{uuid.uuid4().hex[:8]}"
+    config = {"configurable": {"thread_id": thread_id, "user_id": thread_id}}
+    default_approval = conversation.get("default_approval", "deny")
+
+    turns = []
+    start = time.perf_counter()
+    for turn in conversation["turns"]:
+        if isinstance(turn, str):
+            turn = {"user": turn}
+        approvals = list(turn.get("approvals", []))
+        record = {"user": turn["user"], "interrupts": []}
+        turn_start = time.perf_counter()
+        try:
+            before = {message.id for message in graph.get_state(config).values.get("messages", [])}
+            graph.invoke({"messages": ("user", turn["user"])}, config)
+            snapshot = graph.get_state(config)
+            while snapshot.next:
+                # Scripted answer to the approval prompt ("y" approves, anything else is the reason of a denial)
+                answer = approvals.pop(0) if approvals else ("y" if default_approval == "approve" else "denied")
+                pending = pending_tool_calls(snapshot.values["messages"], SENSITIVE_TOOL_NAMES)
+                record["interrupts"].append({
+                    "tool_calls": [{"name": call["name"], "args": call["args"]} for call in pending],
+                    "approved": answer == "y",
+                    "reason": None if answer == "y" else answer,
+                })
+                if answer == "y":
+                    graph.invoke(None, config)
+                else:
+                    graph.invoke({"messages": denial_messages(snapshot.values["messages"], answer)}, config)
+                snapshot = graph.get_state(config)
+
+            messages = [message for message in snapshot.values["messages"] if message.id not in before]
+            record["answer"] = messages[-1].content if messages and isinstance(messages[-1], AIMessage) else ""
+            record["tool_calls"] = _tool_call_trace(messages)
+        except Exception as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+        record["elapsed_ms"] = (time.perf_counter() - turn_start) * 1000
+        turns.append(record)
+
+    return {
+        "id": conversation["id"],
+        "thread_id": thread_id,
+        "elapsed_ms": (time.perf_counter() - start) * 1000,
+        "errors": sum("error" in turn for turn in turns),
+        "turns": turns,
+    }
+
+
+def _replay_worker_run(task: tuple) -> dict:
+    index, conversation = task
+    # A fresh checkpointer per conversation: it is dropped with the conversation, so a long replay does not grow
+    # the worker's memory
+    graph = _replay_worker["graph"].copy(update={"checkpointer": MemorySaver()})
+    if _replay_worker["isolated"]:
+        # A fresh in-memory copy of the database for every conversation
+        with _replay_worker["template"].isolated():
+            replayed = replay_conversation(graph, conversation)
+    else:
+        replayed = replay_conversation(graph, conversation)
+    return {"index": index, "worker": os.getpid(), **replayed}
+
+
+def _read_conversations(path: str):
+    with open(path, encoding="utf-8") as f:
+        for index, line in enumerate(f):
+            if line.strip():
+                conversation = json.loads(line)
+                conversation.setdefault("id", str(index))
+                yield index, conversation
+
+
+# Batch mode: replay recorded conversations across a pool of worker processes.
+# Every line of the input file is one conversation:
+#     {"id": "c1", "turns": ["Hi", {"user": "Add product 3 to my cart", "approvals": ["y"]}], "default_approval": "deny"}
+# "approvals" answers the approval prompts of that turn in order ("y" approves, anything else is the reason of a
+# denial); prompts without a scripted answer get default_approval ("approve" or "deny", default "deny").
+def replay(args) -> int:
+    workers = max(1, args.replay_workers or 1)
+    conversations = turns = errors = 0
+    latencies = []
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix="skincare-replay-") as workdir, \
+            open(args.replay_output, "w", encoding="utf-8") as output:
+        # Spawned workers do not inherit the database connections, locks or threads of this process
+        pool = multiprocessing.get_context("spawn").Pool(workers, _replay_worker_init, (args, workdir))
+        try:
+            for result in pool.imap_unordered(_replay_worker_run, _read_conversations(args.replay)):
+                output.write(json.dumps(result, default=str) + "\n")
+                output.flush()
+                conversations += 1
+                turns += len(result["turns"])
+                errors += result["errors"]
+                latencies.extend(turn["elapsed_ms"] / 1000 for turn in result["turns"])
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    elapsed = time.perf_counter() - start
+    stats = summarize(latencies)
+    print(
+        f"Replayed {conversations} conversations ({turns} turns) in {elapsed:.2f}s with {workers} workers "
+        f"({conversations / elapsed if elapsed else 0.0:.1f} conversations/s), {errors} failed turns. "
+        f"Turn latency: p50 {stats['p50_ms']:.1f} ms, p95 {stats['p95_ms']:.1f} ms. "
+        f"Results written to {args.replay_output}"
+    )
+    return 1 if errors else 0
+
+
+# Main function to run the chatbot
+def main(argv=None):
+    args = parse_args(argv)
+    if args.replay:
+        return replay(args)
+
+    # Enable tracing before any database connection is opened
+    if args.trace or args.metrics:
+        telemetry.enable(args.trace)
+
+    # Generate a unique thread ID for the conversation session (same as user_id)
+    thread_id = args.thread_id or str(uuid.uuid4())
+    config = {
+        "configurable": {
+            "thread_id": thread_id,
+            "user_id": thread_id,
+        },
+        "callbacks": telemetry.callbacks(),
+    }
+
+    # Startup timings: imports, then the setup steps below
+    startup = {"imports": _imported - _started}
+    step = time.perf_counter()
+    model_warmup = _preloaded or warmup.preload(sys.argv[1:] if argv is None else argv)
+
+    # Initialize the LLM model
+    llm = create_llm(args)
+
+    cart_store.configure(args.cart_shards)
+    router = None if args.no_fast_path else FastPathRouter()
+    response_cache = None
+    if args.response_cache:
+        response_cache = ResponseCache(
+            args.response_cache_db,
+            ttl_seconds=args.response_cache_ttl,
+            threshold=args.response_cache_threshold,
+            version=lambda: get_catalog().version(),
+        )
+    retry_policy, fallback_llm = create_retry_policy(args)
+    memory = create_checkpointer(args)
+    graph = build_graph(
+        llm,
         checkpointer=memory,
-        interrupt_before=["sensitive_tools"],    
+        router=router,
+        context_tokens=args.context_tokens,
+        llm_summary=args.llm_summary,
+        tool_timeout=args.tool_timeout,
+        tool_workers=args.tool_workers,
+        result_format=args.tool_result_format,
+        response_cache=response_cache,
+        retry_policy=retry_policy,
+        fallback_llm=fallback_llm,
+        debug=True,
     )
+    startup["setup"] = time.perf_counter() - step
+    if model_warmup is not None:
+        model_warmup.prime(*warmup_request())
 
     ## Uncomment to generate the graph diagram
     # try:
@@ -154,6 +815,13 @@ def main():
     # Start the conversation loop
     _printed = set()
     print("Welcome to the Skincare Assistant Chatbot!")
+    if args.checkpointer == "sqlite":
+        print(f"Conversation ID: {thread_id} (pass --thread-id {thread_id} to resume it later)")
+    print(
+        f"[Startup] ready in {time.perf_counter() - _started:.2f}s (imports {startup['imports']:.2f}s, "
+        f"setup and graph {startup['setup']:.2f}s)"
+        + (f", {model_warmup.report()}" if model_warmup is not None else "")
+    )
 
     while True:
         # Get user input
@@ -163,6 +831,27 @@ def main():
         # Check for exit command
         if user_input.lower() in ['quit', 'exit']:
             print("\nThank you for using Beauty Products Customer Support. Goodbye!")
+            if router is not None:
+                stats = router.stats()
+                print(f"[Fast path] answered {stats['hits']} of {stats['hits'] + stats['misses']} questions "
+                      f"without the LLM (hit rate {stats['hit_rate']:.0%}).")
+            if response_cache is not None:
+                stats = response_cache.stats()
+                print(f"[Response cache] {stats['exact_hits']} exact and {stats['similar_hits']} similar hits, "
+                      f"{stats['misses']} misses (hit rate {stats['hit_rate']:.0%}).")
+                response_cache.close()
+            stats = retry_policy.stats()
+            if stats["retries"] or stats["timeouts"]:
+                print(f"[Retries] {stats['retries']} empty responses retried ({stats['wasted_tokens']} tokens wasted), "
+                      f"{stats['timeouts']} timeouts, {stats['fallbacks']} fallback and {stats['canned']} canned "
+                      f"answers, {stats['retry_seconds']:.1f}s added.")
+            if isinstance(memory, SQLiteCheckpointSaver):
+                memory.close()
+            cart_store.close_all()
+            close_all()
+            if args.metrics:
+                telemetry.get_telemetry().write_metrics(args.metrics)
+            telemetry.disable()
             break
         
         # Skip empty inputs
@@ -170,16 +859,29 @@ def main():
             continue
 
         # Process the user input
+        if model_warmup is not None:
+            # The first turn waits for the warm-up anyway (Ollama queues the requests): say what it cost
+            if not model_warmup.done():
+                print("\n[Startup] waiting for the model to load...")
+                model_warmup.wait()
+            print(f"\n[Startup] {model_warmup.report()}")
+            model_warmup = None
+
         print("\nAssistant:", end=" ")
-        events = graph.stream(
-            {"messages": ("user", user_input)}, 
-            config, 
-            stream_mode="values"
-        )
-        
-        # Print each event response from the assistant
-        for event in events:
-            _print_event(event, _printed)
+        if args.stream:
+            # Print the tokens as they arrive
+            events = graph.stream({"messages": ("user", user_input)}, config, stream_mode="messages")
+            _print_stream_stats(_print_stream(events, _printed))
+        else:
+            events = graph.stream(
+                {"messages": ("user", user_input)}, 
+                config, 
+                stream_mode="values"
+            )
+            
+            # Print each event response from the assistant
+            for event in events:
+                _print_event(event, _printed)
 
 
         # Get the graph state after the user input
@@ -194,7 +896,10 @@ def main():
                 )
             except:
                 user_input = "y"
-            if user_input.strip() == "y":
+            if user_input.strip() == "y" and args.stream:
+                # Just continue, printing the tokens as they arrive
+                _print_stream_stats(_print_stream(graph.stream(None, config, stream_mode="messages"), _printed))
+            elif user_input.strip() == "y":
                 # Just continue
                 result = graph.invoke(
                     None,
@@ -204,19 +909,12 @@ def main():
                 print(result['messages'][-1].content)
                 
             else:
-                # Satisfy the tool invocation by providing a user message
+                # Satisfy every pending sensitive tool invocation by providing a user message
                 result = graph.invoke(
-                    {
-                        "messages": [
-                            ToolMessage(
-                                tool_call_id=event["messages"][-1].tool_calls[0]["id"],
-                                content=f"API call denied by user. Reasoning: '{user_input}'. Continue assisting, accounting for the user's input.",
-                            )
-                        ]
-                    },
+                    {"messages": denial_messages(snapshot.values["messages"], user_input)},
                     config,
                 )
             snapshot = graph.get_state(config)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    raise SystemExit(main())
\ No newline at end of file
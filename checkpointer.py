@@ -0,0 +1,496 @@
+import asyncio
+import os
+import random
+import threading
+import time
+import zlib
+from functools import partial
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Sequence, Tuple
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    SerializerProtocol,
+    get_checkpoint_id,
+)
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+from langgraph.checkpoint.serde.types import TASKS, ChannelProtocol
+
+from database import ConnectionPool, write_transaction
+
+'''
+    This is a module that contains a disk-backed LangGraph checkpointer built on the SQLite connection pool.
+    Unlike MemorySaver, memory use stays flat: only the last few checkpoints of each thread are kept, idle threads
+    expire after a TTL and the oldest threads are evicted once the store grows past a size cap. Sessions survive
+    restarts of the chatbot.
+'''
+
+# Default path to the checkpoint database (kept apart from the products/carts database to avoid lock contention)
+DEFAULT_CHECKPOINT_DB = os.environ.get("SKINCARE_CHECKPOINT_DB", "checkpoints.sqlite")
+
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS checkpoints (
+        thread_id TEXT NOT NULL,
+        checkpoint_ns TEXT NOT NULL DEFAULT '',
+        checkpoint_id TEXT NOT NULL,
+        parent_checkpoint_id TEXT,
+        type TEXT,
+        checkpoint BLOB,
+        metadata_type TEXT,
+        metadata BLOB,
+        size INTEGER NOT NULL,
+        PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS writes (
+        thread_id TEXT NOT NULL,
+        checkpoint_ns TEXT NOT NULL DEFAULT '',
+        checkpoint_id TEXT NOT NULL,
+        task_id TEXT NOT NULL,
+        idx INTEGER NOT NULL,
+        channel TEXT NOT NULL,
+        type TEXT,
+        value BLOB,
+        size INTEGER NOT NULL,
+        PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+    );
+
+    CREATE TABLE IF NOT EXISTS threads (
+        thread_id TEXT PRIMARY KEY,
+        last_access REAL NOT NULL
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_threads_last_access ON threads (last_access);
+"""
+
+
+class CompressedSerializer(SerializerProtocol):
+    """Wraps the LangGraph msgpack serializer and zlib-compresses payloads above a size threshold.
+
+    Chat histories are highly repetitive (every checkpoint repeats the message list), so this typically
+    shrinks checkpoints several times over at a small CPU cost.
+    """
+
+    SUFFIX = "+zlib"
+
+    def __init__(self, serde: Optional[SerializerProtocol] = None, threshold: int = 512, level: int = 6):
+        self.serde = serde or JsonPlusSerializer()
+        self.threshold = threshold
+        self.level = level
+
+    def dumps(self, obj: Any) -> bytes:
+        return self.serde.dumps(obj)
+
+    def loads(self, data: bytes) -> Any:
+        return self.serde.loads(data)
+
+    def dumps_typed(self, obj: Any) -> Tuple[str, bytes]:
+        type_, data = self.serde.dumps_typed(obj)
+        if len(data) >= self.threshold:
+            return type_ + self.SUFFIX, zlib.compress(data, self.level)
+        return type_, data
+
+    def loads_typed(self, data: Tuple[str, bytes]) -> Any:
+        type_, data_ = data
+        if type_.endswith(self.SUFFIX):
+            return self.serde.loads_typed((type_[: -len(self.SUFFIX)], zlib.decompress(data_)))
+        return self.serde.loads_typed((type_, data_))
+
+
+class SQLiteCheckpointSaver(BaseCheckpointSaver[str]):
+    """A bounded, persistent checkpoint saver stored in SQLite.
+
+    Args:
+        path (str): Path to the checkpoint database file.
+        max_checkpoints (int): Number of checkpoints kept per thread (older ones are pruned on every put).
+        ttl_seconds (float): Threads not written to for this long are deleted. None disables the TTL.
+        max_bytes (int): Size cap for the stored checkpoints and writes. The least recently used threads are
+            evicted when it is exceeded. None disables the cap.
+        sweep_interval (float): Minimum number of seconds between two TTL/size sweeps.
+        serde (SerializerProtocol): Serializer for checkpoints, defaults to CompressedSerializer.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CHECKPOINT_DB,
+        *,
+        max_checkpoints: int = 20,
+        ttl_seconds: Optional[float] = 7 * 24 * 3600,
+        max_bytes: Optional[int] = 256 * 1024 * 1024,
+        sweep_interval: float = 60.0,
+        serde: Optional[SerializerProtocol] = None,
+    ):
+        super().__init__(serde=serde or CompressedSerializer())
+        self.max_checkpoints = max_checkpoints
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self.pool = ConnectionPool(path)
+        self._last_sweep = 0.0
+        self._sweep_lock = threading.Lock()
+        self.pool.get_connection().executescript(SCHEMA_SQL)
+
+    def __enter__(self) -> "SQLiteCheckpointSaver":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self):
+        self.pool.close()
+
+    # --- reads ---
+
+    def _load_tuple(self, conn, thread_id: str, checkpoint_ns: str, row) -> CheckpointTuple:
+        checkpoint_id, parent_checkpoint_id, type_, checkpoint, metadata_type, metadata = row
+        writes = conn.execute(
+            """
+            SELECT task_id, channel, type, value FROM writes
+            WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?
+            ORDER BY task_id, idx
+            """,
+            (thread_id, checkpoint_ns, checkpoint_id),
+        ).fetchall()
+        if parent_checkpoint_id:
+            sends = conn.execute(
+                """
+                SELECT type, value FROM writes
+                WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? AND channel = ?
+                ORDER BY task_id, idx
+                """,
+                (thread_id, checkpoint_ns, parent_checkpoint_id, TASKS),
+            ).fetchall()
+        else:
+            sends = []
+
+        return CheckpointTuple(
+            config={
+                "configurable": {
+                    "thread_id": thread_id,
+                    "checkpoint_ns": checkpoint_ns,
+                    "checkpoint_id": checkpoint_id,
+                }
+            },
+            checkpoint={
+                **self.serde.loads_typed((type_, checkpoint)),
+                "pending_sends": [self.serde.loads_typed(send) for send in sends],
+            },
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            parent_config={
+                "configurable": {
+                    "thread_id": thread_id,
+                    "checkpoint_ns": checkpoint_ns,
+                    "checkpoint_id": parent_checkpoint_id,
+                }
+            }
+            if parent_checkpoint_id
+            else None,
+            pending_writes=[
+                (task_id, channel, self.serde.loads_typed((w_type, value)))
+                for task_id, channel, w_type, value in writes
+            ],
+        )
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        """Get the checkpoint with the config's checkpoint_id, or the latest one of the thread."""
+        conn = self.pool.get_connection()
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        query = """
+            SELECT checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata
+            FROM checkpoints
+            WHERE thread_id = ? AND checkpoint_ns = ?
+        """
+        if checkpoint_id := get_checkpoint_id(config):
+            row = conn.execute(query + " AND checkpoint_id = ?", (thread_id, checkpoint_ns, checkpoint_id)).fetchone()
+        else:
+            row = conn.execute(query + " ORDER BY checkpoint_id DESC LIMIT 1", (thread_id, checkpoint_ns)).fetchone()
+        if row is None:
+            return None
+        return self._load_tuple(conn, thread_id, checkpoint_ns, row)
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        """List checkpoints, newest first, optionally filtered by thread, namespace, metadata and `before`."""
+        conn = self.pool.get_connection()
+        clauses, params = [], []
+        if config:
+            clauses.append("thread_id = ?")
+            params.append(config["configurable"]["thread_id"])
+            if (checkpoint_ns := config["configurable"].get("checkpoint_ns")) is not None:
+                clauses.append("checkpoint_ns = ?")
+                params.append(checkpoint_ns)
+            if checkpoint_id := get_checkpoint_id(config):
+                clauses.append("checkpoint_id = ?")
+                params.append(checkpoint_id)
+        if before and (before_checkpoint_id := get_checkpoint_id(before)):
+            clauses.append("checkpoint_id < ?")
+            params.append(before_checkpoint_id)
+
+        query = """
+            SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint,
+                   metadata_type, metadata
+            FROM checkpoints
+        """
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY checkpoint_id DESC"
+        if limit is not None and not filter:
+            # Without a metadata filter every row is a result: let SQLite stop at the limit
+            query += " LIMIT ?"
+            params.append(max(limit, 0))
+
+        # The rows (compressed checkpoints) are read one at a time, only as far as the caller iterates
+        for thread_id, checkpoint_ns, *row in conn.execute(query, params):
+            if limit is not None and limit <= 0:
+                break
+            if filter:
+                metadata = self.serde.loads_typed((row[4], row[5]))
+                if not all(metadata.get(key) == value for key, value in filter.items()):
+                    continue
+            if limit is not None:
+                limit -= 1
+            yield self._load_tuple(conn, thread_id, checkpoint_ns, row)
+
+    # --- writes ---
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        """Save a checkpoint and prune the thread's history down to the last max_checkpoints entries."""
+        c = checkpoint.copy()
+        c.pop("pending_sends", None)  # type: ignore[misc]
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        type_, data = self.serde.dumps_typed(c)
+        metadata_type, metadata_data = self.serde.dumps_typed(metadata)
+
+        conn = self.pool.get_connection()
+        with write_transaction(conn):
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO checkpoints (thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id,
+                                                    type, checkpoint, metadata_type, metadata, size)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    thread_id,
+                    checkpoint_ns,
+                    checkpoint["id"],
+                    config["configurable"].get("checkpoint_id"),
+                    type_,
+                    data,
+                    metadata_type,
+                    metadata_data,
+                    len(data) + len(metadata_data),
+                ),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO threads (thread_id, last_access) VALUES (?, ?)",
+                (thread_id, time.time()),
+            )
+            self._prune_thread(conn, thread_id, checkpoint_ns)
+
+        self._maybe_sweep(thread_id)
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint["id"],
+            }
+        }
+
+    def put_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str) -> None:
+        """Save the intermediate writes of a task for the config's checkpoint."""
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        # Special writes (errors, interrupts) replace earlier ones, regular writes are only saved once
+        verb = "INSERT OR REPLACE" if all(w[0] in WRITES_IDX_MAP for w in writes) else "INSERT OR IGNORE"
+
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            type_, data = self.serde.dumps_typed(value)
+            rows.append((
+                thread_id,
+                checkpoint_ns,
+                checkpoint_id,
+                task_id,
+                WRITES_IDX_MAP.get(channel, idx),
+                channel,
+                type_,
+                data,
+                len(data),
+            ))
+
+        conn = self.pool.get_connection()
+        with write_transaction(conn):
+            conn.executemany(
+                f"""
+                {verb} INTO writes (thread_id, checkpoint_ns, checkpoint_id, task_id, idx, channel, type, value, size)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                rows,
+            )
+
+    def get_next_version(self, current: Optional[str], channel: ChannelProtocol) -> str:
+        # Same monotonically increasing string versions as MemorySaver
+        if current is None:
+            current_v = 0
+        elif isinstance(current, int):
+            current_v = current
+        else:
+            current_v = int(current.split(".")[0])
+        next_v = current_v + 1
+        next_h = random.random()
+        return f"{next_v:032}.{next_h:016}"
+
+    # --- bounding ---
+
+    def _prune_thread(self, conn, thread_id: str, checkpoint_ns: str):
+        """Delete all but the newest max_checkpoints checkpoints (and their writes) of a thread."""
+        row = conn.execute(
+            """
+            SELECT checkpoint_id, parent_checkpoint_id FROM checkpoints
+            WHERE thread_id = ? AND checkpoint_ns = ?
+            ORDER BY checkpoint_id DESC
+            LIMIT 1 OFFSET ?
+            """,
+            (thread_id, checkpoint_ns, self.max_checkpoints - 1),
+        ).fetchone()
+        if row is None:
+            return
+        oldest_kept, parent = row
+        conn.execute(
+            "DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id < ?",
+            (thread_id, checkpoint_ns, oldest_kept),
+        )
+        # Keep the writes of the oldest checkpoint's parent: they hold its pending sends
+        conn.execute(
+            "DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id < ?",
+            (thread_id, checkpoint_ns, min(oldest_kept, parent or oldest_kept)),
+        )
+
+    def _delete_threads(self, conn, thread_ids: Sequence[str]):
+        for table in ("checkpoints", "writes", "threads"):
+            conn.executemany(f"DELETE FROM {table} WHERE thread_id = ?", [(t,) for t in thread_ids])
+
+    def delete_thread(self, thread_id: str):
+        """Delete every checkpoint and write of a thread."""
+        conn = self.pool.get_connection()
+        with write_transaction(conn):
+            self._delete_threads(conn, [thread_id])
+
+    def size(self) -> int:
+        """Total number of bytes of serialized checkpoints and writes."""
+        conn = self.pool.get_connection()
+        return conn.execute(
+            "SELECT (SELECT IFNULL(SUM(size), 0) FROM checkpoints) + (SELECT IFNULL(SUM(size), 0) FROM writes)"
+        ).fetchone()[0]
+
+    def _thread_sizes(self, conn, thread_ids: Sequence[str]) -> int:
+        """Bytes of the checkpoints and writes of some threads."""
+        marks = ",".join("?" * len(thread_ids))
+        return conn.execute(
+            f"SELECT (SELECT IFNULL(SUM(size), 0) FROM checkpoints WHERE thread_id IN ({marks})) "
+            f"+ (SELECT IFNULL(SUM(size), 0) FROM writes WHERE thread_id IN ({marks}))",
+            (*thread_ids, *thread_ids),
+        ).fetchone()[0]
+
+    def sweep(self, keep: Optional[str] = None) -> int:
+        """Evict expired threads, then the least recently used ones until the size cap is met. The thread keep
+           (the one being saved) is never evicted for the size cap. Returns the number of threads evicted.
+        """
+        conn = self.pool.get_connection()
+        evicted = 0
+        with write_transaction(conn):
+            if self.ttl_seconds is not None:
+                expired = [
+                    row[0]
+                    for row in conn.execute(
+                        "SELECT thread_id FROM threads WHERE last_access < ?",
+                        (time.time() - self.ttl_seconds,),
+                    )
+                ]
+                self._delete_threads(conn, expired)
+                evicted += len(expired)
+
+        if self.max_bytes is not None:
+            # The total is summed once, then reduced by the size of each batch of evicted threads
+            size = self.size()
+            while size > self.max_bytes:
+                with write_transaction(conn):
+                    oldest = [
+                        row[0]
+                        for row in conn.execute(
+                            "SELECT thread_id FROM threads WHERE thread_id IS NOT ? ORDER BY last_access LIMIT 10",
+                            (keep,),
+                        )
+                    ]
+                    if not oldest:
+                        break
+                    size -= self._thread_sizes(conn, oldest)
+                    self._delete_threads(conn, oldest)
+                    evicted += len(oldest)
+        return evicted
+
+    def _maybe_sweep(self, thread_id: Optional[str] = None):
+        now = time.monotonic()
+        if now - self._last_sweep < self.sweep_interval or not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_sweep = now
+            self.sweep(keep=thread_id)
+        finally:
+            self._sweep_lock.release()
+
+    # --- async ---
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.get_running_loop().run_in_executor(None, self.get_tuple, config)
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        loop = asyncio.get_running_loop()
+        items = await loop.run_in_executor(
+            None, lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+        )
+        for item in items:
+            yield item
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.put, config, checkpoint, metadata, new_versions
+        )
+
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str) -> None:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, partial(self.put_writes, config, writes, task_id)
+        )
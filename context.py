@@ -0,0 +1,200 @@
+import json
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from langchain_core.messages import AIMessage, AnyMessage, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.runnables import Runnable
+from langgraph.constants import TAG_NOSTREAM
+
+'''
+    This is a module that keeps the prompt sent to the LLM within a token budget, however long the conversation gets.
+    The most recent turns are sent verbatim, tool results of older turns are collapsed to a short preview and the
+    oldest turns are folded into a rolling summary that is cached per conversation (thread_id).
+'''
+
+
+def approximate_tokens(messages: list[AnyMessage]) -> int:
+    """Cheap token estimate (about 4 characters per token plus a small per-message overhead)."""
+    total = 0
+    for message in messages:
+        content = message.content if isinstance(message.content, str) else json.dumps(message.content)
+        total += 4 + len(content) // 4
+        for tool_call in getattr(message, "tool_calls", None) or []:
+            total += 4 + len(json.dumps(tool_call.get("args", {}))) // 4
+    return total
+
+
+def _text(message: AnyMessage) -> str:
+    if isinstance(message.content, str):
+        return message.content
+    return " ".join(part.get("text", "") for part in message.content if isinstance(part, dict))
+
+
+def _shorten(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit] + " ..."
+
+
+def split_turns(messages: list[AnyMessage]) -> list[list[AnyMessage]]:
+    """Split the history into turns, each starting at a user message. Tool calls and their results always
+    stay in the same turn, so folding whole turns never leaves a ToolMessage without its AIMessage.
+    """
+    turns = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([message])
+        else:
+            turns[-1].append(message)
+    return turns
+
+
+def extractive_summary(previous: str, turns: list[list[AnyMessage]], max_chars: int = 1500) -> str:
+    """Summarize turns without calling the LLM: one line per user request and final assistant answer."""
+    lines = previous.splitlines() if previous else []
+    for turn in turns:
+        tools = sorted({tc["name"] for m in turn if isinstance(m, AIMessage) for tc in m.tool_calls})
+        answers = [m for m in turn if isinstance(m, AIMessage) and _text(m)]
+        line = f"- User: {_shorten(_text(turn[0]), 150)}"
+        if tools:
+            line += f" (tools used: {', '.join(tools)})"
+        if answers:
+            line += f" / Assistant: {_shorten(_text(answers[-1]), 150)}"
+        lines.append(line)
+
+    # Keep the newest lines when the summary grows past its budget
+    while len(lines) > 1 and sum(len(line) + 1 for line in lines) > max_chars:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+class ContextManager:
+    """Trims the message history in front of the LLM call.
+
+    Args:
+        max_tokens (int): Token budget for the conversation messages (the system prompt is not included).
+        keep_turns (int): Number of most recent turns always sent verbatim, tool results included.
+        tool_result_chars (int): Older tool results are collapsed to a preview of this many characters.
+        fold_ratio (float): When the budget is exceeded, old turns are folded until the history is below this
+            fraction of it. Folding in batches keeps the prompt prefix stable across turns.
+        summary_tokens (int): Budget of the rolling summary, part of max_tokens (default: a quarter of it).
+        summarizer (Runnable): Optional LLM used to write the rolling summary. Without one, an extractive
+            summary is built instead (no extra LLM call).
+        token_counter (Callable): Function counting the tokens of a list of messages.
+        cache_size (int): Number of conversations whose summary is cached.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 3000,
+        keep_turns: int = 2,
+        tool_result_chars: int = 200,
+        fold_ratio: float = 0.6,
+        summary_tokens: Optional[int] = None,
+        summarizer: Optional[Runnable] = None,
+        token_counter: Callable[[list[AnyMessage]], int] = approximate_tokens,
+        cache_size: int = 1024,
+    ):
+        self.max_tokens = max_tokens
+        self.keep_turns = keep_turns
+        self.tool_result_chars = tool_result_chars
+        self.fold_ratio = fold_ratio
+        self.summary_tokens = summary_tokens if summary_tokens is not None else max_tokens // 4
+        self.summarizer = summarizer
+        self.count_tokens = token_counter
+        self.cache_size = cache_size
+        # thread_id -> (id of the last folded message, number of folded turns, summary)
+        self._summaries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _collapse(self, turns: list[list[AnyMessage]]) -> list[list[AnyMessage]]:
+        """Replace the tool results of all but the last keep_turns turns with a short preview."""
+        collapsed = []
+        for i, turn in enumerate(turns):
+            if i >= len(turns) - self.keep_turns:
+                collapsed.append(turn)
+                continue
+            collapsed.append([
+                ToolMessage(
+                    content=_shorten(_text(m), self.tool_result_chars),
+                    tool_call_id=m.tool_call_id,
+                    name=m.name,
+                    id=m.id,
+                )
+                if isinstance(m, ToolMessage) and len(_text(m)) > self.tool_result_chars
+                else m
+                for m in turn
+            ])
+        return collapsed
+
+    def _summarize(self, previous: str, turns: list[list[AnyMessage]]) -> str:
+        if self.summarizer is None:
+            return extractive_summary(previous, turns, max_chars=self.summary_tokens * 4)
+
+        transcript = "\n".join(
+            f"{type(m).__name__.replace('Message', '')}: {_shorten(_text(m), 500)}"
+            for turn in turns
+            for m in turn
+            if _text(m)
+        )
+        result = self.summarizer.invoke([
+            SystemMessage(
+                content="You maintain a short running summary of a customer support conversation for a skincare "
+                        "shop. Keep the customer's needs, the products discussed (with their product_id) and any "
+                        "cart changes. Reply with the updated summary only."
+            ),
+            HumanMessage(
+                content=f"Current summary:\n{previous or '(none)'}\n\nNew messages:\n{transcript}\n\n"
+                        f"Keep the summary under {int(self.summary_tokens * 0.75)} words."
+            ),
+        ], config={"tags": [TAG_NOSTREAM]})  # internal call: keep its tokens out of the streamed answer
+        # Hard cap in case the model ignores the length instruction
+        return _text(result).strip()[: self.summary_tokens * 4]
+
+    def _cached_summary(self, thread_id, turns: list[list[AnyMessage]]):
+        """Return (number of folded turns, summary) if the cached summary still matches this history."""
+        with self._lock:
+            cached = self._summaries.get(thread_id)
+            if cached is None:
+                return 0, ""
+            self._summaries.move_to_end(thread_id)
+        last_id, folded_turns, summary = cached
+        if folded_turns <= len(turns) and turns[folded_turns - 1][-1].id == last_id:
+            return folded_turns, summary
+        return 0, ""
+
+    def _store_summary(self, thread_id, last_id, folded_turns: int, summary: str):
+        with self._lock:
+            self._summaries[thread_id] = (last_id, folded_turns, summary)
+            self._summaries.move_to_end(thread_id)
+            if len(self._summaries) > self.cache_size:
+                self._summaries.popitem(last=False)
+
+    def prepare(self, messages: list[AnyMessage], thread_id=None) -> list[AnyMessage]:
+        """Return the messages to send to the LLM for this history."""
+        turns = split_turns(messages)
+        folded, summary = self._cached_summary(thread_id, turns) if thread_id is not None else (0, "")
+        recent = self._collapse(turns[folded:])
+
+        sizes = [self.count_tokens(turn) for turn in recent]
+        if sum(sizes) + self.summary_tokens > self.max_tokens:
+            # Fold the oldest turns (never the last keep_turns) until the rest, plus a full summary,
+            # fits in fold_ratio of the budget
+            target = self.max_tokens * self.fold_ratio - self.summary_tokens
+            total = sum(sizes)
+            to_fold = 0
+            while to_fold < len(recent) - max(self.keep_turns, 1) and total > target:
+                total -= sizes[to_fold]
+                to_fold += 1
+
+            if to_fold:
+                summary = self._summarize(summary, turns[folded:folded + to_fold])
+                folded += to_fold
+                recent = recent[to_fold:]
+                if thread_id is not None:
+                    self._store_summary(thread_id, turns[folded - 1][-1].id, folded, summary)
+
+        prepared = [m for turn in recent for m in turn]
+        if summary:
+            prepared.insert(0, SystemMessage(content=f"Summary of the earlier conversation:\n{summary}"))
+        return prepared
@@ -0,0 +1,241 @@
+import atexit
+import contextvars
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+import telemetry
+
+'''
+    This is a module that provides pooled, long-lived SQLite connections for the LangChain tools.
+    Each thread gets its own connection which is configured once and then reused for every tool call.
+
+    The tools use the database configured for the process, unless the current run is bound to another one with
+    use_database() (e.g. a clone made by db_template.py): the binding is a context variable, so it follows the
+    run into the threads and tasks LangGraph starts for it, and many isolated runs can share one process.
+'''
+
+# Default path to the SQLite database file (can be overridden with the SKINCARE_DB environment variable)
+DEFAULT_DB_PATH = os.environ.get("SKINCARE_DB", "skincare.sqlite")
+
+# PRAGMAs applied once to every new connection
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA foreign_keys = ON",
+)
+
+# Number of prepared statements cached per connection
+CACHED_STATEMENTS = 256
+
+# Taking the write lock normally takes microseconds; SQLite's busy handler sleeps at least a millisecond
+# between retries, so a BEGIN IMMEDIATE slower than this waited for another writer.
+LOCK_WAIT_THRESHOLD = 0.001
+
+
+def connect(path: str = DEFAULT_DB_PATH, timeout: float = 5.0) -> sqlite3.Connection:
+    """Open a new connection with the standard PRAGMAs applied."""
+    conn = sqlite3.connect(
+        path,
+        timeout=timeout,
+        # "file:" URIs open in-memory clones ("file:/name?vfs=memdb") and read-only files
+        uri=path.startswith("file:"),
+        cached_statements=CACHED_STATEMENTS,
+        check_same_thread=False,
+        # Connections opened while tracing is enabled time every statement
+        factory=telemetry.TracedConnection if telemetry.enabled() else sqlite3.Connection,
+    )
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class ConnectionPool:
+    """Hands out one reusable SQLite connection per thread for a single database file.
+
+    close() closes every connection handed out so far but leaves the pool usable: a thread calling
+    get_connection() afterwards opens a new connection (so close_all() at the end of a run does not break
+    the threads of a later one).
+    """
+
+    def __init__(self, path: str = DEFAULT_DB_PATH, timeout: float = 5.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # (owning thread, connection) pairs so that every connection can be closed at shutdown
+        self._connections = []
+
+    def get_connection(self) -> sqlite3.Connection:
+        """Return the connection owned by the calling thread, opening it on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect(self.path, self.timeout)
+            self._local.conn = conn
+            with self._lock:
+                self._prune()
+                self._connections.append((weakref.ref(threading.current_thread()), conn))
+        return conn
+
+    def _prune(self):
+        # Close the connections of threads that have already exited
+        alive = []
+        for thread_ref, conn in self._connections:
+            thread = thread_ref()
+            if thread is not None and thread.is_alive():
+                alive.append((thread_ref, conn))
+            else:
+                conn.close()
+        self._connections = alive
+
+    def close(self):
+        """Close every connection handed out by this pool (threads reconnect on their next call)."""
+        with self._lock:
+            connections = [conn for _, conn in self._connections]
+            self._connections = []
+            self._local = threading.local()
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+
+# Module level pool shared by the tools (and any concurrent sessions)
+_pool = ConnectionPool(DEFAULT_DB_PATH)
+_pool_lock = threading.Lock()
+
+
+def configure(path: str) -> ConnectionPool:
+    """Point the shared pool at a different database file, closing the previous connections."""
+    global _pool
+    with _pool_lock:
+        old_pool = _pool
+        _pool = ConnectionPool(path)
+    old_pool.close()
+    return _pool
+
+
+# Pools of the databases bound to runs with use_database(), by path
+_bound_pools = {}
+_bound_pool = contextvars.ContextVar("database_pool", default=None)
+
+
+@contextmanager
+def use_database(path: str):
+    """Bind the current run (this thread or task, and the ones it starts) to another database file.
+       The pool of the path is shared by every run bound to it until release() closes it.
+    """
+    with _pool_lock:
+        pool = _bound_pools.get(path)
+        if pool is None:
+            pool = _bound_pools[path] = ConnectionPool(path)
+    token = _bound_pool.set(pool)
+    try:
+        yield pool
+    finally:
+        _bound_pool.reset(token)
+
+
+def release(path: str):
+    """Close the pool of a database bound with use_database() (once no run uses it anymore)."""
+    with _pool_lock:
+        pool = _bound_pools.pop(path, None)
+    if pool is not None:
+        pool.close()
+
+
+def is_bound() -> bool:
+    """Whether the current run is bound to its own database with use_database()."""
+    return _bound_pool.get() is not None
+
+
+def get_pool() -> ConnectionPool:
+    """Return the pool of the database bound to the current run, or else the shared pool."""
+    return _bound_pool.get() or _pool
+
+
+def get_connection() -> sqlite3.Connection:
+    """Return the calling thread's pooled connection to the database of the current run."""
+    return get_pool().get_connection()
+
+
+# Write lock statistics of every write_transaction() in this process
+_lock_stats = {"transactions": 0, "lock_waits": 0, "lock_wait_seconds": 0.0, "lock_timeouts": 0}
+_lock_stats_lock = threading.Lock()
+
+
+def lock_stats() -> dict:
+    """Return how many write transactions ran, how many of them waited for the write lock (and for how
+    long in total) and how many gave up with "database is locked"."""
+    with _lock_stats_lock:
+        return dict(_lock_stats)
+
+
+def reset_lock_stats():
+    with _lock_stats_lock:
+        _lock_stats.update(transactions=0, lock_waits=0, lock_wait_seconds=0.0, lock_timeouts=0)
+
+
+@contextmanager
+def write_transaction(conn: sqlite3.Connection):
+    """Run a block of statements in one BEGIN IMMEDIATE transaction.
+
+    The write lock is taken up front, so concurrent writers wait on the busy timeout instead of
+    failing half way through. Commits on success and rolls back on any exception.
+    """
+    start = time.perf_counter()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+    except sqlite3.OperationalError as e:
+        if "locked" in str(e) or "busy" in str(e):
+            with _lock_stats_lock:
+                _lock_stats["lock_timeouts"] += 1
+        raise
+    waited = time.perf_counter() - start
+    with _lock_stats_lock:
+        _lock_stats["transactions"] += 1
+        if waited > LOCK_WAIT_THRESHOLD:
+            _lock_stats["lock_waits"] += 1
+            _lock_stats["lock_wait_seconds"] += waited
+
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+@contextmanager
+def read_transaction(conn: sqlite3.Connection):
+    """Run a block of queries in one (deferred) BEGIN transaction, so they all read the same snapshot.
+
+    In WAL mode the snapshot is taken by the first query and kept until the end of the block: writes
+    committed in the meantime are not seen, and writers are not blocked.
+    """
+    conn.execute("BEGIN")
+    try:
+        yield conn
+    finally:
+        # Nothing was written: ending the transaction only releases the snapshot
+        conn.rollback()
+
+
+def close_all():
+    """Close every pooled connection. Safe to call more than once (e.g. at shutdown)."""
+    with _pool_lock:
+        pools = list(_bound_pools.values())
+        _bound_pools.clear()
+    for pool in pools:
+        pool.close()
+    _pool.close()
+
+
+atexit.register(close_all)
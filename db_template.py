@@ -0,0 +1,172 @@
+import argparse
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+import catalog
+import database
+import recommender
+import setup
+
+'''
+    This is a module that gives benchmarks, load tests and replays fresh, isolated products databases without
+    loading the CSV file again. A DatabaseTemplate builds the catalog once (from the CSV file, or from an existing
+    database file) and keeps it in memory; clone() then copies it with the SQLite online backup API, in about a
+    millisecond, into:
+
+        - an in-memory database ("file:/skincare-<id>?vfs=memdb", shared by the connections of this process), or
+        - a database file (switched to WAL like the files setup.py builds).
+
+    isolated() clones the template and binds the current run to the clone with database.use_database(), so the
+    tools of that run (and only of that run) read and write it; the clone is dropped at the end. Clones share the
+    recommendation index of the template (it is read-only) and keep their carts in their own table.
+
+    The template is kept in rollback journal mode: the backup API copies the header of the source, and the memdb
+    VFS cannot open a database whose header asks for WAL. In-memory clones therefore serialize their readers
+    against a writer (readers wait on the busy timeout); use file clones to measure write concurrency.
+
+    Run "python db_template.py" to time the clones against a full setup.py build.
+'''
+
+
+def _memory_uri(name: str) -> str:
+    return f"file:/{name}?vfs=memdb"
+
+
+class DatabaseTemplate:
+    """Products database built once and cloned into isolated databases.
+
+    Args:
+        source (str): Database file to copy the template from (None builds it from the CSV file).
+        csv_path (str): CSV file the template is built from when there is no source (default: setup.csv_file).
+    """
+
+    def __init__(self, source: Optional[str] = None, csv_path: Optional[str] = None):
+        self.uri = _memory_uri(f"skincare-template-{uuid.uuid4().hex}")
+        # The in-memory database lives as long as a connection to it is open
+        self._conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+        # Clone path -> connection keeping an in-memory clone alive (None for files)
+        self._clones = {}
+        self._cleanup = None
+
+        if source is None:
+            workdir = tempfile.mkdtemp(prefix="skincare-template-")
+            # Removed by close(), or when the template is garbage collected or the process exits
+            self._cleanup = weakref.finalize(self, shutil.rmtree, workdir, True)
+            source = os.path.join(workdir, "template.sqlite")
+            setup.build_database(source, csv_path or setup.csv_file)
+        # The source of the recommendation index of every clone
+        self.source = source
+        conn = sqlite3.connect(f"file:{os.path.abspath(source)}?mode=ro", uri=True)
+        try:
+            # VACUUM INTO writes a compact copy in rollback journal mode (a backup would keep the WAL header)
+            conn.execute("VACUUM INTO ?", (self.uri,))
+        finally:
+            conn.close()
+
+    def clone(self, path: Optional[str] = None) -> str:
+        """Copy the template into the database file path (replaced if it exists), or into a new in-memory
+           database if path is None. Returns the path to pass to database.use_database() or database.configure().
+        """
+        if path is None:
+            path = _memory_uri(f"skincare-{uuid.uuid4().hex}")
+            target = sqlite3.connect(path, uri=True, check_same_thread=False)
+        else:
+            setup.remove_database(path)
+            target = sqlite3.connect(path, check_same_thread=False)
+        try:
+            with self._lock:
+                self._conn.backup(target)
+            if not path.startswith("file:"):
+                target.execute("PRAGMA journal_mode = WAL")
+                target.close()
+                target = None
+        except BaseException:
+            target.close()
+            raise
+        recommender.share_index(path, self.source)
+        with self._lock:
+            self._clones[path] = target
+        return path
+
+    def drop(self, path: str):
+        """Remove a clone: its pooled connections, its catalog and its data (or database file)."""
+        database.release(path)
+        catalog.close_catalog(path)
+        recommender.share_index(path, None)
+        with self._lock:
+            conn = self._clones.pop(path, None)
+        if conn is not None:
+            conn.close()
+        elif not path.startswith("file:"):
+            setup.remove_database(path)
+
+    @contextmanager
+    def isolated(self, path: Optional[str] = None) -> Iterator[str]:
+        """Run the block on a fresh clone (in memory unless a path is given) bound to the current run,
+           then drop the clone.
+        """
+        clone = self.clone(path)
+        try:
+            with database.use_database(clone):
+                yield clone
+        finally:
+            self.drop(clone)
+
+    def close(self):
+        """Drop every clone and the template."""
+        with self._lock:
+            clones = list(self._clones)
+        for path in clones:
+            self.drop(path)
+        self._conn.close()
+        if self._cleanup is not None:
+            self._cleanup()
+
+    def __enter__(self) -> "DatabaseTemplate":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time clones of a template database against a full CSV build.")
+    parser.add_argument("--clones", type=int, default=100, help="Number of clones of each kind (default: 100).")
+    parser.add_argument("--source", default=None,
+                        help="Database file to use as the template (default: built from the CSV file).")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        start = time.perf_counter()
+        setup.build_database(os.path.join(workdir, "build.sqlite"), setup.csv_file)
+        build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        template = DatabaseTemplate(args.source)
+        created = time.perf_counter() - start
+        with template:
+            timings = {"memory": [], "file": []}
+            for i in range(args.clones):
+                for kind, path in (("memory", None), ("file", os.path.join(workdir, f"clone-{i}.sqlite"))):
+                    start = time.perf_counter()
+                    with template.isolated(path):
+                        timings[kind].append(time.perf_counter() - start)
+                        database.get_connection().execute("SELECT COUNT(*) FROM products").fetchone()
+
+    print(f"setup.py build: {build * 1000:.1f} ms, template: {created * 1000:.1f} ms")
+    for kind, values in timings.items():
+        values.sort()
+        print(f"{kind} clone: p50 {values[len(values) // 2] * 1000:.2f} ms, max {values[-1] * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
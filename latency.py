@@ -0,0 +1,30 @@
+import math
+
+'''
+    This is a module that summarizes latency samples the same way in every report: benchmark.py, loadtest.py and
+    the replays of chatbot.py print p50/p95/p99 computed here, so their numbers can be compared with each other.
+'''
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    # Nearest rank: the smallest value with at least q of the values at or below it (the rounding drops the
+    # float noise of q * n, e.g. 0.07 * 100 = 7.000000000000001)
+    index = min(len(sorted_values) - 1, max(0, math.ceil(round(q * len(sorted_values), 9)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: list[float]) -> dict:
+    """Latency percentiles in milliseconds and throughput in calls per second."""
+    values = sorted(latencies)
+    total = sum(values)
+    return {
+        "calls": len(values),
+        "p50_ms": percentile(values, 0.50) * 1000,
+        "p95_ms": percentile(values, 0.95) * 1000,
+        "p99_ms": percentile(values, 0.99) * 1000,
+        "mean_ms": total / len(values) * 1000 if values else 0.0,
+        "throughput_per_s": len(values) / total if total else 0.0,
+    }
@@ -0,0 +1,325 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Any, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+import cart_store
+import database
+import setup
+import telemetry
+from assistant import RetryPolicy
+from latency import summarize
+from chatbot import build_graph, denial_messages
+from db_template import DatabaseTemplate
+from tools import TOOL_FLIGHT
+from checkpointer import SQLiteCheckpointSaver
+from response_cache import ResponseCache
+from result_format import DEFAULT_FORMAT, FORMATS
+from router import FastPathRouter
+from singleflight import SingleFlight
+from stub_llm import StubChatModel
+
+'''
+    This is a script that runs many concurrent shopping conversations through the chatbot graph, with the
+    deterministic stub model of stub_llm.py in place of Ollama (so it runs offline and the results are repeatable).
+    Every session is one thread_id working through a scripted conversation, approving (or sometimes denying)
+    the add/remove cart interrupts like a user would. It reports the latency of every graph node, turns/sec
+    and how often the SQLite writers had to wait for the write lock.
+
+    Example:
+        python loadtest.py --sessions 32 --rounds 4 --latency 0.2 --token-latency 0.01
+'''
+
+# Scripted conversations: each session picks one per round
+SCRIPTS = [
+    [
+        "Hi there",
+        "What categories do you have?",
+        "Recommend moisturizers for dry skin",
+        "Add product 1 to my cart",
+        "Show my cart",
+        "What is your return policy?",
+    ],
+    [
+        "Search for vitamin c serum",
+        "Add product 14 to my cart",
+        "Add product 27 to my cart",
+        "Remove product 14 from my cart",
+        "View my cart",
+    ],
+    [
+        "How long does delivery take?",
+        "Recommend sunscreens for sensitive skin",
+        "Add product 40 to my cart",
+        "What payment methods do you accept?",
+        "Show my cart",
+    ],
+    [
+        "Find a gentle cleanser",
+        "Recommend cleansers for oily skin",
+        "Add product 30 to my cart",
+        "Remove product 30 from my cart",
+        "What is your shipping policy?",
+    ],
+]
+
+
+class NodeTimer(BaseCallbackHandler):
+    """Callback handler that records the duration of every graph node run."""
+
+    def __init__(self):
+        self.durations = {}
+        self._starts = {}
+        self._lock = threading.Lock()
+
+    def on_chain_start(
+        self,
+        serialized: dict[str, Any],
+        inputs: dict[str, Any],
+        *,
+        run_id: UUID,
+        metadata: Optional[dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> Any:
+        # A node run is the chain named after the node it belongs to
+        if metadata and kwargs.get("name") == metadata.get("langgraph_node"):
+            self._starts[run_id] = (metadata["langgraph_node"], time.perf_counter())
+
+    def _stop(self, run_id: UUID):
+        start = self._starts.pop(run_id, None)
+        if start is not None:
+            node, started = start
+            with self._lock:
+                self.durations.setdefault(node, []).append(time.perf_counter() - started)
+
+    def on_chain_end(self, outputs: Any, *, run_id: UUID, **kwargs: Any) -> Any:
+        self._stop(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> Any:
+        self._stop(run_id)
+
+
+def run_turn(graph, user_input: str, config: dict, rng: random.Random, deny_rate: float) -> int:
+    """Send one user message and answer every approval interrupt. Returns the number of interrupts."""
+    graph.invoke({"messages": ("user", user_input)}, config)
+    interrupts = 0
+    snapshot = graph.get_state(config)
+    while snapshot.next:
+        interrupts += 1
+        if rng.random() < deny_rate:
+            graph.invoke({"messages": denial_messages(snapshot.values["messages"], "changed my mind")}, config)
+        else:
+            graph.invoke(None, config)
+        snapshot = graph.get_state(config)
+    return interrupts
+
+
+def run_session(
+    graph, session: int, rounds: int, timer: NodeTimer, seed: int, deny_rate: float,
+    template: Optional[DatabaseTemplate] = None,
+) -> dict:
+    """Run `rounds` scripted conversations, each on a new thread_id (and on its own clone of the template,
+       if there is one).
+    """
+    rng = random.Random(seed * 100_003 + session)
+    turns, interrupts, errors = [], 0, 0
+    for round_ in range(rounds):
+        thread_id = f"load-{session:04d}-{round_:04d}"
+        config = {
+            "configurable": {"thread_id": thread_id, "user_id": thread_id},
+            "callbacks": [timer] + telemetry.callbacks(),
+        }
+        with template.isolated() if template is not None else nullcontext():
+            for user_input in rng.choice(SCRIPTS):
+                start = time.perf_counter()
+                try:
+                    interrupts += run_turn(graph, user_input, config, rng, deny_rate)
+                except Exception as e:
+                    errors += 1
+                    print(f"[session {session}] {type(e).__name__}: {e}", file=sys.stderr)
+                turns.append(time.perf_counter() - start)
+    return {"turns": turns, "interrupts": interrupts, "errors": errors}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrent end-to-end load test of the chatbot graph (stub LLM).")
+    parser.add_argument("--sessions", type=int, default=16, help="Number of concurrent sessions (default: 16).")
+    parser.add_argument("--rounds", type=int, default=2,
+                        help="Scripted conversations per session, each on a new thread_id (default: 2).")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Stub LLM delay before the first token, in seconds (default: 0.05).")
+    parser.add_argument("--token-latency", type=float, default=0.0,
+                        help="Stub LLM delay per generated token, in seconds (default: 0).")
+    parser.add_argument("--deny-rate", type=float, default=0.1,
+                        help="Fraction of the cart approvals that are denied (default: 0.1).")
+    parser.add_argument("--checkpointer", choices=["memory", "sqlite"], default="memory",
+                        help="Checkpointer used by the graph (default: memory).")
+    parser.add_argument("--db", default=None,
+                        help="Products database to use (default: a fresh copy built from skincare_products.csv). "
+                             "The carts of the load test are written to it.")
+    parser.add_argument("--empty-rate", type=float, default=0.0,
+                        help="Share of (stub) LLM calls answered with an empty message (default: 0).")
+    parser.add_argument("--llm-attempts", type=int, default=3,
+                        help="LLM calls per turn when the responses are empty (default: 3).")
+    parser.add_argument("--llm-timeout", type=float, default=0.0,
+                        help="Seconds one LLM call may take (default: 0 = no limit).")
+    parser.add_argument("--fallback", action="store_true",
+                        help="Answer exhausted turns with a second stub model instead of the canned response.")
+    parser.add_argument("--cart-shards", type=int, default=0,
+                        help="Spread the carts over this many SQLite files by user (default: 0 = one table).")
+    parser.add_argument("--isolated", action="store_true",
+                        help="Run every scripted conversation on its own in-memory copy of the database "
+                             "(cloned from a template, so the conversations do not share carts or stock).")
+    parser.add_argument("--no-fast-path", action="store_true", help="Send every question to the (stub) LLM.")
+    parser.add_argument("--no-single-flight", action="store_true",
+                        help="Do not share one LLM call between concurrent turns sending the same prompt.")
+    parser.add_argument("--response-cache", action="store_true",
+                        help="Put an (in-memory) response cache in front of the stub LLM.")
+    parser.add_argument("--tool-result-format", choices=FORMATS, default=DEFAULT_FORMAT,
+                        help="Format of the tool results in the conversation (default: table).")
+    parser.add_argument("--context-tokens", type=int, default=3000, help="History token budget (default: 3000).")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0).")
+    parser.add_argument("--output", default=None, help="Write the results to this JSON file.")
+    parser.add_argument("--trace", default=None, help="Append the spans of every turn to this JSONL file.")
+    parser.add_argument("--metrics", default=None, help="Write Prometheus/OpenMetrics metrics to this file.")
+    args = parser.parse_args(argv)
+    if args.trace or args.metrics:
+        telemetry.enable(args.trace)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = args.db
+        if db_path is None:
+            db_path = os.path.join(workdir, "loadtest.sqlite")
+            setup.build_database(db_path, setup.csv_file)
+        database.configure(db_path)
+        cart_store.configure(args.cart_shards, db_path)
+        database.reset_lock_stats()
+
+        checkpointer = None
+        if args.checkpointer == "sqlite":
+            checkpointer = SQLiteCheckpointSaver(os.path.join(workdir, "checkpoints.sqlite"))
+
+        llm = StubChatModel(latency=args.latency, token_latency=args.token_latency, empty_rate=args.empty_rate)
+        retry_policy = RetryPolicy(max_attempts=args.llm_attempts, call_timeout=args.llm_timeout or None)
+        fallback_llm = StubChatModel(latency=args.latency, token_latency=args.token_latency) if args.fallback else None
+        router = None if args.no_fast_path else FastPathRouter()
+        response_cache = ResponseCache() if args.response_cache else None
+        single_flight = None if args.no_single_flight else SingleFlight("assistant")
+        graph = build_graph(
+            llm,
+            checkpointer=checkpointer,
+            router=router,
+            context_tokens=args.context_tokens,
+            response_cache=response_cache,
+            result_format=args.tool_result_format,
+            retry_policy=retry_policy,
+            fallback_llm=fallback_llm,
+            single_flight=single_flight,
+        )
+        timer = NodeTimer()
+        template = DatabaseTemplate(db_path) if args.isolated else None
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+            sessions = list(executor.map(
+                lambda session: run_session(
+                    graph, session, args.rounds, timer, args.seed, args.deny_rate, template
+                ),
+                range(args.sessions),
+            ))
+        elapsed = time.perf_counter() - start
+        if template is not None:
+            template.close()
+
+        turns = [latency for session in sessions for latency in session["turns"]]
+        results = {
+            "sessions": args.sessions,
+            "rounds": args.rounds,
+            "llm_latency": args.latency,
+            "llm_token_latency": args.token_latency,
+            "checkpointer": args.checkpointer,
+            "cart_shards": args.cart_shards,
+            "isolated": args.isolated,
+            "elapsed_s": elapsed,
+            "turns": len(turns),
+            "turns_per_second": len(turns) / elapsed if elapsed else 0.0,
+            "interrupts": sum(session["interrupts"] for session in sessions),
+            "errors": sum(session["errors"] for session in sessions),
+            "turn_latency": summarize(turns),
+            "nodes": {node: summarize(durations) for node, durations in sorted(timer.durations.items())},
+            "sqlite": database.lock_stats(),
+            "llm_retries": retry_policy.stats(),
+            "single_flight": {"tools": TOOL_FLIGHT.stats()},
+        }
+        if single_flight is not None:
+            results["single_flight"]["assistant"] = single_flight.stats()
+        if router is not None:
+            results["fast_path"] = router.stats()
+        if response_cache is not None:
+            results["response_cache"] = response_cache.stats()
+
+        if checkpointer is not None:
+            checkpointer.close()
+        cart_store.close_all()
+        database.close_all()
+
+    print(
+        f"{results['turns']} turns in {elapsed:.2f}s ({results['turns_per_second']:.1f} turns/s), "
+        f"{results['interrupts']} approval interrupts, {results['errors']} errors"
+    )
+    turn = results["turn_latency"]
+    print(f"Turn latency: p50 {turn['p50_ms']:.1f} ms, p95 {turn['p95_ms']:.1f} ms, p99 {turn['p99_ms']:.1f} ms")
+    print(f"\n  {'node':<22} {'runs':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for node, stats in results["nodes"].items():
+        print(f"  {node:<22} {stats['calls']:>7} {stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f}")
+    lock = results["sqlite"]
+    print(
+        f"\nSQLite: {lock['transactions']} write transactions, {lock['lock_waits']} waited for the write lock "
+        f"({lock['lock_wait_seconds'] * 1000:.1f} ms in total), {lock['lock_timeouts']} lock timeouts"
+    )
+
+    retries = results["llm_retries"]
+    if retries["retries"] or retries["timeouts"]:
+        print(
+            f"LLM: {retries['llm_calls']} calls, {retries['retries']} empty responses retried "
+            f"({retries['wasted_tokens']} tokens wasted), {retries['timeouts']} timeouts, "
+            f"{retries['fallbacks']} fallbacks, {retries['canned']} canned answers, "
+            f"{retries['retry_seconds']:.2f}s added by retries"
+        )
+
+    for name, flight in results["single_flight"].items():
+        print(
+            f"Single flight ({name}): {flight['executions']} executions, {flight['shared']} identical concurrent "
+            f"calls shared one ({flight['shared_rate']:.0%}), {flight['timeouts']} waiter timeouts, "
+            f"{flight['errors']} errors"
+        )
+
+    if "response_cache" in results:
+        cache = results["response_cache"]
+        print(
+            f"Response cache: {cache['exact_hits']} exact and {cache['similar_hits']} similar hits, "
+            f"{cache['misses']} misses, {cache['skipped']} not cacheable (hit rate {cache['hit_rate']:.0%})"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.metrics:
+        telemetry.get_telemetry().write_metrics(args.metrics)
+    telemetry.disable()
+    return 1 if results["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,289 @@
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import time
+import zlib
+from typing import Iterator, Optional
+
+import numpy as np
+
+'''
+    This is a module with the recommendation index of the get_recommendations tool. setup.py builds it next to
+    the database file ("skincare.recommender/"): a TF-IDF matrix over hashed word and bigram features of the
+    product names and descriptions, stored term by term (an inverted index of L2-normalized weights) as NumPy
+    files. The tool memory-maps the files, so only the postings of the query terms are ever read.
+
+    A query is scored with vectorized cosine similarity: products are stored grouped by category, so the
+    postings of a query term within the category are one slice, and they are summed per product with NumPy. Products are yielded best first, followed by the rest of the
+    category, so the caller can skip products that are out of stock (stock changes too often to be indexed).
+'''
+
+# Number of hashed features (a power of two; collisions only add a little noise to the scores)
+DIMENSIONS = 2 ** 18
+
+# Rows read from the products table at a time while building
+BUILD_CHUNK_SIZE = 50_000
+
+# Name words count twice as much as description words
+NAME_WEIGHT = 2
+
+# Memoized query terms kept per index
+HASH_CACHE_SIZE = 100_000
+
+# Memoized name and description texts while building (catalogs repeat them a lot)
+TEXT_CACHE_SIZE = 200_000
+
+_ARRAYS = ("product_ids", "category_ptr", "term_ptr", "postings_doc", "postings_weight", "idf")
+
+
+def index_path(db_path: str) -> str:
+    """Directory of the recommendation index of a database file."""
+    return os.path.splitext(db_path)[0] + ".recommender"
+
+
+def _words(text: Optional[str]) -> list[str]:
+    # Light stemming: plurals match their singular ("moisturizers" -> "moisturizer")
+    return [
+        word[:-1] if len(word) > 3 and word.endswith("s") and not word.endswith("ss") else word
+        for word in re.findall(r"\w+", (text or "").lower())
+    ]
+
+
+def _category_key(category: Optional[str]) -> str:
+    # "Moisturizer" finds the "Moisturizers" category
+    return " ".join(_words(category))
+
+
+def _terms(words: list[str]) -> list[str]:
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+class _Hasher:
+    """Memoized term -> feature index (the vocabulary is small next to the number of terms hashed)."""
+
+    def __init__(self, dimensions: int, max_size: Optional[int] = None):
+        self.dimensions = dimensions
+        self.max_size = max_size
+        self._cache = {}
+
+    def __call__(self, term: str) -> int:
+        index = self._cache.get(term)
+        if index is None:
+            if self.max_size is not None and len(self._cache) >= self.max_size:
+                self._cache.clear()
+            index = self._cache[term] = zlib.crc32(term.encode("utf-8")) % self.dimensions
+        return index
+
+
+def build_index(conn, path: str, dimensions: int = DIMENSIONS, chunk_size: int = BUILD_CHUNK_SIZE) -> int:
+    """Build the recommendation index of the products table into the directory path. Returns the product count."""
+    hasher = _Hasher(dimensions)
+    text_features, category_of = {}, {}
+    product_ids, category_codes, category_names = [], [], {}
+    docs, features, frequencies = [], [], []
+    document_frequency = np.zeros(dimensions, dtype=np.int64)
+
+    try:
+        catalog_version = conn.execute("SELECT version FROM catalog_version").fetchone()[0]
+    except Exception:
+        catalog_version = None
+
+    cursor = conn.execute(
+        "SELECT product_id, product_name, description, category FROM products ORDER BY product_id"
+    )
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        first_row = len(product_ids)
+        chunk_docs, chunk_features = [], []
+        for i, (product_id, name, description, category) in enumerate(rows):
+            product_ids.append(product_id)
+            code = category_of.get(category)
+            if code is None:
+                code = category_of[category] = category_names.setdefault(_category_key(category), len(category_names))
+            category_codes.append(code)
+
+            if len(text_features) >= TEXT_CACHE_SIZE:
+                text_features.clear()
+            name_features = text_features.get(name)
+            if name_features is None:
+                name_features = text_features[name] = [hasher(term) for term in _terms(_words(name))]
+            description_features = text_features.get(description)
+            if description_features is None:
+                description_features = text_features[description] = [
+                    hasher(term) for term in _terms(_words(description))
+                ]
+            chunk_docs.extend([i] * (len(name_features) * NAME_WEIGHT + len(description_features)))
+            chunk_features.extend(name_features * NAME_WEIGHT)
+            chunk_features.extend(description_features)
+
+        # Term frequencies of every (product, feature) pair of the chunk
+        keys = np.asarray(chunk_docs, dtype=np.int64) * dimensions + np.asarray(chunk_features, dtype=np.int64)
+        keys, counts = np.unique(keys, return_counts=True)
+        chunk_feature = keys % dimensions
+        docs.append((keys // dimensions + first_row).astype(np.int32))
+        features.append(chunk_feature.astype(np.int32))
+        frequencies.append(counts.astype(np.float32))
+        document_frequency += np.bincount(chunk_feature, minlength=dimensions)
+    cursor.close()
+
+    count = len(product_ids)
+    doc = np.concatenate(docs) if docs else np.zeros(0, dtype=np.int32)
+    feature = np.concatenate(features) if features else np.zeros(0, dtype=np.int32)
+    frequency = np.concatenate(frequencies) if frequencies else np.zeros(0, dtype=np.float32)
+
+    # Sublinear TF times smoothed IDF, L2-normalized per product
+    idf = (np.log((1.0 + count) / (1.0 + document_frequency)) + 1.0).astype(np.float32)
+    weight = (1.0 + np.log(frequency)) * idf[feature]
+    norms = np.sqrt(np.bincount(doc, weights=weight.astype(np.float64) ** 2, minlength=count))
+    weight = (weight / np.maximum(norms[doc], 1e-12)).astype(np.float32)
+
+    # Rows are grouped by category (in product id order within one), so a category is a contiguous range of rows
+    categories = np.asarray(category_codes, dtype=np.int32)
+    order = np.argsort(categories, kind="stable")
+    row_of = np.empty(count, dtype=np.int32)
+    row_of[order] = np.arange(count, dtype=np.int32)
+    category_ptr = np.zeros(len(category_names) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(categories, minlength=len(category_names)), out=category_ptr[1:])
+
+    # Postings grouped by feature, sorted by row within a feature
+    doc = row_of[doc]
+    postings = np.lexsort((doc, feature))
+    term_ptr = np.zeros(dimensions + 1, dtype=np.int64)
+    np.cumsum(np.bincount(feature, minlength=dimensions), out=term_ptr[1:])
+
+    arrays = {
+        "product_ids": np.asarray(product_ids, dtype=np.int64)[order],
+        "category_ptr": category_ptr,
+        "term_ptr": term_ptr,
+        "postings_doc": doc[postings],
+        "postings_weight": weight[postings],
+        "idf": idf,
+    }
+    meta = {
+        "dimensions": dimensions,
+        "products": count,
+        "categories": sorted(category_names, key=category_names.get),
+        "catalog_version": catalog_version,
+        "built": time.time(),
+    }
+
+    # Write into a new directory and swap it in, so readers never see a half written index
+    building = path + ".building"
+    shutil.rmtree(building, ignore_errors=True)
+    os.makedirs(building)
+    for name in _ARRAYS:
+        np.save(os.path.join(building, f"{name}.npy"), arrays[name])
+    with open(os.path.join(building, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    remove_index(path)
+    os.rename(building, path)
+    return count
+
+
+def remove_index(path: str):
+    shutil.rmtree(path, ignore_errors=True)
+
+
+class Recommender:
+    """Memory-mapped recommendation index built by build_index()."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.dimensions = self.meta["dimensions"]
+        self.category_codes = {name: code for code, name in enumerate(self.meta["categories"])}
+        for name in _ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r"))
+        self._hasher = _Hasher(self.dimensions, HASH_CACHE_SIZE)
+
+    def scores(self, category: str, description: str) -> tuple[int, np.ndarray]:
+        """Return (first row, cosine similarities) of the products of the category, in row order."""
+        code = self.category_codes.get(_category_key(category))
+        if code is None:
+            return 0, np.zeros(0)
+        first, last = int(self.category_ptr[code]), int(self.category_ptr[code + 1])
+        scores = np.zeros(last - first)
+
+        terms = {}
+        for term in _terms(_words(description)):
+            feature = self._hasher(term)
+            terms[feature] = terms.get(feature, 0) + 1
+        for feature, frequency in terms.items():
+            start, end = int(self.term_ptr[feature]), int(self.term_ptr[feature + 1])
+            if start == end:
+                continue
+            # Postings are sorted by row: the ones of the category are a contiguous slice
+            postings = self.postings_doc[start:end]
+            low, high = np.searchsorted(postings, (first, last))
+            if low == high:
+                continue
+            query_weight = (1.0 + math.log(frequency)) * float(self.idf[feature])
+            # Dot products with the query vector (its norm is the same for every product, so it is left out)
+            scores += np.bincount(
+                postings[low:high] - first,
+                weights=self.postings_weight[start + low:start + high] * query_weight,
+                minlength=last - first,
+            )
+        return first, scores
+
+    def ranked(self, category: str, description: str, batch: int = 32) -> Iterator[list[int]]:
+        """Yield product ids of the category in batches, best match first (ties by product id). The products
+           that match no term of the description follow in product id order.
+        """
+        first, scores = self.scores(category, description)
+        matched = np.flatnonzero(scores > 0)
+        if len(matched) > batch:
+            # Only the first batch is needed most of the time: select it without sorting everything
+            top = matched[np.argpartition(-scores[matched], batch - 1)[:batch]]
+            top = top[np.lexsort((top, -scores[top]))]
+            yield self.product_ids[first + top].tolist()
+            matched = np.setdiff1d(matched, top, assume_unique=True)
+        if len(matched):
+            matched = matched[np.lexsort((matched, -scores[matched]))]
+            for start in range(0, len(matched), batch):
+                yield self.product_ids[first + matched[start:start + batch]].tolist()
+
+        unmatched = np.flatnonzero(scores == 0)
+        for start in range(0, len(unmatched), batch):
+            yield self.product_ids[first + unmatched[start:start + batch]].tolist()
+
+
+# One index per database file, reloaded when setup.py rebuilds it
+_recommenders = {}
+_recommenders_lock = threading.Lock()
+
+# Databases that use the index of another database file (clones of a template: the index is read-only)
+_shared_indexes = {}
+
+
+def share_index(db_path: str, source_db_path: Optional[str]):
+    """Let db_path use the recommendation index of source_db_path (None stops sharing)."""
+    with _recommenders_lock:
+        if source_db_path is None:
+            _shared_indexes.pop(db_path, None)
+        else:
+            _shared_indexes[db_path] = _shared_indexes.get(source_db_path) or index_path(source_db_path)
+
+
+def get_recommender(db_path: str) -> Optional[Recommender]:
+    """Return the recommendation index of a database file (None if setup.py has not built one)."""
+    path = _shared_indexes.get(db_path) or index_path(db_path)
+    try:
+        modified = os.stat(os.path.join(path, "meta.json")).st_mtime_ns
+    except OSError:
+        return None
+    with _recommenders_lock:
+        entry = _recommenders.get(path)
+        if entry is None or entry[0] != modified:
+            try:
+                entry = _recommenders[path] = (modified, Recommender(path))
+            except (OSError, ValueError):
+                # Being rebuilt right now
+                return None
+        return entry[1]
@@ -0,0 +1,330 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import numpy as np
+from langchain_core.messages import AIMessage, AnyMessage, HumanMessage, ToolMessage, message_to_dict, messages_from_dict
+
+import telemetry
+
+'''
+    This is a module that caches LLM responses for near-identical customer turns ("hi", "what payment methods do
+    you take?"). The key is the normalized context of the current turn: the answer the assistant gave just before
+    it (as a digest), the user message and the tool calls and results that followed it. An exact tier matches that
+    key; a similarity tier (TF-IDF over hashed word and bigram features, cosine similarity computed with NumPy)
+    matches user messages worded slightly differently after the same previous answer.
+
+    Only responses that do not depend on cart or stock state are cached: cart changes are never cached, and an
+    answer written from tool results is only cached if every result came from a static tool (policies, payment
+    methods, categories). Messages that refer back to the conversation ("add it", "tell me more") are never
+    cached either (nor replies such as "yes please"), since their answer depends on the history. Every entry records the catalog version it was
+    created at and is dropped when the products change.
+'''
+
+# Tools whose results depend neither on the cart nor on stock (or time): answers written from them can be cached
+STATIC_TOOLS = {"get_product_categories", "get_returns_policy", "get_shipping_policy", "get_payment_methods"}
+
+# Tools whose calls must never be replayed from the cache
+CART_TOOLS = {"add_to_cart", "remove_from_cart"}
+
+# Words that refer to earlier turns or answer the assistant: the answer depends on the history, not only on
+# the message
+REFERENCES = re.compile(
+    r"\b(it|its|that|this|these|those|them|they|one|ones|more|same|again|another|above|previous|first|second|"
+    r"third|last|else|instead|yes|yeah|yep|yup|no|nope|ok|okay|sure|the (product|item|price|cart))\b"
+)
+
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS responses (
+        key TEXT PRIMARY KEY,
+        query TEXT,
+        response TEXT NOT NULL,
+        version TEXT,
+        created REAL NOT NULL
+    )
+"""
+
+
+def normalize(text: str) -> str:
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+def _text(message: AnyMessage) -> str:
+    return message.content if isinstance(message.content, str) else json.dumps(message.content)
+
+
+def current_turn(messages: list[AnyMessage]) -> list[AnyMessage]:
+    """Return the messages of the current turn (from the last user message on)."""
+    for i in range(len(messages) - 1, -1, -1):
+        if isinstance(messages[i], HumanMessage):
+            return messages[i:]
+    return []
+
+
+def previous_answer(messages: list[AnyMessage]) -> str:
+    """Digest of the last AI message before the current turn ("start" at the start of a conversation): the same
+       user message can mean something else after another answer.
+    """
+    turn = current_turn(messages)
+    for message in reversed(messages[:len(messages) - len(turn)]):
+        if isinstance(message, AIMessage):
+            text = normalize(_text(message)) + json.dumps(
+                [[call["name"], call["args"]] for call in message.tool_calls], sort_keys=True
+            )
+            return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+    return "start"
+
+
+class ResponseCache:
+    """Exact and similarity cache of LLM responses, bounded by LRU and TTL eviction.
+
+    Args:
+        path (str): SQLite file the entries are persisted to (None keeps them in memory only).
+        max_entries (int): Maximum number of cached responses (least recently used are evicted first).
+        ttl_seconds (float): Entries older than this are expired.
+        threshold (float): Minimum cosine similarity for the similarity tier (1.0 disables it).
+        dimensions (int): Number of hashed TF-IDF features.
+        version (Callable): Returns the current catalog version; entries from another version are dropped.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_entries: int = 2048,
+        ttl_seconds: float = 3600.0,
+        threshold: float = 0.85,
+        dimensions: int = 2048,
+        version: Optional[Callable[[], object]] = None,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self.dimensions = dimensions
+        self.version = version
+        self._lock = threading.Lock()
+
+        # key -> (query, response dict, version, created, matrix row or None)
+        self._entries = OrderedDict()
+        # Term frequency rows of the entries that take part in the similarity tier
+        self._matrix = np.zeros((max_entries, dimensions), dtype=np.float32)
+        self._active = np.zeros(max_entries, dtype=bool)
+        # Previous answer digest of every row (see previous_answer()), to pick the candidates in one comparison
+        self._contexts = np.zeros(max_entries, dtype="U16")
+        self._document_frequency = np.zeros(dimensions, dtype=np.float32)
+        self._free_rows = list(range(max_entries - 1, -1, -1))
+        self._row_keys = {}
+        self.counts = {"exact_hits": 0, "similar_hits": 0, "misses": 0, "skipped": 0, "stores": 0, "evictions": 0}
+
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute(SCHEMA_SQL)
+            self._load()
+
+    # Features
+
+    def _features(self, query: str) -> np.ndarray:
+        """Hashed term frequencies of the words and word bigrams of a normalized query."""
+        words = query.split()
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for term in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            vector[zlib.crc32(term.encode("utf-8")) % self.dimensions] += 1.0
+        return vector
+
+    def _idf(self) -> np.ndarray:
+        documents = float(self._active.sum())
+        return np.log((1.0 + documents) / (1.0 + self._document_frequency)) + 1.0
+
+    # Keys
+
+    def _key(self, messages: list[AnyMessage]) -> Optional[tuple[str, Optional[str]]]:
+        """Return (exact key, query for the similarity tier) for the current turn, or None if it is not cacheable.
+           The similarity tier only applies to the first LLM call of a turn (no tool results yet). The key starts
+           with the digest of the previous answer (see previous_answer()).
+        """
+        turn = current_turn(messages)
+        if not turn or not isinstance(turn[0].content, str):
+            return None
+        query = normalize(turn[0].content)
+        if not query or REFERENCES.search(query):
+            return None
+
+        parts = [previous_answer(messages), query]
+        for message in turn[1:]:
+            if isinstance(message, ToolMessage):
+                if message.name not in STATIC_TOOLS:
+                    return None
+                parts.append(f"{message.name}={normalize(_text(message))}")
+            elif isinstance(message, AIMessage):
+                if any(call["name"] not in STATIC_TOOLS for call in message.tool_calls):
+                    return None
+                parts.extend(f"call {call['name']} {json.dumps(call['args'], sort_keys=True)}" for call in message.tool_calls)
+            else:
+                # e.g. the "Respond with a real output." retry prompt
+                return None
+        return " | ".join(parts), (query if len(turn) == 1 else None)
+
+    @staticmethod
+    def _context(key: str) -> str:
+        # The previous answer digest the key starts with
+        return key.split(" | ", 1)[0]
+
+    def _current_version(self) -> Optional[str]:
+        return None if self.version is None else str(self.version())
+
+    # Entries
+
+    def _remove(self, key: str):
+        query, response, version, created, row = self._entries.pop(key)
+        if row is not None:
+            self._document_frequency -= self._matrix[row] > 0
+            self._matrix[row] = 0
+            self._active[row] = False
+            self._contexts[row] = ""
+            self._free_rows.append(row)
+            del self._row_keys[row]
+
+    def _add(self, key: str, query: Optional[str], response: dict, version: Optional[str], created: float):
+        if key in self._entries:
+            self._remove(key)
+        while len(self._entries) >= self.max_entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.counts["evictions"] += 1
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (oldest,))
+
+        row = None
+        if query is not None and self.threshold < 1.0:
+            row = self._free_rows.pop()
+            self._matrix[row] = self._features(query)
+            self._active[row] = True
+            self._contexts[row] = self._context(key)
+            self._document_frequency += self._matrix[row] > 0
+            self._row_keys[row] = key
+        self._entries[key] = (query, response, version, created, row)
+
+    def _load(self):
+        """Load the persisted entries that are still valid (the most recent ones if there are too many)."""
+        expired_before = time.time() - self.ttl_seconds
+        self._conn.execute("DELETE FROM responses WHERE created < ?", (expired_before,))
+        self._conn.commit()
+        rows = self._conn.execute(
+            "SELECT key, query, response, version, created FROM responses ORDER BY created DESC LIMIT ?",
+            (self.max_entries,),
+        ).fetchall()
+        for key, query, response, version, created in reversed(rows):
+            self._add(key, query, json.loads(response), version, created)
+
+    def _response(self, response: dict) -> AIMessage:
+        """Rebuild a cached response with fresh message and tool call ids (they must be unique per conversation)."""
+        message = messages_from_dict([response])[0]
+        message.id = f"cached-{uuid.uuid4()}"
+        for call in message.tool_calls:
+            call["id"] = f"call_{uuid.uuid4().hex[:24]}"
+        return message
+
+    def _count(self, result: str):
+        self.counts[result] += 1
+        current = telemetry.get_telemetry()
+        if current is not None:
+            current.count("skincare_response_cache_total", result=result)
+
+    def lookup(self, messages: list[AnyMessage]) -> Optional[AIMessage]:
+        """Return a cached response for this conversation, or None."""
+        key = self._key(messages)
+        if key is None:
+            with self._lock:
+                self._count("skipped")
+            return None
+        key, query = key
+        version = self._current_version()
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[2] == version and now - entry[3] <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self._count("exact_hits")
+                    return self._response(entry[1])
+                self._remove(key)
+
+            rows = ()
+            if query is not None and self.threshold < 1.0:
+                # Only entries written after the same previous answer are candidates
+                rows = np.flatnonzero(self._active & (self._contexts == self._context(key)))
+            if len(rows):
+                # Cosine similarity of the TF-IDF vectors, for all candidate entries at once
+                idf = self._idf()
+                weighted = self._matrix[rows] * idf
+                query_vector = self._features(query) * idf
+                norms = np.linalg.norm(weighted, axis=1) * np.linalg.norm(query_vector)
+                scores = weighted @ query_vector / np.maximum(norms, 1e-12)
+                best = int(np.argmax(scores))
+                row = int(rows[best])
+                if scores[best] > 0:
+                    candidate_key = self._row_keys[row]
+                    candidate = self._entries.get(candidate_key)
+                    # Numbers (product ids, quantities) must match exactly
+                    if (
+                        scores[best] >= self.threshold
+                        and candidate is not None
+                        and re.findall(r"\d+", candidate[0]) == re.findall(r"\d+", query)
+                        and candidate[2] == version
+                        and now - candidate[3] <= self.ttl_seconds
+                    ):
+                        self._entries.move_to_end(candidate_key)
+                        self._count("similar_hits")
+                        return self._response(candidate[1])
+
+            self._count("misses")
+            return None
+
+    def store(self, messages: list[AnyMessage], response: AIMessage):
+        """Cache the response the LLM gave for this conversation (if it does not depend on cart or stock)."""
+        key = self._key(messages)
+        if key is None or any(call["name"] in CART_TOOLS for call in response.tool_calls):
+            return
+        key, query = key
+        if any(call["name"] not in STATIC_TOOLS for call in response.tool_calls):
+            # Search and recommendation arguments come from the exact wording: no similarity matches for those
+            query = None
+        if not response.tool_calls and not (isinstance(response.content, str) and response.content.strip()):
+            return
+
+        data = message_to_dict(response)
+        data["data"].pop("usage_metadata", None)
+        data["data"].pop("response_metadata", None)
+        version = self._current_version()
+        created = time.time()
+        with self._lock:
+            self._add(key, query, data, version, created)
+            self.counts["stores"] += 1
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, query, response, version, created) VALUES (?, ?, ?, ?, ?)",
+                    (key, query, json.dumps(data), version, created),
+                )
+                self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.counts["exact_hits"] + self.counts["similar_hits"] + self.counts["misses"]
+            hits = self.counts["exact_hits"] + self.counts["similar_hits"]
+            return {**self.counts, "size": len(self._entries), "hit_rate": hits / lookups if lookups else 0.0}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,137 @@
+import argparse
+import json
+from typing import Any
+
+from langgraph.prebuilt.tool_node import msg_content_output
+
+'''
+    This is a module that formats tool results before they become ToolMessages. Every ToolMessage is sent to the
+    LLM again on later turns and stored in every checkpoint, and the product tools return lists of dicts that
+    repeat every key for every row. The "table" format writes such a list once as a header and value rows:
+
+        [{"product_id": 1, "product_name": "Cream"}, {"product_id": 2, "product_name": "Gel"}]
+        -> {"columns":["product_id","product_name"],"rows":[[1,"Cream"],[2,"Gel"]]}
+
+    The "json" format is the one of LangGraph's ToolNode. Run "python result_format.py" to measure how many
+    prompt tokens and checkpoint bytes the table format saves per conversation.
+'''
+
+FORMATS = ("table", "json")
+DEFAULT_FORMAT = "table"
+
+
+def tabulate(value: Any) -> Any:
+    """Replace (recursively) every list of two or more dicts with the same keys by columns and rows."""
+    if isinstance(value, list):
+        if len(value) > 1 and all(isinstance(item, dict) for item in value):
+            columns = list(value[0])
+            if all(list(item) == columns for item in value[1:]):
+                return {"columns": columns, "rows": [[tabulate(item[key]) for key in columns] for item in value]}
+        return [tabulate(item) for item in value]
+    if isinstance(value, dict):
+        return {key: tabulate(item) for key, item in value.items()}
+    return value
+
+
+def format_content(content: Any, result_format: str = DEFAULT_FORMAT) -> Any:
+    """Format the content of a tool result (a string, or the list/dict the tool returned) as a ToolMessage content."""
+    if result_format == "json":
+        return msg_content_output(content)
+
+    value = content
+    if isinstance(content, str):
+        # Dict results arrive already serialized to JSON by LangChain
+        try:
+            value = json.loads(content)
+        except ValueError:
+            return content
+    if not isinstance(value, (list, dict)):
+        return msg_content_output(content)
+    return json.dumps(tabulate(value), ensure_ascii=False, separators=(",", ":"))
+
+
+def measure(result_format: str, latency: float = 0.0) -> list[dict]:
+    """Replay the scripted conversations of loadtest.py with the stub model and return, per conversation,
+       the approximate tokens of its tool results, the prompt tokens sent to the LLM and the bytes of all
+       checkpoints written.
+    """
+    import os
+    import tempfile
+
+    from langchain_core.callbacks import BaseCallbackHandler
+    from langchain_core.messages import ToolMessage
+    from langgraph.checkpoint.memory import MemorySaver
+
+    import database
+    import setup
+    from chatbot import build_graph
+    from context import approximate_tokens
+    from loadtest import SCRIPTS
+    from stub_llm import StubChatModel
+
+    class PromptCounter(BaseCallbackHandler):
+        def __init__(self):
+            self.tokens = 0
+
+        def on_chat_model_start(self, serialized, messages, **kwargs):
+            self.tokens += sum(approximate_tokens(batch) for batch in messages)
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = os.path.join(workdir, "measure.sqlite")
+        setup.build_database(db_path, setup.csv_file)
+        database.configure(db_path)
+        checkpointer = MemorySaver()
+        # No fast path and no history trimming: every tool result reaches the LLM and the checkpoints
+        graph = build_graph(
+            StubChatModel(latency=latency), checkpointer=checkpointer, context_tokens=0, result_format=result_format
+        )
+        for index, script in enumerate(SCRIPTS):
+            counter = PromptCounter()
+            thread_id = f"measure-{result_format}-{index}"
+            config = {"configurable": {"thread_id": thread_id, "user_id": thread_id}, "callbacks": [counter]}
+            for user_input in script:
+                graph.invoke({"messages": ("user", user_input)}, config)
+                while graph.get_state(config).next:
+                    graph.invoke(None, config)
+            messages = graph.get_state(config).values["messages"]
+            checkpoint_bytes = sum(
+                len(checkpointer.serde.dumps_typed(saved.checkpoint)[1]) for saved in checkpointer.list(config)
+            )
+            results.append({
+                "conversation": index,
+                "tool_result_tokens": approximate_tokens([m for m in messages if isinstance(m, ToolMessage)]),
+                "prompt_tokens": counter.tokens,
+                "checkpoint_bytes": checkpoint_bytes,
+            })
+        database.close_all()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Measure the prompt tokens and checkpoint bytes of the tool result formats (stub LLM, offline)."
+    )
+    parser.parse_args(argv)
+
+    measured = {result_format: measure(result_format) for result_format in FORMATS}
+    columns = (("tool_result_tokens", "tool result tokens"), ("prompt_tokens", "prompt tokens"),
+               ("checkpoint_bytes", "checkpoint bytes"))
+    print(f"{'conversation':>12}" + "".join(f" {label + ' json/table':>30} {'saved':>7}" for _, label in columns))
+    for json_result, table_result in zip(measured["json"], measured["table"]):
+        line = f"{json_result['conversation']:>12}"
+        for key, _ in columns:
+            before, after = json_result[key], table_result[key]
+            line += f" {f'{before:,} / {after:,}':>30} {1 - after / before:>7.1%}"
+        print(line)
+
+    count = len(measured["json"])
+    print("\nSaved per conversation by the table format:")
+    for key, label in columns:
+        before = sum(result[key] for result in measured["json"]) / count
+        after = sum(result[key] for result in measured["table"]) / count
+        print(f"  {label}: {before - after:,.0f} ({1 - after / before:.1%})")
+
+
+if __name__ == "__main__":
+    main()
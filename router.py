@@ -0,0 +1,175 @@
+import json
+import re
+import threading
+import uuid
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langchain_core.tools import BaseTool
+
+from assistant import State
+from tools import (
+    get_product_categories,
+    get_delivery_time,
+    get_returns_policy,
+    get_shipping_policy,
+    get_payment_methods,
+)
+
+'''
+    This is a module that answers obvious questions about static data (policies, payment methods, delivery time and
+    product categories) without calling the LLM. A cheap regex matcher classifies the user message; when it is
+    confident, the tool is called directly and the answer is written from a template. Anything else falls through
+    to the LLM assistant.
+'''
+
+
+@dataclass
+class Intent:
+    name: str
+    tool: BaseTool
+    pattern: re.Pattern
+    template: Callable[[object], str]
+    # Intents this one wins against when both match (e.g. "how long does shipping take" asks for a delivery time)
+    overrides: tuple[str, ...] = ()
+
+
+def _returns_answer(result: dict) -> str:
+    return f"{result['policy']}\n\n{result['details']}"
+
+
+def _shipping_answer(result: dict) -> str:
+    return f"{result['policy']}\n\n{result['details']}"
+
+
+def _payment_answer(result: list) -> str:
+    return f"We accept the following payment methods: {', '.join(result)}."
+
+
+def _delivery_answer(result: dict) -> str:
+    return f"If you order today, your order is expected to be delivered by {result['expected_delivery_time']} (US/Eastern)."
+
+
+def _categories_answer(result: list) -> str:
+    return f"We carry the following product categories: {', '.join(result)}. Which one would you like to explore?"
+
+
+INTENTS = [
+    Intent(
+        "returns_policy",
+        get_returns_policy,
+        re.compile(r"\b(return(s|ing)?|refunds?|exchanges?)\b"),
+        _returns_answer,
+    ),
+    # Checked before the shipping policy: questions about when an order arrives are about the delivery time
+    Intent(
+        "delivery_time",
+        get_delivery_time,
+        re.compile(r"\b(deliver|delivery|delivered|arrive|arrives|arrival|how long|how soon|when will|get here)\b"),
+        _delivery_answer,
+        overrides=("shipping_policy",),
+    ),
+    Intent(
+        "shipping_policy",
+        get_shipping_policy,
+        re.compile(r"\b(shipping|ship|tracking)\b"),
+        _shipping_answer,
+    ),
+    Intent(
+        "payment_methods",
+        get_payment_methods,
+        re.compile(r"\b(pay|payment|payments|paying|apple pay|google pay|credit cards?|debit cards?)\b"),
+        _payment_answer,
+    ),
+    Intent(
+        "product_categories",
+        get_product_categories,
+        re.compile(r"\b(categor(y|ies)|kinds? of products|types? of products|what do you (sell|have|offer))\b"),
+        _categories_answer,
+    ),
+]
+
+# Words that mean the user wants more than the static answer (products, cart, ...): leave those to the LLM
+BLOCKERS = re.compile(
+    r"\b(cart|add|remove|recommend|suggest|search|find|show|looking for|buy|product \d+|serum|cream|cleanser|"
+    r"sunscreen|moisturi[sz]er|skin|and also|but)\b"
+)
+
+
+class FastPathRouter:
+    """Graph node that answers static intents directly and reports its hit rate.
+
+    Args:
+        threshold (float): Minimum confidence needed to answer without the LLM.
+        max_words (int): Longer messages get a lower confidence (they usually ask for more than one thing).
+    """
+
+    def __init__(self, intents: Optional[list[Intent]] = None, threshold: float = 0.8, max_words: int = 14):
+        self.intents = intents or INTENTS
+        self.threshold = threshold
+        self.max_words = max_words
+        self.hits = 0
+        self.misses = 0
+        self.hits_by_intent = {intent.name: 0 for intent in self.intents}
+        self._lock = threading.Lock()
+
+    def classify(self, text: str) -> tuple[Optional[Intent], float]:
+        """Return the matched intent (or None) and the confidence of the match."""
+        text = text.lower()
+        matches = [intent for intent in self.intents if intent.pattern.search(text)]
+        overridden = {name for intent in matches for name in intent.overrides}
+        matches = [intent for intent in matches if intent.name not in overridden]
+        if len(matches) != 1:
+            # Nothing matched, or the message asks about several things at once
+            return (None, 0.0) if not matches else (matches[0], 0.4)
+
+        confidence = 1.0
+        if len(text.split()) > self.max_words:
+            confidence -= 0.4
+        if BLOCKERS.search(text):
+            confidence -= 0.7
+        return matches[0], max(confidence, 0.0)
+
+    def __call__(self, state: State):
+        message = state["messages"][-1]
+        if not isinstance(message, HumanMessage) or not isinstance(message.content, str):
+            # e.g. resuming after a denied tool call: not a new user question
+            return {"messages": []}
+
+        intent, confidence = self.classify(message.content)
+        if intent is None or confidence < self.threshold:
+            with self._lock:
+                self.misses += 1
+            return {"messages": []}
+
+        result = intent.tool.invoke({})
+        with self._lock:
+            self.hits += 1
+            self.hits_by_intent[intent.name] += 1
+
+        # Record the tool call and its result like the LLM would, so later turns keep the full context
+        tool_call_id = f"fast_path_{uuid.uuid4().hex}"
+        return {
+            "messages": [
+                AIMessage(content="", tool_calls=[{"name": intent.tool.name, "args": {}, "id": tool_call_id}]),
+                ToolMessage(content=json.dumps(result), tool_call_id=tool_call_id, name=intent.tool.name),
+                AIMessage(content=intent.template(result)),
+            ]
+        }
+
+    def route(self, state: State) -> str:
+        """Conditional edge: finish the turn if the fast path answered, otherwise go to the LLM assistant."""
+        if isinstance(state["messages"][-1], AIMessage):
+            return "answered"
+        return "assistant"
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "hits_by_intent": dict(self.hits_by_intent),
+            }
@@ -0,0 +1,312 @@
+import argparse
+import asyncio
+import json
+import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langgraph.checkpoint.memory import MemorySaver
+
+import cart_store
+import telemetry
+import warmup
+from chatbot import (
+    SENSITIVE_TOOL_NAMES,
+    add_retry_arguments,
+    build_graph,
+    create_llm,
+    create_retry_policy,
+    denial_messages,
+    warmup_request,
+)
+from checkpointer import DEFAULT_CHECKPOINT_DB, SQLiteCheckpointSaver
+from database import close_all
+from result_format import DEFAULT_FORMAT, FORMATS
+from router import FastPathRouter
+from singleflight import SingleFlight
+from tool_executor import pending_tool_calls
+
+'''
+    This is a script that serves the chatbot to many users at once over a line protocol (one JSON object per line,
+    over TCP). Every connection is one conversation (its own thread_id) driven through the same compiled graph with
+    astream(), so a single process can serve hundreds of concurrent shoppers.
+
+    Client -> server:
+        {"type": "message", "text": "..."}          a user message (a plain text line works too)
+        {"type": "approve"}                          approve the pending cart change (or the plain line "y")
+        {"type": "deny", "reason": "..."}            deny it (any other plain line while an approval is pending;
+                                                     other requests get an error and leave it pending)
+        {"type": "metrics"}                          Prometheus/OpenMetrics text (when started with --trace/--metrics)
+        {"type": "quit"}
+
+    Server -> client:
+        {"type": "hello", "thread_id": "..."}
+        {"type": "token", "text": "..."}             answer tokens as they are generated
+        {"type": "approval_required", "tool_calls": [...]}
+        {"type": "answer", "text": "..."}            the final answer; the turn is over
+        {"type": "metrics", "text": "..."}
+        {"type": "error", "message": "..."}
+
+    Concurrency is bounded at three levels: --max-connections (new connections beyond it are turned away),
+    one turn at a time per connection (the next line is only read once the turn is over, so a client that sends
+    too fast is held back by TCP flow control), and --llm-concurrency LLM calls in flight. Writes wait for the
+    client to read (drain), so slow readers cannot make the server buffer without bound.
+'''
+
+# Longest accepted line, in bytes
+LINE_LIMIT = 64 * 1024
+
+
+class ChatServer:
+    """Line protocol server for one compiled chatbot graph.
+
+    Args:
+        graph: Graph built by chatbot.build_graph().
+        max_connections (int): Connections served at once; more are answered with an error and closed.
+        idle_timeout (float): Seconds a connection may stay silent (also while an approval is pending).
+        turn_timeout (float): Seconds the graph may run for a turn before it is abandoned (the time spent waiting
+            for the client to approve a cart change is not counted; idle_timeout bounds that).
+    """
+
+    def __init__(self, graph, max_connections: int = 500, idle_timeout: float = 600.0, turn_timeout: float = 300.0):
+        self.graph = graph
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.turn_timeout = turn_timeout
+        self.connections = 0
+        self.turns = 0
+        self.rejected = 0
+
+    async def _send(self, writer: asyncio.StreamWriter, payload: dict):
+        writer.write((json.dumps(payload) + "\n").encode("utf-8"))
+        # Backpressure: wait until the client has read what was sent so far
+        await writer.drain()
+
+    async def _read(self, reader: asyncio.StreamReader) -> Optional[dict]:
+        """Read one request (None when the client disconnected)."""
+        try:
+            line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+        except ValueError:
+            # readline() reports a line longer than the limit as a ValueError
+            raise asyncio.LimitOverrunError(f"Line longer than {LINE_LIMIT} bytes.", LINE_LIMIT)
+        if not line:
+            return None
+        text = line.decode("utf-8", errors="replace").strip()
+        try:
+            request = json.loads(text)
+            if isinstance(request, dict) and "type" in request:
+                return request
+        except ValueError:
+            pass
+        # Plain text line (e.g. typed into netcat)
+        return {"type": "text", "text": text}
+
+    async def _stream(self, graph_input, config: dict, writer: asyncio.StreamWriter):
+        """Run the graph until it finishes or stops at an approval, sending the answer tokens as they arrive."""
+        streamed = set()
+        async for message, metadata in self.graph.astream(graph_input, config, stream_mode="messages"):
+            if isinstance(message, AIMessageChunk):
+                if isinstance(message.content, str) and message.content:
+                    streamed.add(message.id)
+                    await self._send(writer, {"type": "token", "text": message.content})
+            elif isinstance(message, AIMessage) and message.id not in streamed and isinstance(message.content, str):
+                # Complete message that was not generated token by token (e.g. a fast path answer)
+                if message.content:
+                    await self._send(writer, {"type": "token", "text": message.content})
+
+    async def _turn(self, text: str, config: dict, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        """Run one user turn, carrying the approvals over the connection. Returns False if the client left.
+           The graph runs of the turn share the turn timeout; waiting for an approval does not use it up.
+        """
+        loop = asyncio.get_running_loop()
+        spent = 0.0
+
+        async def run(graph_input):
+            nonlocal spent
+            start = loop.time()
+            try:
+                await asyncio.wait_for(self._stream(graph_input, config, writer), max(self.turn_timeout - spent, 0))
+            finally:
+                spent += loop.time() - start
+
+        await run({"messages": ("user", text)})
+        snapshot = await self.graph.aget_state(config)
+        while snapshot.next:
+            pending = pending_tool_calls(snapshot.values["messages"], SENSITIVE_TOOL_NAMES)
+            await self._send(writer, {
+                "type": "approval_required",
+                "tool_calls": [{"id": c["id"], "name": c["name"], "args": c["args"]} for c in pending],
+            })
+            request = await self._read(reader)
+            while request is not None and request["type"] not in ("quit", "approve", "deny", "text"):
+                # Only an explicit answer approves or denies the cart change: anything else leaves it pending
+                await self._send(writer, {
+                    "type": "error",
+                    "message": 'A cart change is waiting for approval: send {"type": "approve"} or {"type": "deny"}.',
+                })
+                request = await self._read(reader)
+            if request is None or request["type"] == "quit":
+                return False
+            if request["type"] == "approve" or (request["type"] == "text" and request.get("text") == "y"):
+                await run(None)
+            else:
+                reason = request.get("reason") or request.get("text") or "denied"
+                await run({"messages": denial_messages(snapshot.values["messages"], str(reason))})
+            snapshot = await self.graph.aget_state(config)
+
+        messages = snapshot.values.get("messages", [])
+        answer = messages[-1].content if messages and isinstance(messages[-1], AIMessage) else ""
+        await self._send(writer, {"type": "answer", "text": answer})
+        self.turns += 1
+        return True
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if self.connections >= self.max_connections:
+            self.rejected += 1
+            try:
+                await self._send(writer, {"type": "error", "message": "Server busy, try again later."})
+            finally:
+                writer.close()
+            return
+
+        self.connections += 1
+        thread_id = str(uuid.uuid4())
+        config = {
+            "configurable": {"thread_id": thread_id, "user_id": thread_id},
+            "callbacks": telemetry.callbacks(),
+        }
+        try:
+            await self._send(writer, {"type": "hello", "thread_id": thread_id})
+            while True:
+                request = await self._read(reader)
+                if request is None or request["type"] == "quit":
+                    break
+                if request["type"] == "metrics":
+                    current = telemetry.get_telemetry()
+                    await self._send(writer, {"type": "metrics", "text": current.metrics_text() if current else ""})
+                    continue
+                text = request.get("text")
+                if request["type"] not in ("message", "text") or not isinstance(text, str) or not text.strip():
+                    await self._send(writer, {"type": "error", "message": "Expected a message."})
+                    continue
+
+                try:
+                    if not await self._turn(text.strip(), config, reader, writer):
+                        break
+                except asyncio.TimeoutError:
+                    await self._send(writer, {"type": "error", "message": "The turn took too long."})
+                except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    raise
+                except Exception as e:
+                    await self._send(writer, {"type": "error", "message": f"{type(e).__name__}: {e}"})
+        except asyncio.LimitOverrunError:
+            try:
+                await self._send(writer, {"type": "error", "message": f"Lines are limited to {LINE_LIMIT} bytes."})
+            except ConnectionError:
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            # Client went away or stayed silent for too long
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def serve(self, host: str, port: int):
+        server = await asyncio.start_server(self.handle, host, port, limit=LINE_LIMIT, backlog=self.max_connections)
+        addresses = ", ".join(str(sock.getsockname()) for sock in server.sockets)
+        print(f"Skincare chatbot server listening on {addresses}")
+        async with server:
+            await server.serve_forever()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the skincare chatbot to many users over a JSON line protocol.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1).")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on (default: 8765).")
+    parser.add_argument("--max-connections", type=int, default=500,
+                        help="Conversations served at once (default: 500).")
+    parser.add_argument("--llm-concurrency", type=int, default=8,
+                        help="LLM calls in flight at once; other turns wait for a slot (default: 8).")
+    parser.add_argument("--workers", type=int, default=64,
+                        help="Threads running the synchronous nodes (tools, fast path) (default: 64).")
+    parser.add_argument("--idle-timeout", type=float, default=600.0,
+                        help="Seconds before a silent connection is closed (default: 600).")
+    parser.add_argument("--turn-timeout", type=float, default=300.0,
+                        help="Seconds the graph may run for a turn before it is abandoned, not counting the wait "
+                             "for an approval (default: 300).")
+    add_retry_arguments(parser)
+    parser.add_argument("--no-single-flight", action="store_true",
+                        help="Do not share one LLM call between concurrent turns sending the same prompt.")
+    parser.add_argument("--cart-shards", type=int, default=0,
+                        help="Spread the carts over this many SQLite files by user (default: 0 = one table).")
+    parser.add_argument("--stub", action="store_true",
+                        help="Use the deterministic stub model of stub_llm.py instead of Ollama (for load tests).")
+    warmup.add_arguments(parser)
+    parser.add_argument("--checkpointer", choices=["memory", "sqlite"], default="memory",
+                        help="Where conversation checkpoints are kept (default: memory).")
+    parser.add_argument("--checkpoint-db", default=DEFAULT_CHECKPOINT_DB,
+                        help="SQLite checkpoint file used with --checkpointer sqlite.")
+    parser.add_argument("--context-tokens", type=int, default=3000,
+                        help="Token budget of the history sent to the LLM (default: 3000, 0 = unlimited).")
+    parser.add_argument("--no-fast-path", action="store_true", help="Send every question to the LLM.")
+    parser.add_argument("--tool-result-format", choices=FORMATS, default=DEFAULT_FORMAT,
+                        help="Format of the tool results in the conversation (default: table).")
+    parser.add_argument("--trace", default=None, metavar="FILE", help="Append spans to this JSONL file.")
+    parser.add_argument("--metrics", action="store_true",
+                        help="Collect metrics (served to clients that send {\"type\": \"metrics\"}).")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.trace or args.metrics:
+        telemetry.enable(args.trace)
+
+    # Load the model in the background while the graph is built (not for --stub or --no-warmup)
+    model_warmup = warmup.preload(sys.argv[1:] if argv is None else argv)
+    llm = create_llm(args)
+    retry_policy, fallback_llm = create_retry_policy(args)
+
+    cart_store.configure(args.cart_shards)
+    checkpointer = SQLiteCheckpointSaver(args.checkpoint_db) if args.checkpointer == "sqlite" else MemorySaver()
+    graph = build_graph(
+        llm,
+        checkpointer=checkpointer,
+        router=None if args.no_fast_path else FastPathRouter(),
+        context_tokens=args.context_tokens,
+        llm_concurrency=args.llm_concurrency,
+        result_format=args.tool_result_format,
+        retry_policy=retry_policy,
+        fallback_llm=fallback_llm,
+        single_flight=None if args.no_single_flight else SingleFlight("assistant"),
+    )
+    if model_warmup is not None:
+        model_warmup.prime(*warmup_request())
+    server = ChatServer(
+        graph,
+        max_connections=args.max_connections,
+        idle_timeout=args.idle_timeout,
+        turn_timeout=args.turn_timeout,
+    )
+
+    async def run():
+        # Synchronous nodes run on the default executor: size it for many concurrent turns
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=args.workers))
+        await server.serve(args.host, args.port)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if isinstance(checkpointer, SQLiteCheckpointSaver):
+            checkpointer.close()
+        cart_store.close_all()
+        close_all()
+        telemetry.disable()
+
+
+if __name__ == "__main__":
+    main()
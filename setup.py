@@ -1,11 +1,18 @@
+import argparse
+import csv
 import os
-import shutil
 import sqlite3
-import pandas as pd
+
+import cart_store
+import recommender
 
 '''
     This is a script to setup the SQLite database files for the skincare products & shopping carts.
     If setup.py is run again, it will reset the local database to its original state.
+    Run "python setup.py --migrate" to upgrade the schema of an existing database without resetting it,
+    "python setup.py --sync" to only apply new or changed products from the CSV file, or
+    "python setup.py --restore" to reset it from the backup of the last full setup without reading the CSV file.
+    (db_template.py clones fresh databases for tests and load tests the same way.)
 '''
 
 # File paths
@@ -14,20 +21,20 @@ backup_file = "skincare.backup.sqlite"
 csv_file = "skincare_products.csv"
 overwrite = True
 
-# Create the SQLite database file (it if not does not exist)
-if overwrite or not os.path.exists(local_file):
-    with open(local_file, "wb") as f:
-        pass 
-
-# Backup - we use this to "reset" the DB whenever setup.py is run again.
-shutil.copy(local_file, backup_file)
+# Number of CSV rows inserted per executemany() batch
+CHUNK_SIZE = 10_000
 
-# Connect to the SQLite database
-conn = sqlite3.connect(local_file)
-cursor = conn.cursor()
+# PRAGMAs used while bulk loading a fresh database file
+BULK_LOAD_PRAGMAS = (
+    "PRAGMA journal_mode = OFF",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA cache_size = -262144",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA locking_mode = EXCLUSIVE",
+)
 
-# Create the "products" table
-cursor.execute("""
+# The "products" table
+PRODUCTS_TABLE_SQL = """
     CREATE TABLE IF NOT EXISTS products (
         product_id INTEGER PRIMARY KEY,
         product_name TEXT NOT NULL,
@@ -36,39 +43,503 @@ cursor.execute("""
         stock INTEGER,
         price REAL
     )
-""")
+"""
 
-# Create the "shopping_carts" table
-cursor.execute("""
+# The "shopping_carts" table. Each user has at most one row per product, so (user_id, product_id) is the
+# primary key. WITHOUT ROWID stores the rows clustered by that key, which keeps a user's cart together on disk.
+SHOPPING_CARTS_TABLE_SQL = """
     CREATE TABLE IF NOT EXISTS shopping_carts (
         user_id INTEGER,
         product_id INTEGER,
         product_name TEXT NOT NULL,
         price REAL,
         quantity INTEGER,
+        PRIMARY KEY (user_id, product_id),
         FOREIGN KEY (product_id) REFERENCES products (product_id)
+    ) WITHOUT ROWID
+"""
+
+# Per-user cart summary (number of products, number of items and total price), kept up to date by triggers on
+# "shopping_carts" within the transaction of every cart change, so view_cart reads the totals of a cart in one
+# primary key lookup. An update is applied as the removal of the old row plus the insertion of the new one.
+CART_SUMMARIES_SQL = """
+    CREATE TABLE IF NOT EXISTS cart_summaries (
+        user_id PRIMARY KEY,
+        products INTEGER NOT NULL,
+        items INTEGER NOT NULL,
+        total REAL NOT NULL
+    ) WITHOUT ROWID;
+
+    CREATE TRIGGER IF NOT EXISTS shopping_carts_summary_insert AFTER INSERT ON shopping_carts BEGIN
+        INSERT INTO cart_summaries (user_id, products, items, total)
+        VALUES (new.user_id, 1, new.quantity, new.price * new.quantity)
+        ON CONFLICT (user_id) DO UPDATE SET
+            products = products + 1, items = items + excluded.items, total = total + excluded.total;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS shopping_carts_summary_delete AFTER DELETE ON shopping_carts BEGIN
+        UPDATE cart_summaries
+        SET products = products - 1, items = items - old.quantity, total = total - old.price * old.quantity
+        WHERE user_id = old.user_id;
+        DELETE FROM cart_summaries WHERE user_id = old.user_id AND products <= 0;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS shopping_carts_summary_update
+    AFTER UPDATE OF user_id, price, quantity ON shopping_carts BEGIN
+        UPDATE cart_summaries
+        SET products = products - 1, items = items - old.quantity, total = total - old.price * old.quantity
+        WHERE user_id = old.user_id;
+        DELETE FROM cart_summaries WHERE user_id = old.user_id AND products <= 0;
+        INSERT INTO cart_summaries (user_id, products, items, total)
+        VALUES (new.user_id, 1, new.quantity, new.price * new.quantity)
+        ON CONFLICT (user_id) DO UPDATE SET
+            products = products + 1, items = items + excluded.items, total = total + excluded.total;
+    END;
+"""
+
+# Full-text search index over the products table. It is an external content FTS5 table (the text is
+# only stored once, in "products") and the triggers below keep it in sync with every insert, update and delete.
+SEARCH_INDEX_SQL = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        product_name,
+        description,
+        category,
+        content = 'products',
+        content_rowid = 'product_id',
+        tokenize = 'porter unicode61 remove_diacritics 2'
+    );
+
+    CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts (rowid, product_name, description, category)
+        VALUES (new.product_id, new.product_name, new.description, new.category);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts (products_fts, rowid, product_name, description, category)
+        VALUES ('delete', old.product_id, old.product_name, old.description, old.category);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF product_name, description, category ON products BEGIN
+        INSERT INTO products_fts (products_fts, rowid, product_name, description, category)
+        VALUES ('delete', old.product_id, old.product_name, old.description, old.category);
+        INSERT INTO products_fts (rowid, product_name, description, category)
+        VALUES (new.product_id, new.product_name, new.description, new.category);
+    END;
+"""
+
+# Single row version number of the product catalog, bumped by triggers whenever a product is inserted,
+# updated or deleted. The in-memory catalog of the tools (catalog.py) uses it to detect stale data.
+CATALOG_VERSION_SQL = """
+    CREATE TABLE IF NOT EXISTS catalog_version (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        version INTEGER NOT NULL
+    );
+
+    INSERT OR IGNORE INTO catalog_version (id, version) VALUES (0, 0);
+
+    CREATE TRIGGER IF NOT EXISTS products_version_insert AFTER INSERT ON products BEGIN
+        UPDATE catalog_version SET version = version + 1 WHERE id = 0;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS products_version_update AFTER UPDATE ON products BEGIN
+        UPDATE catalog_version SET version = version + 1 WHERE id = 0;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS products_version_delete AFTER DELETE ON products BEGIN
+        UPDATE catalog_version SET version = version + 1 WHERE id = 0;
+    END;
+"""
+
+
+# Covering indexes of the keyset-paginated browse_products tool (they replace the plain category index). Each
+# holds every column the tool filters on and returns, so a page is answered from the index alone.
+BROWSE_INDEXES_SQL = """
+    DROP INDEX IF EXISTS idx_products_category;
+    CREATE INDEX IF NOT EXISTS idx_products_browse_category_price
+        ON products (category COLLATE NOCASE, price, product_id, stock, product_name, description);
+    CREATE INDEX IF NOT EXISTS idx_products_browse_price
+        ON products (price, product_id, stock, product_name, category, description);
+    CREATE INDEX IF NOT EXISTS idx_products_browse_category_name
+        ON products (category COLLATE NOCASE, product_name, product_id, stock, price, description);
+    CREATE INDEX IF NOT EXISTS idx_products_browse_name
+        ON products (product_name, product_id, stock, price, category, description);
+"""
+
+# Browse indexes created by earlier versions without a column they now hold (rebuilt by create_indexes)
+BROWSE_INDEX_UPGRADES = {
+    "idx_products_browse_category_price": "description",
+    "idx_products_browse_price": "description",
+    "idx_products_browse_category_name": "description",
+    "idx_products_browse_name": "description",
+}
+
+
+def create_search_index(conn):
+    """Create the FTS5 search index and its sync triggers. Returns False if FTS5 is not available."""
+    try:
+        conn.executescript(SEARCH_INDEX_SQL)
+    except sqlite3.OperationalError as e:
+        print(f"Full-text search index not created ({e}). The tools will fall back to LIKE queries.")
+        return False
+    # Index any rows that already exist (e.g. when run against an older database)
+    conn.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+    return True
+
+
+def migrate_shopping_carts(conn):
+    """Migrate a "shopping_carts" table created by older versions of this script (no primary key).
+       Duplicate rows for the same user and product are merged by summing their quantities.
+    """
+    columns = conn.execute("PRAGMA table_info(shopping_carts)").fetchall()
+    if not columns:
+        return False
+    # Column 5 of table_info is the position of the column in the primary key (0 if not part of it)
+    if sorted(col[1] for col in columns if col[5]) == ["product_id", "user_id"]:
+        return False
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("ALTER TABLE shopping_carts RENAME TO shopping_carts_old")
+        conn.execute(SHOPPING_CARTS_TABLE_SQL)
+        conn.execute("""
+            INSERT INTO shopping_carts (user_id, product_id, product_name, price, quantity)
+            SELECT user_id, product_id, MAX(product_name), MAX(price), SUM(quantity)
+            FROM shopping_carts_old
+            GROUP BY user_id, product_id
+        """)
+        conn.execute("DROP TABLE shopping_carts_old")
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    return True
+
+
+def create_cart_summaries(conn):
+    """Create the cart summary table and its triggers, filling it from the existing carts when it is new (or
+       when the triggers were missing, e.g. after migrate_shopping_carts() rebuilt the carts table).
+    """
+    exists = conn.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE name IN ('cart_summaries', 'shopping_carts_summary_insert',"
+        " 'shopping_carts_summary_delete', 'shopping_carts_summary_update')"
+    ).fetchone()[0] == 4
+    conn.executescript(CART_SUMMARIES_SQL)
+    if exists:
+        return False
+
+    # Summarize the carts written without the triggers
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM cart_summaries")
+        conn.execute("""
+            INSERT INTO cart_summaries (user_id, products, items, total)
+            SELECT user_id, COUNT(*), SUM(quantity), SUM(price * quantity) FROM shopping_carts GROUP BY user_id
+        """)
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    return True
+
+
+def create_tables(conn):
+    """Create the "products", "shopping_carts" and "cart_summaries" tables (migrating the old shopping carts
+       layout).
+    """
+    # Create the "products" table
+    conn.execute(PRODUCTS_TABLE_SQL)
+
+    # Create the "shopping_carts" table (or migrate the old layout without a primary key)
+    conn.commit()
+    if migrate_shopping_carts(conn):
+        print("Shopping carts table migrated to the (user_id, product_id) primary key.")
+    conn.execute(SHOPPING_CARTS_TABLE_SQL)
+    conn.commit()
+    create_cart_summaries(conn)
+
+
+def create_indexes(conn):
+    """Create the secondary indexes, search index and triggers. Returns whether the search index exists.
+       Building these after a bulk load is much faster than maintaining them row by row during it.
+    """
+    # Indexes of browse_products, one per sort order with and without a category filter (also used by the
+    # category filters of the recommendation tool). They are ordered like the sort key (column, product_id) and
+    # hold every column the tool reads, so a page is found and returned without reading the table.
+    for index, column in BROWSE_INDEX_UPGRADES.items():
+        columns = [row[2] for row in conn.execute(f"PRAGMA index_info({index})")]
+        if columns and column not in columns:
+            conn.execute(f"DROP INDEX {index}")
+    conn.executescript(BROWSE_INDEXES_SQL)
+
+    # Create the catalog version row and the triggers that bump it
+    conn.executescript(CATALOG_VERSION_SQL)
+
+    # Create the full-text search index over product names, descriptions and categories
+    search_index = create_search_index(conn)
+    conn.commit()
+    return search_index
+
+
+def create_schema(conn):
+    """Create (or upgrade) every table and index used by the tools. Returns whether the search index exists."""
+    create_tables(conn)
+    return create_indexes(conn)
+
+
+def _to_int(value):
+    return int(float(value)) if value not in (None, "") else None
+
+
+def _to_float(value):
+    return float(value) if value not in (None, "") else None
+
+
+def read_products(path, chunk_size=CHUNK_SIZE):
+    """Stream the CSV file in chunks of (product_id, product_name, description, category, stock, price) tuples.
+       The CSV "ID" column becomes the product_id (rows without one get the next free id).
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        chunk = []
+        for row in csv.DictReader(f):
+            chunk.append((
+                _to_int(row.get("ID")),
+                row["product_name"],
+                row.get("description") or None,
+                row.get("category") or None,
+                _to_int(row.get("stock")),
+                _to_float(row.get("price")),
+            ))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def load_products(conn, path=None, chunk_size=CHUNK_SIZE):
+    """Bulk load the CSV file into an empty "products" table in a single transaction. Returns the row count."""
+    count = 0
+    conn.execute("BEGIN")
+    try:
+        for chunk in read_products(path or csv_file, chunk_size):
+            conn.executemany("""
+                INSERT INTO products (product_id, product_name, description, category, stock, price)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, chunk)
+            count += len(chunk)
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    return count
+
+
+def sync_products(conn, path=None, chunk_size=CHUNK_SIZE):
+    """Upsert the CSV file into the existing "products" table, keyed on the CSV "ID" column.
+       Only new or changed rows are written, so the search index and catalog version only see real changes.
+       Returns (inserted, updated) counts.
+    """
+    before = conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+    written = 0
+    cursor = conn.cursor()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for chunk in read_products(path or csv_file, chunk_size):
+            cursor.executemany("""
+                INSERT INTO products (product_id, product_name, description, category, stock, price)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (product_id) DO UPDATE SET
+                    product_name = excluded.product_name,
+                    description = excluded.description,
+                    category = excluded.category,
+                    stock = excluded.stock,
+                    price = excluded.price
+                WHERE products.product_name IS NOT excluded.product_name
+                   OR products.description IS NOT excluded.description
+                   OR products.category IS NOT excluded.category
+                   OR products.stock IS NOT excluded.stock
+                   OR products.price IS NOT excluded.price
+            """, chunk)
+            # rowcount covers inserted and updated rows (not the rows written by the triggers)
+            written += cursor.rowcount
+        after = conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    conn.commit()
+
+    inserted = after - before
+    return inserted, written - inserted
+
+
+def backup_database(conn, path=None):
+    """Copy the database with the SQLite online backup API (consistent even while it is in use)."""
+    backup = sqlite3.connect(path or backup_file)
+    try:
+        conn.backup(backup)
+    finally:
+        backup.close()
+
+
+def remove_database(path):
+    """Delete the database file together with any leftover WAL/shared memory/journal files."""
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def build_recommendations(conn, db_path):
+    """(Re)build the recommendation index of get_recommendations next to the database file."""
+    return recommender.build_index(conn, recommender.index_path(db_path))
+
+
+def build_database(path, csv_path=None, chunk_size=CHUNK_SIZE, backup_path=None, recommendations=True):
+    """Create a new database file at path from the CSV file and return the number of products loaded.
+       This is the bulk load path of setup.py (also timed by benchmark.py).
+    """
+    remove_database(path)
+    # A new database starts with empty carts: drop the cart shards of the old one
+    cart_store.remove_shards(cart_store.shards_path(path))
+
+    # Connect to the SQLite database. Nothing else uses the file during the load, so durability is traded
+    # for speed: no rollback journal, no fsync and a large page cache.
+    conn = sqlite3.connect(path)
+    try:
+        for pragma in BULK_LOAD_PRAGMAS:
+            conn.execute(pragma)
+
+        create_tables(conn)
+        count = load_products(conn, csv_path, chunk_size=chunk_size)
+
+        search_index = create_indexes(conn)
+        if search_index:
+            # Merge the index b-trees now that the bulk load is done
+            conn.execute("INSERT INTO products_fts (products_fts) VALUES ('optimize')")
+            conn.commit()
+        conn.execute("ANALYZE")
+        if recommendations:
+            build_recommendations(conn, path)
+
+        # Switch to the journal mode used by the tools before handing the file over
+        conn.execute("PRAGMA synchronous = FULL")
+        conn.execute("PRAGMA journal_mode = WAL")
+
+        if backup_path:
+            backup_database(conn, backup_path)
+    finally:
+        conn.close()
+    return count
+
+
+def reset_database(chunk_size=CHUNK_SIZE):
+    """Recreate the database from the CSV file."""
+    if not os.path.exists(csv_file):
+        print(f"CSV file '{csv_file}' not found.")
+        return
+
+    # Start from an empty database file (unless overwrite is off and one already exists)
+    if not overwrite and os.path.exists(local_file):
+        sync_database(chunk_size)
+        return
+
+    # Backup - we use this to "reset" the DB whenever setup.py is run again.
+    count = build_database(local_file, csv_file, chunk_size, backup_path=backup_file)
+    print(f"Products table populated successfully ({count} products).")
+
+    print("Database setup complete!")
+
+
+def sync_database(chunk_size=CHUNK_SIZE):
+    """Apply the CSV file to the existing database, only writing new or changed products."""
+    if not os.path.exists(local_file):
+        print(f"Database file '{local_file}' not found. Run setup.py without --sync first.")
+        return
+
+    conn = sqlite3.connect(local_file, timeout=30)
+    conn.execute("PRAGMA journal_mode = WAL")
+    create_schema(conn)
+    inserted, updated = sync_products(conn, chunk_size=chunk_size)
+    if inserted or updated or recommender.get_recommender(local_file) is None:
+        build_recommendations(conn, local_file)
+    conn.close()
+
+    print(f"Database sync complete! ({inserted} products added, {updated} products updated)")
+
+
+def restore_database():
+    """Reset the database to the backup written by the last full setup, with the online backup API (no CSV load;
+       chatbots that have the database open see the restored products and carts on their next query).
+    """
+    if not os.path.exists(backup_file):
+        print(f"Backup file '{backup_file}' not found. Run setup.py without --restore first.")
+        return
+
+    source = sqlite3.connect(backup_file)
+    conn = sqlite3.connect(local_file, timeout=30)
+    try:
+        conn.execute("PRAGMA journal_mode = WAL")
+        source.backup(conn)
+        # The backup has empty carts: drop the cart shards as well
+        cart_store.remove_shards(cart_store.shards_path(local_file))
+        index = recommender.get_recommender(local_file)
+        version = conn.execute("SELECT version FROM catalog_version").fetchone()[0]
+        if index is None or index.meta.get("catalog_version") != version:
+            build_recommendations(conn, local_file)
+    finally:
+        conn.close()
+        source.close()
+
+    print("Database restored from the backup!")
+
+
+def migrate_database():
+    """Upgrade the schema of an existing database in place, keeping its products and carts."""
+    if not os.path.exists(local_file):
+        print(f"Database file '{local_file}' not found. Run setup.py without --migrate first.")
+        return
+
+    conn = sqlite3.connect(local_file)
+    create_schema(conn)
+    if recommender.get_recommender(local_file) is None:
+        build_recommendations(conn, local_file)
+    conn.close()
+
+    print("Database migration complete!")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Set up the SQLite database for the skincare chatbot.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--migrate",
+        action="store_true",
+        help="Upgrade the schema of the existing database instead of resetting it.",
+    )
+    mode.add_argument(
+        "--sync",
+        action="store_true",
+        help="Upsert new or changed products from the CSV file into the existing database instead of resetting it.",
+    )
+    mode.add_argument(
+        "--restore",
+        action="store_true",
+        help=f"Reset the database from {backup_file} (written by the last full setup) instead of the CSV file.",
     )
-""")
-
-# Load data from the CSV file and insert it into the "products" table
-if os.path.exists(csv_file):
-    df = pd.read_csv(csv_file)
-    
-    # Insert data into the "products" table
-    for _, row in df.iterrows():
-        cursor.execute("""
-            INSERT INTO products (product_name, description, category, stock, price)
-            VALUES (?, ?, ?, ?, ?)
-        """, (row['product_name'], row['description'], row['category'], row['stock'], row['price']))
-    
-    print("Products table populated successfully.")
-else:
-    print(f"CSV file '{csv_file}' not found.")
-
-# Commit changes
-conn.commit()
-# Backup the database file
-shutil.copy(local_file, backup_file)
-conn.close()
-
-print("Database setup complete!")
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=CHUNK_SIZE,
+        help=f"Number of CSV rows inserted per batch (default: {CHUNK_SIZE}).",
+    )
+    args = parser.parse_args()
+
+    if args.migrate:
+        migrate_database()
+    elif args.sync:
+        sync_database(args.chunk_size)
+    elif args.restore:
+        restore_database()
+    else:
+        reset_database(args.chunk_size)
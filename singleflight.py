@@ -0,0 +1,178 @@
+import asyncio
+import functools
+import json
+import threading
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+import telemetry
+
+'''
+    This is a module that coalesces identical calls that are in flight at the same time ("single flight"). When
+    many sessions ask the same thing at once, the first call with a key (the leader) runs, and the calls with the
+    same key that arrive before it finishes wait for it and share its result, or its exception, instead of
+    running their own SQLite query or LLM generation. Nothing is kept once the leader has finished: this is not
+    a cache, only concurrent duplicates are merged.
+
+    do() serves threaded callers (graph.invoke, the tool nodes, the thread pools of loadtest.py) and ado() serves
+    asyncio callers (graph.ainvoke / astream in server.py). Waiters give up after a timeout (per flight, or per
+    call) with a TimeoutError; the leader itself is not bounded here, its caller does that.
+'''
+
+# Seconds a waiter waits for the leader by default (None: as long as the leader runs)
+DEFAULT_TIMEOUT = 30.0
+
+_DEFAULT = object()
+
+
+class _Call:
+    """One in-flight execution of a threaded caller."""
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one execution.
+
+    Args:
+        name (str): Name of the flight in stats and metrics (e.g. "tools", "assistant").
+        timeout (float): Seconds a waiter waits for the leader before raising TimeoutError (None: no limit).
+
+    stats() returns the executions (calls that ran), the shared calls (waiters served by another call, i.e. the
+    duplicate work avoided), the waiters that timed out and the executions that raised.
+    """
+
+    def __init__(self, name: str, timeout: Optional[float] = DEFAULT_TIMEOUT):
+        self.name = name
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        # key -> _Call of the threaded callers, (event loop, key) -> task of the asyncio callers
+        self._calls = {}
+        self._tasks = {}
+        self.counts = {"executions": 0, "shared": 0, "timeouts": 0, "errors": 0}
+
+    def _count(self, result: str):
+        with self._lock:
+            self.counts[result] += 1
+        current = telemetry.get_telemetry()
+        if current is not None:
+            current.count("skincare_single_flight_total", flight=self.name, result=result)
+
+    def _wait_timeout(self, timeout) -> Optional[float]:
+        return self.timeout if timeout is _DEFAULT else timeout
+
+    # Threaded callers
+
+    def do(self, key: Hashable, fn: Callable[[], Any], timeout=_DEFAULT) -> tuple[Any, bool]:
+        """Run fn() unless a call with the same key is in flight, in which case wait for its result.
+           Returns (result, shared): shared is True when the result came from another call. An exception of
+           the execution is raised in every caller that shared it; a waiter that waited longer than timeout
+           (default: the flight's) raises TimeoutError.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if leader:
+            self._count("executions")
+            try:
+                call.result = fn()
+                return call.result, False
+            except BaseException as e:
+                call.error = e
+                self._count("errors")
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        if not call.done.wait(self._wait_timeout(timeout)):
+            self._count("timeouts")
+            raise TimeoutError(f"Timed out waiting for the in-flight {self.name} call")
+        self._count("shared")
+        if call.error is not None:
+            raise call.error
+        return call.result, True
+
+    # Asyncio callers
+
+    def _finished(self, slot: tuple, task: asyncio.Task):
+        with self._lock:
+            if self._tasks.get(slot) is task:
+                del self._tasks[slot]
+        # Retrieving the exception also keeps asyncio from logging it as never retrieved
+        if not task.cancelled() and task.exception() is not None:
+            self._count("errors")
+
+    async def ado(self, key: Hashable, factory: Callable[[], Awaitable[Any]], timeout=_DEFAULT) -> tuple[Any, bool]:
+        """Async version of do(): await factory() unless a call with the same key is in flight on this event loop.
+           The execution runs as a task, so a caller that is cancelled (or times out) does not cancel it for the
+           others.
+        """
+        loop = asyncio.get_running_loop()
+        slot = (loop, key)
+        with self._lock:
+            task = self._tasks.get(slot)
+            leader = task is None
+            if leader:
+                task = self._tasks[slot] = loop.create_task(factory())
+                task.add_done_callback(functools.partial(self._finished, slot))
+
+        if leader:
+            self._count("executions")
+            return await asyncio.shield(task), False
+
+        try:
+            result = await asyncio.wait_for(asyncio.shield(task), self._wait_timeout(timeout))
+        except asyncio.TimeoutError:
+            if task.done():
+                # The execution itself timed out: that is its exception, shared like any other
+                self._count("shared")
+            else:
+                self._count("timeouts")
+            raise
+        except asyncio.CancelledError:
+            raise
+        except BaseException:
+            self._count("shared")
+            raise
+        self._count("shared")
+        return result, True
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.counts)
+            stats["in_flight"] = len(self._calls) + len(self._tasks)
+        calls = stats["executions"] + stats["shared"]
+        stats["shared_rate"] = stats["shared"] / calls if calls else 0.0
+        return stats
+
+
+def call_key(name: str, args: tuple, kwargs: dict) -> str:
+    """Key of a function call with JSON-like arguments (keyword order does not matter)."""
+    return json.dumps([name, list(args), kwargs], sort_keys=True, default=str, ensure_ascii=False)
+
+
+def coalesce(flight: SingleFlight, scope: Optional[Callable[[], Hashable]] = None):
+    """Decorator sharing concurrent identical calls of a function (that only reads) through the flight.
+       scope() is added to the key, for what the result depends on besides the arguments (e.g. the database).
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            key = call_key(fn.__name__, args, kwargs)
+            if scope is not None:
+                key = (scope(), key)
+            return flight.do(key, lambda: fn(*args, **kwargs))[0]
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,334 @@
+import argparse
+import json
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Iterator, Optional, Sequence
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from assistant import RETRY_PROMPT
+
+'''
+    This is a module with a local, deterministic stand-in for the Ollama model, used by the load tests.
+    It answers from simple keyword rules: a user message becomes the tool calls the real assistant would make
+    ("add product 3 to my cart" -> add_to_cart), and tool results become a short text answer. The latency of
+    the real model is simulated with a fixed delay before the first token plus a delay per generated token.
+    A share of empty responses (empty_rate) simulates a misbehaving model for the Assistant's retry policy.
+
+    "python stub_llm.py" serves the same model as a local stand-in for the Ollama endpoint (/api/generate
+    and /api/chat), with a model load delay, to try the chatbot startup path without Ollama:
+
+        python stub_llm.py --port 11435 --load-latency 3 &
+        python chatbot.py --ollama-url http://127.0.0.1:11435
+'''
+
+# (pattern, tool name, function building the arguments from the regex match), tried in order
+RULES = [
+    (re.compile(r"\badd (?:product )?(\d+)"), "add_to_cart", lambda m: {"product_id": int(m.group(1)), "quantity": 1}),
+    (re.compile(r"\bremove (?:product )?(\d+)"), "remove_from_cart", lambda m: {"product_id": int(m.group(1))}),
+    (re.compile(r"\b(?:view|show|what'?s in) (?:my )?cart\b"), "view_cart", lambda m: {}),
+    (re.compile(r"\bcategor(?:y|ies)\b"), "get_product_categories", lambda m: {}),
+    (
+        re.compile(r"\brecommend (?:an? |some )?(\w+) for (.+)"),
+        "get_recommendations",
+        lambda m: {"category": m.group(1), "description": m.group(2)},
+    ),
+    (
+        re.compile(r"\b(\w+) under \$?(\d+(?:\.\d+)?)"),
+        "browse_products",
+        lambda m: {"category": m.group(1), "max_price": float(m.group(2))},
+    ),
+    (re.compile(r"\b(?:search|find|look) (?:for )?(.+)"), "search_product_by_name", lambda m: {"product_name": m.group(1)}),
+    (re.compile(r"\breturn"), "get_returns_policy", lambda m: {}),
+    (re.compile(r"\bshipping\b"), "get_shipping_policy", lambda m: {}),
+    (re.compile(r"\bpay"), "get_payment_methods", lambda m: {}),
+    (re.compile(r"\bdeliver"), "get_delivery_time", lambda m: {}),
+]
+
+
+def _text(message: BaseMessage) -> str:
+    return message.content if isinstance(message.content, str) else json.dumps(message.content)
+
+
+class StubChatModel(BaseChatModel):
+    """Deterministic chat model that emits scripted tool calls.
+
+    Args:
+        latency (float): Seconds before the first token of every answer (prompt processing).
+        token_latency (float): Seconds per generated token.
+        answer_words (int): Number of words of a text answer.
+        empty_rate (float): Share of calls answered with an empty message (picked from a hash of the conversation,
+            so the same call always gets the same answer).
+    """
+
+    latency: float = 0.05
+    token_latency: float = 0.0
+    answer_words: int = 40
+    empty_rate: float = 0.0
+    tool_names: Sequence[str] = ()
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs: Any) -> "StubChatModel":
+        # Only the names matter: the rules never call a tool that is not bound
+        return self.model_copy(update={"tool_names": [getattr(t, "name", t) for t in tools]})
+
+    def respond(self, messages: Sequence[BaseMessage]) -> AIMessage:
+        """Return the answer for this conversation (no delay), with word counts as its token usage."""
+        if self.empty_rate and zlib.crc32(json.dumps([_text(m) for m in messages]).encode("utf-8")) < self.empty_rate * 2 ** 32:
+            message = AIMessage(content="")
+        else:
+            # Answer the retry prompt of the Assistant as if it was the original call
+            while len(messages) > 1 and isinstance(messages[-1], HumanMessage) and _text(messages[-1]) == RETRY_PROMPT:
+                messages = messages[:-1]
+            message = self._answer(messages)
+        input_tokens = sum(len(_text(m).split()) for m in messages)
+        output_tokens = len(_text(message).split()) + 10 * len(message.tool_calls)
+        message.usage_metadata = {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+        }
+        return message
+
+    def _answer(self, messages: Sequence[BaseMessage]) -> AIMessage:
+        last = messages[-1]
+        if isinstance(last, ToolMessage):
+            # Answer from the results of the last batch of tool calls
+            results = []
+            for message in reversed(messages):
+                if not isinstance(message, ToolMessage):
+                    break
+                results.append(f"{message.name}: {_text(message)}")
+            words = " ".join(reversed(results)).split()
+            return AIMessage(content="Here is what I found. " + " ".join(words[: self.answer_words]))
+
+        human = next((m for m in reversed(messages) if isinstance(m, HumanMessage)), None)
+        text = _text(human).lower() if human is not None else ""
+        tool_calls = []
+        for pattern, name, arguments in RULES:
+            match = pattern.search(text)
+            if match and (not self.tool_names or name in self.tool_names):
+                # Ids only need to be unique within a conversation, which always grows
+                tool_calls.append({"name": name, "args": arguments(match), "id": f"call_{len(messages)}_{len(tool_calls)}"})
+                break
+        if tool_calls:
+            return AIMessage(content="", tool_calls=tool_calls)
+
+        filler = "I am happy to help you find the right skincare products today".split()
+        words = ["Hello!"] + [filler[i % len(filler)] for i in range(self.answer_words - 1)]
+        return AIMessage(content=" ".join(words) + ".")
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        message = self.respond(messages)
+        time.sleep(self.latency + self.token_latency * message.usage_metadata["output_tokens"])
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: Optional[list[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        message = self.respond(messages)
+        time.sleep(self.latency)
+        if message.tool_calls:
+            chunk = ChatGenerationChunk(message=AIMessageChunk(
+                content="",
+                tool_call_chunks=[
+                    {"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": i}
+                    for i, call in enumerate(message.tool_calls)
+                ],
+                usage_metadata=message.usage_metadata,
+            ))
+            if run_manager:
+                run_manager.on_llm_new_token("", chunk=chunk)
+            yield chunk
+            return
+
+        words = message.content.split(" ")
+        for i, word in enumerate(words):
+            time.sleep(self.token_latency)
+            # The usage of the whole answer comes with its last chunk, like Ollama does
+            chunk = ChatGenerationChunk(message=AIMessageChunk(
+                content=word if i == 0 else " " + word,
+                usage_metadata=message.usage_metadata if i == len(words) - 1 else None,
+            ))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.message.content, chunk=chunk)
+            yield chunk
+
+
+def _duration(value) -> float:
+    """Seconds of an Ollama keep_alive ("30m", "1h", "45s", a number of seconds, or negative: forever)."""
+    if value is None:
+        return 300.0
+    if isinstance(value, (int, float)):
+        return float("inf") if value < 0 else float(value)
+    match = re.fullmatch(r"(-?\d+(?:\.\d+)?)(ms|s|m|h)?", value.strip())
+    if not match:
+        return 300.0
+    seconds = float(match.group(1)) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600, None: 1}[match.group(2)]
+    return float("inf") if seconds < 0 else seconds
+
+
+def _from_ollama(message: dict) -> BaseMessage:
+    content = message.get("content", "")
+    if message["role"] == "system":
+        return SystemMessage(content=content)
+    if message["role"] == "assistant":
+        tool_calls = [
+            {"name": call["function"]["name"], "args": call["function"]["arguments"], "id": call.get("id", f"call_{i}")}
+            for i, call in enumerate(message.get("tool_calls") or [])
+        ]
+        return AIMessage(content=content, tool_calls=tool_calls)
+    if message["role"] == "tool":
+        return ToolMessage(content=content, tool_call_id=message.get("tool_call_id", ""))
+    return HumanMessage(content=content)
+
+
+class OllamaStandIn(ThreadingHTTPServer):
+    """Local stand-in for the Ollama HTTP API, answering with StubChatModel.
+
+    Args:
+        address (tuple): (host, port) to listen on.
+        model (StubChatModel): Model answering the chat requests.
+        load_latency (float): Seconds to load a model that is not loaded (first request, or after its keep-alive).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple, model: StubChatModel, load_latency: float = 2.0):
+        super().__init__(address, _OllamaHandler)
+        self.model = model
+        self.load_latency = load_latency
+        self.loaded_until = {}
+        self.requests = {"generate": 0, "chat": 0, "loads": 0}
+        self._lock = threading.Lock()
+
+    def count(self, kind: str):
+        """Count a request (the handler threads run concurrently)."""
+        with self._lock:
+            self.requests[kind] += 1
+
+    def load(self, name: str, keep_alive) -> float:
+        """Load the model if needed and extend its keep-alive. Returns the load duration in seconds."""
+        with self._lock:
+            loaded = self.loaded_until.get(name, 0.0) > time.monotonic()
+            if not loaded:
+                self.requests["loads"] += 1
+                time.sleep(self.load_latency)
+            self.loaded_until[name] = time.monotonic() + _duration(keep_alive)
+        return 0.0 if loaded else self.load_latency
+
+
+class _OllamaHandler(BaseHTTPRequestHandler):
+    def _send(self, payload, status: int = 200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path in ("/", "/api/version"):
+            self._send({"version": "stub"})
+        else:
+            self._send({"error": "not found"}, 404)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.end_headers()
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        name = request.get("model", "stub")
+        if self.path == "/api/generate":
+            self.server.count("generate")
+            load = self.server.load(name, request.get("keep_alive"))
+            self._send({"model": name, "response": "", "done": True, "done_reason": "load",
+                        "load_duration": int(load * 1e9)})
+        elif self.path == "/api/chat":
+            self.server.count("chat")
+            self._chat(name, request, self.server.load(name, request.get("keep_alive")))
+        else:
+            self._send({"error": "not found"}, 404)
+
+    def _chat(self, name: str, request: dict, load: float):
+        model = self.server.model.bind_tools([tool["function"]["name"] for tool in request.get("tools") or []])
+        message = model.respond([_from_ollama(m) for m in request.get("messages", [])])
+        num_predict = (request.get("options") or {}).get("num_predict")
+        if num_predict is not None and num_predict >= 0:
+            message = AIMessage(content=" ".join(_text(message).split()[:num_predict]))
+        time.sleep(model.latency)
+
+        reply = {"role": "assistant", "content": message.content}
+        if message.tool_calls:
+            reply["tool_calls"] = [{"function": {"name": c["name"], "arguments": c["args"]}} for c in message.tool_calls]
+        usage = message.usage_metadata or {}
+        done = {
+            "model": name, "done": True, "done_reason": "stop", "load_duration": int(load * 1e9),
+            "prompt_eval_count": usage.get("input_tokens", 0), "eval_count": usage.get("output_tokens", 0),
+        }
+        if not request.get("stream", True):
+            self._send({**done, "message": reply})
+            return
+
+        # Streamed answers are newline-delimited JSON, the usage comes with the last line
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        words = message.content.split(" ") if message.content else []
+        for i, word in enumerate(words):
+            time.sleep(model.token_latency)
+            chunk = {"role": "assistant", "content": word if i == 0 else " " + word}
+            self.wfile.write((json.dumps({"model": name, "done": False, "message": chunk}) + "\n").encode("utf-8"))
+        self.wfile.write((json.dumps({**done, "message": {**reply, "content": ""}}) + "\n").encode("utf-8"))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the stub model as a local stand-in for Ollama.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1).")
+    parser.add_argument("--port", type=int, default=11435, help="Port to listen on (default: 11435).")
+    parser.add_argument("--load-latency", type=float, default=2.0,
+                        help="Seconds to load the model when it is not loaded (default: 2).")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds before every answer (default: 0.05).")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Seconds per streamed token (default: 0).")
+    args = parser.parse_args(argv)
+
+    server = OllamaStandIn(
+        (args.host, args.port),
+        StubChatModel(latency=args.latency, token_latency=args.token_latency),
+        load_latency=args.load_latency,
+    )
+    print(f"Ollama stand-in listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Requests: {server.requests}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+import contextvars
+import itertools
+import json
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler, dispatch_custom_event
+from langgraph.constants import TAG_NOSTREAM
+
+'''
+    This is a module that traces where the time of a turn goes. When enabled, a LangChain callback handler
+    records a span for every graph node, LLM call and tool call (with token counts and the empty-response retries
+    of the Assistant) and the database connections time every SQL statement. Spans are appended to a JSONL trace
+    file and aggregated into metrics exported as Prometheus/OpenMetrics text.
+
+    Nothing is recorded until enable() is called: the callback handler is not attached and database.connect()
+    creates plain connections, so the disabled overhead is a single flag check per connection and per retry.
+'''
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Custom callback event dispatched by the Assistant when the LLM returned an empty answer and is asked again
+RETRY_EVENT = "assistant_retry"
+
+# Span of the code currently running (parent of the database queries it makes)
+_current_span = contextvars.ContextVar("current_span", default=None)
+_span_ids = itertools.count(1)
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{str(value)}"' for key, value in sorted(labels.items())) + "}"
+
+
+class Telemetry:
+    """Collects spans and metrics, and writes the spans to a JSONL file.
+
+    Args:
+        trace_path (str): File the spans are appended to, one JSON object per line (None keeps metrics only).
+    """
+
+    def __init__(self, trace_path: Optional[str] = None):
+        self.trace_path = trace_path
+        self._trace = open(trace_path, "a", encoding="utf-8", buffering=1) if trace_path else None
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def record(self, span: dict):
+        """Record a finished span (kind, name, start, duration_ms, status and free-form attributes)."""
+        labels = (("kind", span["kind"]), ("name", span["name"]))
+        with self._lock:
+            histogram = self._histograms.get(labels)
+            if histogram is None:
+                histogram = self._histograms[labels] = _Histogram()
+            histogram.observe(span["duration_ms"] / 1000)
+            if span.get("status") == "error":
+                self._count("skincare_span_errors_total", 1, labels)
+            if self._trace is not None:
+                self._trace.write(json.dumps(span, default=str) + "\n")
+
+    def count(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self._count(name, value, tuple(sorted(labels.items())))
+
+    def _count(self, name: str, value: float, labels: tuple):
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def metrics_text(self) -> str:
+        """Return the metrics in the Prometheus/OpenMetrics text exposition format."""
+        lines = [
+            "# HELP skincare_span_duration_seconds Duration of graph nodes, LLM calls, tool calls and SQL statements.",
+            "# TYPE skincare_span_duration_seconds histogram",
+        ]
+        with self._lock:
+            for labels, histogram in sorted(self._histograms.items()):
+                labels = dict(labels)
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append(f"skincare_span_duration_seconds_bucket{_labels({**labels, 'le': bound})} {cumulative}")
+                lines.append(f"skincare_span_duration_seconds_bucket{_labels({**labels, 'le': '+Inf'})} {histogram.count}")
+                lines.append(f"skincare_span_duration_seconds_sum{_labels(labels)} {histogram.sum}")
+                lines.append(f"skincare_span_duration_seconds_count{_labels(labels)} {histogram.count}")
+
+            typed = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                family = name[: -len("_total")]
+                if family not in typed:
+                    lines.append(f"# TYPE {family} counter")
+                    typed.add(family)
+                lines.append(f"{name}{_labels(dict(labels))} {value}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.metrics_text())
+
+    def close(self):
+        with self._lock:
+            if self._trace is not None:
+                self._trace.close()
+                self._trace = None
+
+
+_telemetry: Optional[Telemetry] = None
+
+
+def enable(trace_path: Optional[str] = None) -> Telemetry:
+    """Start recording. Call it before the database connections are opened so that their queries are timed."""
+    global _telemetry
+    if _telemetry is None:
+        _telemetry = Telemetry(trace_path)
+    return _telemetry
+
+
+def disable():
+    global _telemetry
+    if _telemetry is not None:
+        _telemetry.close()
+    _telemetry = None
+
+
+def enabled() -> bool:
+    return _telemetry is not None
+
+
+def get_telemetry() -> Optional[Telemetry]:
+    return _telemetry
+
+
+def callbacks() -> list:
+    """Callback handlers to add to the graph config ([] while disabled)."""
+    return [TracingCallbackHandler(_telemetry)] if _telemetry is not None else []
+
+
+def record_retry(config: dict):
+    """Count an empty-response retry of the Assistant and add it to the span of its node run."""
+    if _telemetry is None:
+        return
+    _telemetry.count("skincare_assistant_retries_total")
+    try:
+        dispatch_custom_event(RETRY_EVENT, {}, config=config)
+    except RuntimeError:
+        # Called outside of a traced run
+        pass
+
+
+def _start_span(kind: str, name: str, **attributes) -> dict:
+    span = {
+        "span_id": next(_span_ids),
+        "parent_id": _current_span.get(),
+        "kind": kind,
+        "name": name,
+        "start": time.time(),
+        "_started": time.perf_counter(),
+        **attributes,
+    }
+    _current_span.set(span["span_id"])
+    return span
+
+
+def _finish_span(telemetry: Telemetry, span: dict, status: str = "ok"):
+    span["duration_ms"] = (time.perf_counter() - span.pop("_started")) * 1000
+    span["status"] = status
+    _current_span.set(span["parent_id"])
+    telemetry.record(span)
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Records a span for every graph node run, chat model call and tool call of a graph invocation."""
+
+    def __init__(self, telemetry: Telemetry):
+        self.telemetry = telemetry
+        self._spans = {}
+
+    def _start(self, run_id: UUID, kind: str, name: str, metadata: Optional[dict], **attributes):
+        thread_id = (metadata or {}).get("thread_id")
+        self._spans[run_id] = _start_span(kind, name, thread_id=thread_id, **attributes)
+
+    def _end(self, run_id: UUID, status: str = "ok", **attributes):
+        span = self._spans.pop(run_id, None)
+        if span is not None:
+            span.update(attributes)
+            _finish_span(self.telemetry, span, status)
+
+    def on_chain_start(self, serialized, inputs, *, run_id: UUID, metadata=None, **kwargs: Any) -> Any:
+        # Only the chain named after its node is a node run (the rest are LangChain internals)
+        if metadata and kwargs.get("name") == metadata.get("langgraph_node"):
+            self._start(run_id, "node", metadata["langgraph_node"], metadata, retries=0)
+
+    def on_chain_end(self, outputs, *, run_id: UUID, **kwargs: Any) -> Any:
+        self._end(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> Any:
+        # Interrupts are raised as exceptions too, but they are not failures
+        status = "interrupt" if type(error).__name__ == "GraphInterrupt" else "error"
+        self._end(run_id, status, error=None if status == "interrupt" else repr(error))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, tags=None, metadata=None, **kwargs: Any) -> Any:
+        name = (metadata or {}).get("ls_model_name") or (serialized or {}).get("name") or "llm"
+        # Internal calls (e.g. the rolling summary) are tagged nostream
+        self._start(run_id, "llm", name, metadata, internal=bool(tags and TAG_NOSTREAM in tags))
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs: Any) -> Any:
+        attributes = {}
+        try:
+            usage = response.generations[0][0].message.usage_metadata or {}
+        except (AttributeError, IndexError):
+            usage = {}
+        if usage:
+            attributes = {"input_tokens": usage.get("input_tokens", 0), "output_tokens": usage.get("output_tokens", 0)}
+            self.telemetry.count("skincare_llm_tokens_total", attributes["input_tokens"], direction="input")
+            self.telemetry.count("skincare_llm_tokens_total", attributes["output_tokens"], direction="output")
+        self._end(run_id, **attributes)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> Any:
+        self._end(run_id, "error", error=repr(error))
+
+    def on_tool_start(self, serialized, input_str, *, run_id: UUID, metadata=None, **kwargs: Any) -> Any:
+        self._start(run_id, "tool", (serialized or {}).get("name") or kwargs.get("name") or "tool", metadata)
+
+    def on_tool_end(self, output, *, run_id: UUID, **kwargs: Any) -> Any:
+        self._end(run_id)
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> Any:
+        self._end(run_id, "error", error=repr(error))
+
+    def on_custom_event(self, name: str, data: Any, *, run_id: UUID, **kwargs: Any) -> Any:
+        if name == RETRY_EVENT:
+            span = self._spans.get(run_id)
+            if span is not None:
+                span["retries"] = span.get("retries", 0) + 1
+
+
+def _statement_name(sql: str) -> str:
+    """Short, low-cardinality name of a SQL statement, e.g. "SELECT products"."""
+    verb = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else "SQL"
+    table = re.search(r"\b(?:FROM|INTO|UPDATE|TABLE)\s+\"?(\w+)", sql, re.IGNORECASE)
+    return f"{verb} {table.group(1)}" if table else verb
+
+
+def _traced(method, sql: str, *args):
+    telemetry = _telemetry
+    if telemetry is None:
+        return method(sql, *args)
+    span = _start_span("db", _statement_name(sql))
+    try:
+        result = method(sql, *args)
+    except Exception:
+        _finish_span(telemetry, span, "error")
+        raise
+    _finish_span(telemetry, span)
+    return result
+
+
+class TracedCursor(sqlite3.Cursor):
+    """Cursor that records a "db" span for every statement."""
+
+    def execute(self, sql, *args):
+        return _traced(super().execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return _traced(super().executemany, sql, *args)
+
+
+class TracedConnection(sqlite3.Connection):
+    """Connection factory (sqlite3.connect(..., factory=TracedConnection)) whose statements are timed."""
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.cursor().executemany(sql, *args)
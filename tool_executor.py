@@ -0,0 +1,162 @@
+import contextvars
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import monotonic
+from typing import Optional, Sequence
+
+from langchain_core.messages import AIMessage, AnyMessage, RemoveMessage, ToolCall, ToolMessage
+from langchain_core.runnables import RunnableConfig
+from langchain_core.tools import BaseTool
+from langgraph.prebuilt.tool_node import INVALID_TOOL_NAME_ERROR_TEMPLATE
+from assistant import State
+from result_format import DEFAULT_FORMAT, format_content
+
+'''
+    This is a module that executes the tool calls of an AI message. The calls are split by tool node (safe tools run
+    straight away, sensitive ones wait for the user's approval), each node runs its share of the calls concurrently
+    on a thread pool with a per-call timeout, and the results of the whole batch end up in the original call order.
+    Calls to tools that no node has are answered with an error by the node given the names of all the tools.
+'''
+
+
+def last_tool_call_message(messages: Sequence[AnyMessage]) -> Optional[AIMessage]:
+    """Return the most recent AIMessage with tool calls (it may be followed by some of its ToolMessages)."""
+    for message in reversed(messages):
+        if isinstance(message, AIMessage):
+            return message if message.tool_calls else None
+    return None
+
+
+def pending_tool_calls(messages: Sequence[AnyMessage], tool_names: Optional[set] = None) -> list[ToolCall]:
+    """Return the tool calls of the last AI message that do not have a result yet (optionally only some tools)."""
+    ai_message = last_tool_call_message(messages)
+    if ai_message is None:
+        return []
+    answered = {m.tool_call_id for m in messages if isinstance(m, ToolMessage)}
+    return [
+        call for call in ai_message.tool_calls
+        if call["id"] not in answered and (tool_names is None or call["name"] in tool_names)
+    ]
+
+
+def in_call_order(messages: Sequence[AnyMessage], results: dict) -> list[AnyMessage]:
+    """Messages adding results (tool_call_id -> ToolMessage) for pending calls of the last AI message, in the
+       order of its calls. When they complete a batch that already has results of other calls (e.g. the safe
+       calls ran before the sensitive ones were approved or denied), the whole batch is emitted again so that
+       every result follows the original order of the calls.
+    """
+    ai_message = last_tool_call_message(messages)
+    if ai_message is None:
+        return list(results.values())
+    if results and len(results) == len(pending_tool_calls(messages)) and len(results) < len(ai_message.tool_calls):
+        earlier = {m.tool_call_id: m for m in messages if isinstance(m, ToolMessage)}
+        removed, ordered = [], []
+        for call in ai_message.tool_calls:
+            if call["id"] in results:
+                ordered.append(results[call["id"]])
+            else:
+                removed.append(RemoveMessage(id=earlier[call["id"]].id))
+                ordered.append(earlier[call["id"]].model_copy(update={"id": str(uuid.uuid4())}))
+        return removed + ordered
+    return [results[call["id"]] for call in ai_message.tool_calls if call["id"] in results]
+
+
+def error_message(call: ToolCall, error: Exception) -> ToolMessage:
+    return ToolMessage(
+        content=f"Error: {repr(error)}\n please fix your mistakes.",
+        name=call["name"],
+        tool_call_id=call["id"],
+        status="error",
+    )
+
+
+class ParallelToolNode:
+    """Graph node that runs its pending tool calls concurrently.
+
+    Args:
+        tools (list): The tools this node is allowed to run. Calls to other tools are left for another node.
+        timeout (float): Seconds each call may take once it started before it is answered with a timeout error
+            (the call keeps running in the background). None waits for every call: use it for tools that
+            write, whose result must not be reported before it is known.
+        all_tool_names (set): Names of the tools of every node. If given, this node also answers the calls to
+            tools outside of it with an "is not a valid tool" error (as LangGraph's ToolNode).
+        max_workers (int): Size of the thread pool shared by the calls of this node.
+        result_format (str): Format of the results, "table" (lists of rows written once as columns and rows)
+            or "json" (as LangGraph's ToolNode), see result_format.py.
+    """
+
+    def __init__(
+        self,
+        tools: Sequence[BaseTool],
+        timeout: Optional[float] = 10.0,
+        max_workers: int = 8,
+        result_format: str = DEFAULT_FORMAT,
+        all_tool_names: Optional[set] = None,
+    ):
+        self.tools_by_name = {t.name: t for t in tools}
+        self.timeout = timeout
+        self.all_tool_names = all_tool_names
+        self.result_format = result_format
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+
+    def _run_one(self, call: ToolCall, config: RunnableConfig, started: dict) -> ToolMessage:
+        started[call["id"]] = monotonic()
+        if call["name"] not in self.tools_by_name:
+            return ToolMessage(
+                content=INVALID_TOOL_NAME_ERROR_TEMPLATE.format(
+                    requested_tool=call["name"], available_tools=", ".join(sorted(self.all_tool_names))
+                ),
+                name=call["name"],
+                tool_call_id=call["id"],
+                status="error",
+            )
+        try:
+            tool_message = self.tools_by_name[call["name"]].invoke({**call, "type": "tool_call"}, config)
+            tool_message.content = format_content(tool_message.content, self.result_format)
+            return tool_message
+        except Exception as e:
+            return error_message(call, e)
+
+    def _own_calls(self, messages: Sequence[AnyMessage]) -> list[ToolCall]:
+        """Pending calls of this node's tools (and of unknown tools, if it answers those)."""
+        return [
+            call for call in pending_tool_calls(messages)
+            if call["name"] in self.tools_by_name
+            or (self.all_tool_names is not None and call["name"] not in self.all_tool_names)
+        ]
+
+    def __call__(self, state: State, config: RunnableConfig):
+        messages = state["messages"]
+        calls = self._own_calls(messages)
+
+        # Each call runs in a copy of the current context (so context variables follow it into the pool).
+        # Its timeout counts from when it starts: calls queued behind others in the pool are not charged.
+        started = {}
+        pending = {
+            self.executor.submit(contextvars.copy_context().run, self._run_one, call, config, started): call
+            for call in calls
+        }
+        results = {}
+        while pending:
+            wait_for = None
+            if self.timeout is not None:
+                now = monotonic()
+                wait_for = max(min(started.get(call["id"], now) for call in pending.values()) + self.timeout - now, 0)
+            done, _ = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[pending.pop(future)["id"]] = future.result()
+            if self.timeout is None:
+                continue
+            now = monotonic()
+            for future, call in list(pending.items()):
+                if call["id"] in started and now - started[call["id"]] >= self.timeout:
+                    # The call keeps running in the background; its result is dropped
+                    del pending[future]
+                    results[call["id"]] = error_message(
+                        call, TimeoutError(f"Tool '{call['name']}' did not answer within {self.timeout} seconds.")
+                    )
+
+        return {"messages": in_call_order(messages, results)}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,21 +1,37 @@
+import base64
+import json
+import re
 import sqlite3
 from datetime import datetime, timedelta
 from langchain_core.tools import tool
 import pytz
 from langchain_core.runnables import RunnableConfig
 from typing import Optional, List, Union
+from database import get_connection, get_pool
+from catalog import get_catalog, PRODUCT_COLUMNS
+from recommender import get_recommender
+from cart_store import get_store
+from singleflight import SingleFlight, coalesce
 
-''' This is a script that contains 10 LangChain tools to support the AI assistant's capabilities.'''
+''' This is a script that contains 11 LangChain tools to support the AI assistant's capabilities.'''
 
-# Path to the SQLite database file
-db = "skincare.sqlite"
+# Connections come from the shared pool in database.py (use database.configure() to change the database file),
+# the carts are kept by the store of cart_store.py (optionally sharded by user) and the read tools are answered from the in-memory catalog in catalog.py whenever possible.
+# Concurrent identical calls of the read tools (same tool, same arguments) share one execution through
+# TOOL_FLIGHT, so a burst of sessions asking for the categories runs one query instead of one each.
+TOOL_FLIGHT = SingleFlight("tools")
 
 
-@tool
-def get_product_categories() -> list[str]:
-    """Fetch all product categories from the database.
-    """
-    conn = sqlite3.connect(db)
+def _database_path() -> str:
+    # Runs bound to different databases (database.use_database()) never share results
+    return get_pool().path
+
+
+def _query_categories(snapshot) -> list[str]:
+    if snapshot.loaded:
+        return snapshot.categories
+
+    conn = get_connection()
     cursor = conn.cursor()
 
     query = """
@@ -29,19 +45,84 @@ def get_product_categories() -> list[str]:
     results = [row[0] for row in rows]
 
     cursor.close()
-    conn.close()
 
     return results
 
 
 @tool
-def search_product_by_name(product_name: str) -> Union[dict, List[dict]]:
-    """Fetch up to 3 products by partial match of their name."""
-    try:
-        conn = sqlite3.connect(db)
-        cursor = conn.cursor()
+@coalesce(TOOL_FLIGHT, scope=_database_path)
+def get_product_categories() -> list[str]:
+    """Fetch all product categories from the database.
+    """
+    return list(get_catalog().cached(("get_product_categories",), _query_categories))
 
-        # Use the LIKE operator for partial matching and LIMIT the results to 4
+
+def _has_search_index(conn) -> bool:
+    """Check whether setup.py built the FTS5 index over the products table."""
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_fts'"
+    ).fetchone()
+    return row is not None
+
+
+def _fts_terms(text: str) -> list[str]:
+    """Turn free text into quoted FTS5 terms (quoting stops user input from being parsed as query syntax).
+       Words of 3+ characters are prefix matched, shorter ones must match exactly.
+    """
+    return [
+        f'"{token}"*' if len(token) >= 3 else f'"{token}"'
+        for token in re.findall(r"\w+", text.lower())
+    ]
+
+
+def _product_dicts(rows) -> List[dict]:
+    return [
+        {
+            "product_id": row[0],
+            "product_name": row[1],
+            "description": row[2],
+            "category": row[3],
+            "stock": row[4],
+            "price": row[5]
+        }
+        for row in rows
+    ]
+
+
+def _query_products_by_name(snapshot, product_name: str) -> list[tuple]:
+    # Answer from the in-memory name index when the catalog is loaded
+    if snapshot.loaded:
+        return snapshot.search_names(product_name)
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        terms = _fts_terms(product_name)
+        if terms and _has_search_index(conn):
+            # Rank the name matches with bm25 using the full-text index (every term must match)
+            query = """
+            SELECT 
+                p.product_id, p.product_name, p.description, p.category, p.stock, p.price
+            FROM 
+                products_fts
+                JOIN products p ON p.product_id = products_fts.rowid
+            WHERE 
+                products_fts MATCH ?
+            ORDER BY 
+                bm25(products_fts)
+            LIMIT 3
+            """
+            try:
+                cursor.execute(query, (f"product_name : ({' '.join(terms)})",))
+                rows = cursor.fetchall()
+                if rows:
+                    return rows
+            except sqlite3.OperationalError:
+                # The index exists but this SQLite build has no FTS5 module
+                pass
+
+        # Fallback: use the LIKE operator for partial matching (also for the parts of words, e.g. "oist", that the
+        # prefix terms of the full-text index do not match)
         query = """
         SELECT 
             product_id, product_name, description, category, stock, price
@@ -53,98 +134,310 @@ def search_product_by_name(product_name: str) -> Union[dict, List[dict]]:
         """
         # Use '%' for partial matching on both sides
         cursor.execute(query, (f"%{product_name}%",))
-        rows = cursor.fetchall()
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+@tool
+@coalesce(TOOL_FLIGHT, scope=_database_path)
+def search_product_by_name(product_name: str) -> Union[dict, List[dict]]:
+    """Fetch up to 3 products by partial match of their name."""
+    try:
+        rows = get_catalog().cached(
+            ("search_product_by_name", product_name),
+            lambda snapshot: _query_products_by_name(snapshot, product_name),
+        )
 
         if not rows:
             return {"message": "No matching products found."}
 
         # If there are matches, return them as a list of dictionaries
-        results = [
-            {
-                "product_id": row[0],
-                "product_name": row[1],
-                "description": row[2],
-                "category": row[3],
-                "stock": row[4],
-                "price": row[5]
-            }
-            for row in rows
-        ]
+        results = _product_dicts(rows)
     except Exception as e:
         return {"message": f"Error: {str(e)}"}
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
     # Return a single product if only one match is found, else return a list
     return results[0] if len(results) == 1 else results
 
 
-@tool
-def get_recommendations(category: str, description: str) -> Union[List[dict], dict]:
-    """Get up to 3 product recommendations based on category and partial match in description.
-       If no matches are found with the description, fetch products by category only.
-    """
+def _query_recommendations(snapshot, category: str, description: str) -> list[tuple]:
+    conn = get_connection()
+    cursor = conn.cursor()
     try:
-        conn = sqlite3.connect(db)
-        cursor = conn.cursor()
+        # Step 1: Try fetching by category and a match in the description
+        rows = None
+        terms = _fts_terms(description)
+        if terms and _has_search_index(conn):
+            # Rank products matching any of the description terms with bm25 (name matches weigh more)
+            query_with_description = """
+            SELECT 
+                p.product_id, p.product_name, p.description, p.category, p.stock, p.price
+            FROM 
+                products_fts
+                JOIN products p ON p.product_id = products_fts.rowid
+            WHERE 
+                products_fts MATCH ? AND p.category = ? COLLATE NOCASE AND p.stock > 0
+            ORDER BY 
+                bm25(products_fts, 2.0, 1.0, 0.0)
+            LIMIT 3
+            """
+            try:
+                cursor.execute(
+                    query_with_description,
+                    (f"{{product_name description}} : ({' OR '.join(terms)})", category),
+                )
+                rows = cursor.fetchall()
+            except sqlite3.OperationalError:
+                # The index exists but this SQLite build has no FTS5 module
+                rows = None
+
+        if rows is None:
+            # Fallback: partial match in the description with the LIKE operator
+            query_with_description = """
+            SELECT 
+                product_id, product_name, description, category, stock, price
+            FROM 
+                products
+            WHERE 
+                category = ? COLLATE NOCASE AND LOWER(description) LIKE LOWER(?) AND stock > 0
+            LIMIT 3
+            """
+            cursor.execute(query_with_description, (category, f"%{description}%"))
+            rows = cursor.fetchall()
+
+        if rows:
+            return rows
 
-        # Step 1: Try fetching by category and partial match in description
-        query_with_description = """
+        # Step 2: If no results found, fallback to fetching by category only (still only products in stock)
+        if snapshot.loaded:
+            return [row for row in snapshot.by_category.get(category.casefold(), []) if row[4] and row[4] > 0][:3]
+
+        query_fallback = """
         SELECT 
             product_id, product_name, description, category, stock, price
         FROM 
             products
         WHERE 
-            LOWER(category) = LOWER(?) AND LOWER(description) LIKE LOWER(?)
+            category = ? COLLATE NOCASE AND stock > 0
         LIMIT 3
         """
-        cursor.execute(query_with_description, (category, f"%{description}%"))
-        rows = cursor.fetchall()
+        cursor.execute(query_fallback, (category,))
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def _products_by_id(snapshot, product_ids: list[int]) -> list[tuple]:
+    """Return the product rows with these ids, in the same order (ids that no longer exist are skipped)."""
+    if snapshot.loaded:
+        rows = {product_id: snapshot.by_id.get(product_id) for product_id in product_ids}
+    else:
+        conn = get_connection()
+        cursor = conn.execute(
+            f"SELECT {', '.join(PRODUCT_COLUMNS)} FROM products "
+            f"WHERE product_id IN ({', '.join('?' * len(product_ids))})",
+            product_ids,
+        )
+        rows = {row[0]: row for row in cursor.fetchall()}
+        cursor.close()
+    return [rows[product_id] for product_id in product_ids if rows.get(product_id)]
+
+
+def _rank_recommendations(snapshot, recommender, category: str, description: str, limit: int = 3) -> list[tuple]:
+    """Return the best matching in-stock products of the category, using the recommendation index."""
+    results = []
+    for product_ids in recommender.ranked(category, description):
+        # Stock is not part of the index: check it on the current rows
+        results.extend(row for row in _products_by_id(snapshot, product_ids) if row[4] and row[4] > 0)
+        if len(results) >= limit:
+            break
+    return results[:limit]
+
+
+def _recommend(snapshot, category: str, description: str) -> list[tuple]:
+    recommender = get_recommender(get_pool().path)
+    if recommender is None:
+        # Database set up without the recommendation index: use the full-text index (or LIKE) instead
+        return _query_recommendations(snapshot, category, description)
+    return _rank_recommendations(snapshot, recommender, category, description)
 
-        # Step 2: If no results found, fallback to fetching by category only
-        if not rows:
-            query_fallback = """
-            SELECT 
-                product_id, product_name, description, category, stock, price
-            FROM 
-                products
-            WHERE 
-                LOWER(category) = LOWER(?)
-            LIMIT 3
-            """
-            cursor.execute(query_fallback, (category,))
-            rows = cursor.fetchall()
 
-            if not rows:
-                return {"message": "No relevant products found in this category."}
+@tool
+@coalesce(TOOL_FLIGHT, scope=_database_path)
+def get_recommendations(category: str, description: str) -> Union[List[dict], dict]:
+    """Get up to 3 in-stock product recommendations from a category, ranked by how well they match the description.
+       If nothing matches the description, other products of the category are recommended.
+    """
+    try:
+        rows = get_catalog().cached(
+            ("get_recommendations", category, description),
+            lambda snapshot: _recommend(snapshot, category, description),
+        )
+
+        if not rows:
+            return {"message": "No relevant products found in this category."}
 
         # Prepare results as a list of dictionaries
-        results = [
-            {
-                "product_id": row[0],
-                "product_name": row[1],
-                "description": row[2],
-                "category": row[3],
-                "stock": row[4],
-                "price": row[5]
-            }
-            for row in rows
-        ]
+        results = _product_dicts(rows)
 
     except Exception as e:
         return {"message": f"Error: {str(e)}"}
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
     return results
 
 
+# Sort orders of browse_products: (ORDER BY columns, direction). product_id breaks ties so every key is unique.
+BROWSE_SORTS = {
+    "price_asc": ("price", "ASC"),
+    "price_desc": ("price", "DESC"),
+    "name": ("product_name", "ASC"),
+}
+
+# Largest page browse_products returns
+MAX_PAGE_SIZE = 20
+
+# Cart items returned per view_cart page
+CART_PAGE_SIZE = 20
+
+
+def _encode_cursor(state: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(",", ":")).encode("utf-8")).decode("ascii")
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _decode_cursor(cursor: str) -> dict:
+    """State of the next page encoded by _encode_cursor(). Every field is checked, so a tampered cursor is
+       rejected here instead of failing inside the query.
+    """
+    invalid = ValueError("Invalid cursor: pass the next_cursor of the previous page unchanged.")
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, UnicodeError):
+        raise invalid
+    if not isinstance(state, dict) or state.get("sort") not in BROWSE_SORTS:
+        raise invalid
+    after = state.get("after")
+    if not isinstance(after, list) or len(after) != 2 or not isinstance(after[1], int) or isinstance(after[1], bool):
+        raise invalid
+    # The sort key of the last row: a price, or a product name
+    if not (_is_number(after[0]) if BROWSE_SORTS[state["sort"]][0] == "price" else isinstance(after[0], str)):
+        raise invalid
+    if (
+        not (state.get("category") is None or isinstance(state["category"], str))
+        or not all(state.get(key) is None or _is_number(state[key]) for key in ("min_price", "max_price"))
+        or not isinstance(state.get("in_stock"), bool)
+        or not isinstance(state.get("page_size"), int)
+        or isinstance(state["page_size"], bool)
+    ):
+        raise invalid
+    # A cursor is not trusted to keep the page size within the limits
+    state["page_size"] = min(max(state["page_size"], 1), MAX_PAGE_SIZE)
+    return state
+
+
+def _decode_cart_cursor(cursor: str) -> int:
+    try:
+        return int(json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))["cart_after"])
+    except (ValueError, UnicodeError, TypeError, KeyError):
+        raise ValueError("Invalid cursor: pass the next_cursor of the previous page unchanged.")
+
+
+def _query_browse(state: dict) -> tuple[list[tuple], Optional[dict]]:
+    """Return one page of products and the state of the next page (None on the last page).
+       Pages continue after the sort key of the last row (keyset pagination), so the idx_products_browse_*
+       indexes created by setup.py find the start of any page directly instead of skipping OFFSET rows.
+    """
+    column, direction = BROWSE_SORTS[state["sort"]]
+    conditions, params = [], []
+    if state.get("category"):
+        conditions.append("category = ? COLLATE NOCASE")
+        params.append(state["category"])
+    if state.get("min_price") is not None:
+        conditions.append("price >= ?")
+        params.append(state["min_price"])
+    if state.get("max_price") is not None:
+        conditions.append("price <= ?")
+        params.append(state["max_price"])
+    if state.get("in_stock"):
+        conditions.append("stock > 0")
+    if column == "price":
+        # Products without a price cannot be placed in a price order
+        conditions.append("price IS NOT NULL")
+    if state.get("after"):
+        conditions.append(f"({column}, product_id) {'>' if direction == 'ASC' else '<'} (?, ?)")
+        params.extend(state["after"])
+
+    query = f"""
+    SELECT 
+        product_id, product_name, description, category, stock, price
+    FROM 
+        products
+    {"WHERE " + " AND ".join(conditions) if conditions else ""}
+    ORDER BY 
+        {column} {direction}, product_id {direction}
+    LIMIT ?
+    """
+    # One extra row tells whether there is a next page
+    page_size = state["page_size"]
+    rows = get_connection().execute(query, (*params, page_size + 1)).fetchall()
+
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    last = rows[-1]
+    return rows, {**state, "after": [last[5] if column == "price" else last[1], last[0]]}
+
+
+@tool
+@coalesce(TOOL_FLIGHT, scope=_database_path)
+def browse_products(
+    category: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    in_stock: bool = True,
+    sort: str = "price_asc",
+    page_size: int = 5,
+    cursor: Optional[str] = None,
+) -> dict:
+    """Browse the catalog one page at a time, filtered by category, price range and stock.
+       sort is one of "price_asc", "price_desc" or "name". To show more results, call the tool again with only
+       the next_cursor of the previous page as cursor (it keeps the filters); next_cursor is null on the last page.
+    """
+    try:
+        if cursor:
+            state = _decode_cursor(cursor)
+        else:
+            if sort not in BROWSE_SORTS:
+                return {"message": f"Unknown sort '{sort}'. Use one of: {', '.join(BROWSE_SORTS)}."}
+            state = {
+                "category": category,
+                "min_price": min_price,
+                "max_price": max_price,
+                "in_stock": in_stock,
+                "sort": sort,
+                "page_size": min(max(int(page_size), 1), MAX_PAGE_SIZE),
+                "after": None,
+            }
+
+        rows, next_state = get_catalog().cached(
+            ("browse_products", json.dumps(state, sort_keys=True)),
+            lambda snapshot: _query_browse(state),
+        )
+        if not rows:
+            return {"message": "No matching products found."}
+
+        return {
+            "products": _product_dicts(rows),
+            "next_cursor": _encode_cursor(next_state) if next_state else None,
+        }
+    except Exception as e:
+        return {"message": f"Error: {str(e)}"}
+
+
 @tool
 def add_to_cart(config: RunnableConfig, product_id: int, quantity: int = 1) -> dict:
     '''Add a product to the user's cart with the specified quantity.'''
@@ -154,42 +447,17 @@ def add_to_cart(config: RunnableConfig, product_id: int, quantity: int = 1) -> d
 
         if not user_id:
             raise ValueError("No user_id found in the configuration.")
-        
-        conn = sqlite3.connect(db)
-        cursor = conn.cursor()
 
-        # Check if the product exists and get its price, stock, and name
-        cursor.execute("SELECT product_name, price, stock FROM products WHERE product_id = ?", (product_id,))
-        row = cursor.fetchone()
-
-        if not row:
+        # The cart store writes the single carts table or the user's shard (see cart_store.py)
+        status = get_store().add(user_id, product_id, quantity)
+        if status == "not_found":
             return {"message": "Product not found."}
-        
-        product_name, price, stock = row
-        if stock < quantity:
+        if status == "insufficient_stock":
             return {"message": "Insufficient stock."}
-        
-        # Check to see if the product is already in the cart, increase quantity if so.
-        cursor.execute("SELECT quantity FROM shopping_carts WHERE user_id = ? AND product_id = ?", (user_id, product_id))
-        row = cursor.fetchone()
-
-        if row:
-            quantity += row[0]
-            cursor.execute("UPDATE shopping_carts SET quantity = ? WHERE user_id = ? AND product_id = ?", (quantity, user_id, product_id))
-        else:
-            # Insert the product name along with price and quantity into the cart
-            cursor.execute("INSERT INTO shopping_carts (user_id, product_id, product_name, price, quantity) VALUES (?, ?, ?, ?, ?)", 
-                           (user_id, product_id, product_name, price, quantity))
-        
-        conn.commit()
+
         return {"message": "Product added to cart successfully."}
     except Exception as e:
         return {"message": f"Error: {str(e)}"}
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
 @tool
 def remove_from_cart(config: RunnableConfig, product_id: int) -> dict:
@@ -200,53 +468,33 @@ def remove_from_cart(config: RunnableConfig, product_id: int) -> dict:
 
         if not user_id:
             raise ValueError("No user_id found in the configuration.")
-        
-        conn = sqlite3.connect(db)
-        cursor = conn.cursor()
-
-        # Check if the product exists in the cart
-        cursor.execute("SELECT * FROM shopping_carts WHERE user_id = ? AND product_id = ?", (user_id, product_id))
-        row = cursor.fetchone()
 
-        if not row:
+        if not get_store().remove(user_id, product_id):
             return {"message": "Product not found in cart."}
 
-        # If the product exists, delete it from the cart
-        cursor.execute("DELETE FROM shopping_carts WHERE user_id = ? AND product_id = ?", (user_id, product_id))
-        
-        conn.commit()
         return {"message": "Product removed from cart successfully."}
     except Exception as e:
         return {"message": f"Error: {str(e)}"}
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
 
 @tool
-def view_cart(config: RunnableConfig) -> Union[dict, List[dict]]:
-    '''View the user's cart and calculate the total price.'''
+def view_cart(config: RunnableConfig, cursor: Optional[str] = None) -> Union[dict, List[dict]]:
+    '''View the user's cart and its total price. Large carts are returned in pages: pass the next_cursor
+       of a page as cursor to get the next one.'''
     try:
         # Get the user_id from the configuration to identify their cart
         user_id = config.get("configurable", {}).get("thread_id", None)
 
         if not user_id:
             raise ValueError("No user_id found in the configuration.")
-        
-        conn = sqlite3.connect(db)
-        cursor = conn.cursor()
 
-        # Fetch all products in the user's cart
-        cursor.execute("SELECT product_id, product_name, price, quantity FROM shopping_carts WHERE user_id = ?", (user_id,))
-        rows = cursor.fetchall()
-
-        if not rows:
+        # The totals come from the cart summary kept up to date by triggers (one row), not from the items.
+        # It is read with the page of rows in one transaction, so both see the same cart.
+        after = _decode_cart_cursor(cursor) if cursor else None
+        summary, rows = get_store().page(user_id, after, CART_PAGE_SIZE + 1)
+        if not summary:
             return {"message": "Cart is empty."}
-        
-        # Calculate the total price of the cart
-        total_price = sum(price * quantity for _, _, price, quantity in rows)
+        _, items, total_price = summary
 
         # Prepare results as a list of dictionaries
         results = [
@@ -256,17 +504,15 @@ def view_cart(config: RunnableConfig) -> Union[dict, List[dict]]:
                 "price": row[2],
                 "quantity": row[3]
             }
-            for row in rows
+            for row in rows[:CART_PAGE_SIZE]
         ]
 
-        return {"total_price": total_price, "products": results}
+        result = {"total_price": round(total_price, 2), "item_count": items, "products": results}
+        if len(rows) > CART_PAGE_SIZE:
+            result["next_cursor"] = _encode_cursor({"cart_after": rows[CART_PAGE_SIZE - 1][0]})
+        return result
     except Exception as e:
         return {"message": f"Error: {str(e)}"}
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
 
 @tool
@@ -0,0 +1,152 @@
+import argparse
+import json
+import os
+import threading
+import time
+import urllib.request
+from typing import Optional
+
+'''
+    This is a module that warms the Ollama model up in the background while the chatbot starts. It only uses the
+    standard library, so chatbot.py can start it before importing LangChain and LangGraph (about a second), and
+    the model loads into Ollama while those imports, the graph build and the welcome banner run:
+
+        1. preload() loads the model with an empty /api/generate request and a keep-alive.
+        2. prime() sends the static system prompt and tool schemas with num_predict 1, so Ollama has already
+           evaluated that prompt prefix when the first user turn arrives.
+
+    Both requests run on daemon threads and never fail the chatbot: an unreachable Ollama is only reported.
+    Point --ollama-url at "python stub_llm.py" to try the startup path without Ollama.
+'''
+
+DEFAULT_MODEL = "llama3.2:3b"
+DEFAULT_OLLAMA_URL = os.environ.get("OLLAMA_HOST", "http://127.0.0.1:11434")
+DEFAULT_KEEP_ALIVE = "30m"
+
+# Seconds a warm-up request may take (loading a model from disk can be slow)
+REQUEST_TIMEOUT = 300.0
+
+
+def ollama_url(host: str) -> str:
+    """Base URL of an Ollama host given as OLLAMA_HOST accepts it ("localhost:11434", "http://host:port")."""
+    url = host if "://" in host else f"http://{host}"
+    return url.rstrip("/")
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Add the model options shared by chatbot.py and preload()."""
+    parser.add_argument("--model", default=DEFAULT_MODEL, help=f"Ollama model (default: {DEFAULT_MODEL}).")
+    parser.add_argument(
+        "--ollama-url",
+        default=DEFAULT_OLLAMA_URL,
+        help=f"Ollama endpoint, e.g. a local stand-in started with 'python stub_llm.py' "
+             f"(default: $OLLAMA_HOST or {DEFAULT_OLLAMA_URL}).",
+    )
+    parser.add_argument(
+        "--keep-alive",
+        default=DEFAULT_KEEP_ALIVE,
+        help=f"How long Ollama keeps the model loaded after a request (default: {DEFAULT_KEEP_ALIVE}).",
+    )
+    parser.add_argument("--no-warmup", action="store_true", help="Do not load the model before the first turn.")
+
+
+class Warmup:
+    """Background warm-up of one Ollama model.
+
+    Args:
+        model (str): Ollama model name.
+        url (str): Ollama base URL.
+        keep_alive (str): Keep-alive sent with the warm-up requests (e.g. "30m").
+    """
+
+    def __init__(self, model: str, url: str, keep_alive: str = DEFAULT_KEEP_ALIVE):
+        self.model = model
+        self.url = ollama_url(url)
+        self.keep_alive = keep_alive
+        self.started = time.perf_counter()
+        # load / prime: seconds each request took; ready: seconds from start() until the prefix was evaluated
+        self.timings = {}
+        self.error = None
+        self._threads = []
+
+    def _post(self, path: str, payload: dict) -> dict:
+        request = urllib.request.Request(
+            self.url + path,
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+            return json.loads(response.read().decode("utf-8") or "{}")
+
+    def _run(self, name: str, path: str, payload: dict, after: Optional[threading.Thread] = None):
+        if after is not None:
+            after.join()
+        if self.error is not None:
+            return
+        start = time.perf_counter()
+        try:
+            self._post(path, payload)
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            return
+        self.timings[name] = time.perf_counter() - start
+        if name == "prime":
+            self.timings["ready"] = time.perf_counter() - self.started
+
+    def _spawn(self, *args) -> threading.Thread:
+        thread = threading.Thread(target=self._run, args=args, name="ollama-warmup", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        return thread
+
+    def start(self) -> "Warmup":
+        """Load the model (an empty generate request only loads it)."""
+        self._spawn("load", "/api/generate", {"model": self.model, "keep_alive": self.keep_alive})
+        return self
+
+    def prime(self, messages: list[dict], tools: list[dict]):
+        """Evaluate the static prompt prefix (system messages and tool schemas, as the chat model sends them)
+           once the model is loaded.
+        """
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "tools": tools,
+            "stream": False,
+            "keep_alive": self.keep_alive,
+            "options": {"num_predict": 1},
+        }
+        self._spawn("prime", "/api/chat", payload, self._threads[-1] if self._threads else None)
+
+    def done(self) -> bool:
+        return all(not thread.is_alive() for thread in self._threads)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0.0, deadline - time.perf_counter()))
+        return self.done()
+
+    def report(self) -> str:
+        if self.error is not None:
+            return f"model warm-up failed ({self.error})"
+        if not self.done():
+            return "model warm-up running in the background"
+        parts = [f"{name} {self.timings[name]:.2f}s" for name in ("load", "prime") if name in self.timings]
+        ready = f" (ready {self.timings['ready']:.2f}s after start)" if "ready" in self.timings else ""
+        return f"model warm-up done: {', '.join(parts)}{ready}"
+
+
+def preload(argv: list[str]) -> Optional[Warmup]:
+    """Start loading the model selected by the chatbot command line (None for --stub, --replay or --no-warmup).
+       Only the model options are parsed, so this can run before the chatbot's imports.
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    add_arguments(parser)
+    parser.add_argument("--stub", action="store_true")
+    parser.add_argument("--replay", default=None)
+    parser.add_argument("-h", "--help", action="store_true")
+    args, _ = parser.parse_known_args(argv)
+    if args.stub or args.replay or args.no_warmup or args.help:
+        return None
+    return Warmup(args.model, args.ollama_url, args.keep_alive).start()